@@ -0,0 +1,73 @@
+"""
+RV32A atomic memory operations
+"""
+from amaranth import *
+from amaranth.lib import enum
+
+class AtomicFunction(enum.Enum, shape = 5):
+    # Upper 5 bits of funct7, aq and rl are below
+    ADD  = 0b00000
+    SWAP = 0b00001
+    LR   = 0b00010 # Load reserved
+    SC   = 0b00011 # Store conditional
+    XOR  = 0b00100
+    OR   = 0b01000
+    AND  = 0b01100
+    MIN  = 0b10000
+    MAX  = 0b10100
+    MINU = 0b11000
+    MAXU = 0b11100
+    
+def amo(f, old, value):
+    """
+    Word written back by AMO function f, from the word in
+    memory and the value of rs2
+    """
+    old = old.as_unsigned()
+    value = value.as_unsigned()
+    
+    less = old.as_signed() < value.as_signed()
+    less_unsigned = old < value
+    
+    result = value
+    for function, write in (
+        (AtomicFunction.ADD, old + value),
+        (AtomicFunction.XOR, old ^ value),
+        (AtomicFunction.OR, old | value),
+        (AtomicFunction.AND, old & value),
+        (AtomicFunction.MIN, Mux(less, old, value)),
+        (AtomicFunction.MAX, Mux(less, value, old)),
+        (AtomicFunction.MINU, Mux(less_unsigned, old, value)),
+        (AtomicFunction.MAXU, Mux(less_unsigned, value, old))
+    ):
+        result = Mux(f == function, write, result)
+        
+    return result[0:32]
+    
+def reservations(m, name, keys, reads, writes):
+    """
+    LR/SC reservation of each master on a shared memory
+    
+    keys are the words each master accesses, a reserved read
+    in reads sets the reservation, a write in writes by any
+    other master to the same word clears it. Returns whether
+    each master holds a reservation on the word it accesses
+    """
+    n = len(keys)
+    
+    valid = [Signal(name = "{}_valid{}".format(name, i)) for i in range(n)]
+    reserved = [Signal(len(keys[i]), name = "{}_key{}".format(name, i)) for i in range(n)]
+    held = [Signal(name = "{}_held{}".format(name, i)) for i in range(n)]
+    
+    for i in range(n):
+        key = Mux(reads[i], keys[i], reserved[i])
+        with m.If(reads[i]):
+            m.d.sync += reserved[i].eq(keys[i])
+            m.d.sync += valid[i].eq(1)
+        for j in range(n):
+            if j != i:
+                with m.If(writes[j] & (keys[j] == key)):
+                    m.d.sync += valid[i].eq(0)
+        m.d.comb += held[i].eq(valid[i] & (keys[i] == reserved[i]))
+        
+    return held
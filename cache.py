@@ -1,101 +1,463 @@
 from amaranth import *
-from amaranth.lib import wiring
+from amaranth.lib import wiring, memory
 from amaranth.lib.wiring import In, Out
+from amaranth.utils import exact_log2
 
-from signature import Bus
+from signature import Bus, CycleType
 
+def plru_victim(bits, ways):
+    """
+    Way to replace from tree pseudo-LRU bits,
+    node n of the tree is bits[n] (bit 0 is unused)
+    """
+    node = C(1, 1)
+    for _ in range(exact_log2(ways)):
+        node = Cat(bits.bit_select(node, 1), node)
+    return node[:exact_log2(ways)]
+    
+def plru_update(bits, way, ways):
+    """
+    Point the tree away from the accessed way
+    """
+    levels = exact_log2(ways)
+    
+    new = [bits[0]]
+    for n in range(1, ways):
+        level = n.bit_length() - 1
+        on_path = (way >> (levels - level)) == (n - (1 << level))
+        new.append(Mux(on_path, ~way[levels - 1 - level], bits[n]))
+    return Cat(*new)
+    
 class InstructionDebug(object):
     def __init__(self):
         self.ready = None
         self.state = None
-
+        
 class InstructionCache(wiring.Component):
-    def __init__(self):
+    """
+    Set associative instruction cache
+    
+    Lines are refilled from mem on a miss, the way to
+    replace is chosen with tree pseudo-LRU. Hits are acked
+    in the same cycle as the request.
+    
+    mem is either byte or word wide, with burst the line is
+    read as one incrementing burst. When pipelined a read
+    is issued every cycle mem doesn't stall.
+    """
+    def __init__(self, sets = 4, ways = 2, line_size = 16, mem_width = 8, burst = False, pipelined = False):
+        for name, value in (("sets", sets), ("ways", ways), ("line_size", line_size)):
+            if value < 1 or value & (value - 1):
+                raise ValueError("Cache {} must be a power of two, not {}".format(name, value))
+        if line_size < 4:
+            raise ValueError("Cache line must hold at least one word")
+        if mem_width not in (8, 32):
+            raise ValueError("Refill width must be 8 or 32, not {}".format(mem_width))
+        if burst and pipelined:
+            raise ValueError("Refill is either burst or pipelined, not both")
+            
+        self.sets = sets
+        self.ways = ways
+        self.line_size = line_size # bytes
+        
+        self.mem_width = mem_width
+        self.burst = burst
+        self.pipelined = pipelined
+        
         self.debug = InstructionDebug()
         
         super().__init__({
             "proc": In(Bus(32, 32)),
-            "mem": Out(Bus(32, 8))
+            "mem": Out(Bus(32, mem_width, burst = burst, pipelined = pipelined))
         })
         
     def elaborate(self, platform):
         m = Module()
         
-        cache_width = 4
+        line_words = self.line_size // 4
+        
+        word_bits = exact_log2(line_words)
+        set_bits = exact_log2(self.sets)
+        tag_bits = 32 - 2 - word_bits - set_bits
+        
+        # Split address into tag, set and word of line
+        word = self.proc.addr[2:2 + word_bits]
+        index = self.proc.addr[2 + word_bits:2 + word_bits + set_bits]
+        tag = self.proc.addr[2 + word_bits + set_bits:]
         
-        cache_address = Array([Signal(32, name = "a{}".format(i)) for i in range(cache_width)])
+        tags = [Array([Signal(tag_bits, name = "t{}_{}".format(w, s)) for s in range(self.sets)])
+                for w in range(self.ways)]
+        valid = [Array([Signal(name = "v{}_{}".format(w, s)) for s in range(self.sets)])
+                for w in range(self.ways)]
+                
+        plru = Array([Signal(self.ways, name = "lru{}".format(s)) for s in range(self.sets)])
         
-        cache_ready = Array([Signal(name = "r{}".format(i)) for i in range(cache_width)])
+        lru = Signal(self.ways)
+        m.d.comb += lru.eq(plru[index])
         
-        self.debug.ready = cache_ready
+        self.debug.ready = [v for way in valid for v in way]
         
-        cache = Array([Signal(32, name = "c{}".format(i)) for i in range(cache_width)])
+        # Lookup
+        hits = Signal(self.ways)
+        hit_way = Signal(range(self.ways))
         
-        read_pointer = Signal(range(cache_width))
-        write_pointer = Signal(range(cache_width))
+        for w in range(self.ways):
+            m.d.comb += hits[w].eq(valid[w][index] & (tags[w][index] == tag))
+            with m.If(hits[w]):
+                m.d.comb += hit_way.eq(w)
+                
+        data = m.submodules.data = memory.Memory(shape = 32, depth = self.sets * self.ways * line_words, init = [])
         
-        cache_hit = Signal()
+        read_port = data.read_port(domain = "comb")
+        write_port = data.write_port()
         
-        # Correct cache address is queued
-        m.d.comb += cache_hit.eq(
-                        (cache_address[read_pointer] == self.proc.addr) &
-                        (cache_ready[read_pointer])
-                    )
+        m.d.comb += read_port.addr.eq(Cat(word, index, hit_way))
+        m.d.comb += self.proc.r_data.eq(read_port.data)
         
-        address = Signal(32)
+        # Refill
+        refill_tag = Signal(tag_bits)
+        refill_index = Signal(set_bits)
+        refill_way = Signal(range(self.ways))
+        refill_word = Signal(word_bits)
+        refill_data = Signal(32)
         
         byte_counter = Signal(2, init = 0)
         
-        m.d.comb += self.proc.r_data.eq(cache[read_pointer])
-        m.d.comb += self.mem.addr.eq(address + byte_counter)
+        word_done = Signal()
+        line_done = Signal()
+        
+        m.d.comb += write_port.addr.eq(Cat(refill_word, refill_index, refill_way))
+        
+        # Reads issued ahead of acks when pipelined
+        beats = line_words * 4 * 8 // self.mem_width
+        issued = Signal(range(beats + 1))
         
-        #write_next = Signal(range(cache_width))
-        #m.d.comb += write_next.eq(write_pointer + 1)
+        if self.mem_width == 8:
+            # Words are read a byte at a time
+            if self.pipelined:
+                m.d.comb += self.mem.addr.eq(Cat(issued[0:2 + word_bits], refill_index, refill_tag))
+            else:
+                m.d.comb += self.mem.addr.eq(Cat(byte_counter, refill_word, refill_index, refill_tag))
+            m.d.comb += write_port.data.eq(Cat(refill_data[8:32], self.mem.r_data))
+            m.d.comb += word_done.eq(byte_counter == 3)
+        else:
+            if self.pipelined:
+                m.d.comb += self.mem.addr.eq(Cat(C(0, 2), issued[0:word_bits], refill_index, refill_tag))
+            else:
+                m.d.comb += self.mem.addr.eq(Cat(C(0, 2), refill_word, refill_index, refill_tag))
+            m.d.comb += write_port.data.eq(self.mem.r_data)
+            m.d.comb += word_done.eq(1)
+            
+        m.d.comb += line_done.eq(word_done & (refill_word == line_words - 1))
+        
+        if self.burst:
+            m.d.comb += self.mem.cti.eq(Mux(line_done, CycleType.END, CycleType.INCREMENT))
         
         with m.FSM() as fsm:
-            with m.State("Reset"):
-                # Clear cache
-                m.d.sync += read_pointer.eq(0)
-                m.d.sync += write_pointer.eq(0)
-                # Indicate first address we're loading
-                m.d.sync += cache_address[0].eq(address)
-                
-                for i in range(cache_width):
-                    m.d.sync += cache_ready[i].eq(0)
-                m.next = "Load"
-            with m.State("Load"):
-                # Load words into cache
-                with m.If(~cache_ready[write_pointer]):
-                    m.d.sync += cache_address[write_pointer].eq(address)
+            with m.State("Ready"):
+                with m.If(self.proc.stb & self.proc.cyc):
+                    with m.If(hits.any()):
+                        m.d.comb += self.proc.ack.eq(1)
+                        m.d.sync += plru[index].eq(plru_update(lru, hit_way, self.ways))
+                    with m.Else():
+                        # Cache miss, replace least recently used line
+                        m.d.sync += [
+                            refill_tag.eq(tag),
+                            refill_index.eq(index),
+                            refill_way.eq(plru_victim(lru, self.ways)),
+                            refill_word.eq(0),
+                            byte_counter.eq(0),
+                            issued.eq(0)
+                        ]
+                        m.next = "Refill"
+            with m.State("Refill"):
+                # Load words of line from memory
+                m.d.comb += self.mem.cyc.eq(1)
+                if self.pipelined:
+                    m.d.comb += self.mem.stb.eq(issued != beats)
+                    with m.If(self.mem.stb & ~self.mem.stall):
+                        m.d.sync += issued.eq(issued + 1)
+                else:
                     m.d.comb += self.mem.stb.eq(1)
-                    m.d.comb += self.mem.cyc.eq(1)
-                    with m.If(self.mem.ack):
-                        m.d.sync += cache[write_pointer].eq(
-                                                (cache[write_pointer] >> 8) + 
-                                                (self.mem.r_data << 24))
-                        with m.If(byte_counter == 3):
-                            # Finished reading word
-                            m.d.sync += byte_counter.eq(0)
-                            m.d.sync += write_pointer.eq(write_pointer + 1)
-                            m.d.sync += cache_ready[write_pointer].eq(1)
-                            m.d.sync += address.eq(address + 4) # ?
-                        with m.Else():
-                            # Next byte of word
-                            m.d.sync += byte_counter.eq(byte_counter + 1)
+                with m.If(self.mem.ack):
+                    m.d.sync += refill_data.eq(Cat(refill_data[8:32], self.mem.r_data))
+                    m.d.sync += byte_counter.eq(byte_counter + 1)
+                    with m.If(word_done):
+                        # Finished reading word
+                        m.d.comb += write_port.en.eq(1)
+                        m.d.sync += refill_word.eq(refill_word + 1)
+                        with m.If(line_done):
+                            # Line is ready
+                            for w in range(self.ways):
+                                with m.If(refill_way == w):
+                                    m.d.sync += tags[w][refill_index].eq(refill_tag)
+                                    m.d.sync += valid[w][refill_index].eq(1)
+                            m.next = "Ready"
+                            
+        self.debug.state = fsm.state
+        
+        return m
+        
+class DataDebug(object):
+    def __init__(self):
+        self.hits = None
+        self.misses = None
+        self.writebacks = None # Dirty lines written to mem
+        self.state = None
+        
+class DataCache(wiring.Component):
+    """
+    Set associative write back data cache
+    
+    Loads and stores that hit are acked in the same cycle.
+    A miss writes the replaced line back to mem if it is dirty,
+    then refills it (stores allocate a line too).
+    
+    proc and mem are each byte wide, or word wide with byte enables,
+    to go between RiscCore.bus and memory. Every access is cached,
+    so devices shouldn't be behind it.
+    
+    flush writes back every dirty line then invalidates the cache,
+    invalidate drops every line without writing back. busy is high
+    until a flush is finished.
+    """
+    def __init__(self, sets = 4, ways = 2, line_size = 16, data_width = 8, mem_width = 8):
+        for name, value in (("sets", sets), ("ways", ways), ("line_size", line_size)):
+            if value < 1 or value & (value - 1):
+                raise ValueError("Cache {} must be a power of two, not {}".format(name, value))
+        if line_size < 4:
+            raise ValueError("Cache line must hold at least one word")
+        for name, value in (("Data", data_width), ("Memory", mem_width)):
+            if value not in (8, 32):
+                raise ValueError("{} width must be 8 or 32, not {}".format(name, value))
                 
-                with m.If(self.proc.stb & self.proc.cyc & self.proc.ack):
-                    m.d.sync += read_pointer.eq(read_pointer + 1) # Next value
-                    m.d.sync += cache_ready[read_pointer].eq(0) # Clear ready flag
+        self.sets = sets
+        self.ways = ways
+        self.line_size = line_size # bytes
+        
+        self.data_width = data_width
+        self.mem_width = mem_width
+        
+        self.debug = DataDebug()
+        
+        super().__init__({
+            "proc": In(Bus(32, data_width, sel_shape = 4 if data_width == 32 else 0)),
+            "mem": Out(Bus(32, mem_width, sel_shape = 4 if mem_width == 32 else 0)),
+            "flush": In(1),
+            "invalidate": In(1),
+            "busy": Out(1)
+        })
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        line_words = self.line_size // 4
+        
+        word_bits = exact_log2(line_words)
+        set_bits = exact_log2(self.sets)
+        way_bits = exact_log2(self.ways)
+        tag_bits = 32 - 2 - word_bits - set_bits
+        
+        # Split address into tag, set and word of line
+        word = self.proc.addr[2:2 + word_bits]
+        index = self.proc.addr[2 + word_bits:2 + word_bits + set_bits]
+        tag = self.proc.addr[2 + word_bits + set_bits:]
+        
+        tags = [Array([Signal(tag_bits, name = "t{}_{}".format(w, s)) for s in range(self.sets)])
+                for w in range(self.ways)]
+        valid = [Array([Signal(name = "v{}_{}".format(w, s)) for s in range(self.sets)])
+                for w in range(self.ways)]
+        dirty = [Array([Signal(name = "d{}_{}".format(w, s)) for s in range(self.sets)])
+                for w in range(self.ways)]
                 
-                with m.If(self.proc.stb & self.proc.cyc):
-                    with m.If(cache_address[read_pointer] == self.proc.addr):
-                        # Wait for program to be loaded
-                        m.d.comb += self.proc.ack.eq(cache_ready[read_pointer])
-                    with m.Else():
-                        # Cache miss, set new address and clear cache
-                        m.d.sync += address.eq(self.proc.addr)
-                        m.next = "Reset"
+        plru = Array([Signal(self.ways, name = "lru{}".format(s)) for s in range(self.sets)])
+        
+        lru = Signal(self.ways)
+        m.d.comb += lru.eq(plru[index])
+        
+        # Lookup
+        hits = Signal(self.ways)
+        hit_way = Signal(range(self.ways))
+        
+        for w in range(self.ways):
+            m.d.comb += hits[w].eq(valid[w][index] & (tags[w][index] == tag))
+            with m.If(hits[w]):
+                m.d.comb += hit_way.eq(w)
+                
+        data = m.submodules.data = memory.Memory(shape = 32, depth = self.sets * self.ways * line_words, init = [])
+        
+        read_port = data.read_port(domain = "comb")
+        line_port = data.read_port(domain = "comb")
+        write_port = data.write_port(granularity = 8)
+        
+        m.d.comb += read_port.addr.eq(Cat(word, index, hit_way))
         
+        if self.data_width == 8:
+            # Byte lane of word
+            m.d.comb += self.proc.r_data.eq(read_port.data.word_select(self.proc.addr[0:2], 8))
+            proc_sel = (C(1, 4) << self.proc.addr[0:2])[0:4]
+            proc_data = Cat(*([self.proc.w_data] * 4))
+        else:
+            m.d.comb += self.proc.r_data.eq(read_port.data)
+            proc_sel = self.proc.sel
+            proc_data = self.proc.w_data
+            
+        # Line being written back or refilled
+        line_tag = Signal(tag_bits)
+        line_index = Signal(set_bits)
+        line_way = Signal(range(self.ways))
+        line_word = Signal(word_bits)
+        line_data = Signal(32)
+        
+        # Tag of the request that missed
+        refill_tag = Signal(tag_bits)
+        
+        byte_counter = Signal(2, init = 0)
+        
+        word_done = Signal()
+        line_done = Signal()
+        
+        m.d.comb += line_port.addr.eq(Cat(line_word, line_index, line_way))
+        
+        if self.mem_width == 8:
+            # Words are moved a byte at a time
+            m.d.comb += self.mem.addr.eq(Cat(byte_counter, line_word, line_index, line_tag))
+            m.d.comb += self.mem.w_data.eq(line_port.data.word_select(byte_counter, 8))
+            m.d.comb += word_done.eq(byte_counter == 3)
+            refill_word = Cat(line_data[8:32], self.mem.r_data)
+        else:
+            m.d.comb += self.mem.addr.eq(Cat(C(0, 2), line_word, line_index, line_tag))
+            m.d.comb += self.mem.w_data.eq(line_port.data)
+            m.d.comb += self.mem.sel.eq(0b1111)
+            m.d.comb += word_done.eq(1)
+            refill_word = self.mem.r_data
+            
+        m.d.comb += line_done.eq(word_done & (line_word == line_words - 1))
+        
+        # Line being flushed, set then way
+        flush_line = Signal(set_bits + way_bits)
+        flushing = Signal()
+        
+        hit_count = Signal(32)
+        miss_count = Signal(32)
+        writeback_count = Signal(32)
+        
+        # Access after a refill was counted as a miss
+        refilled = Signal()
+        
+        with m.FSM() as fsm:
+            with m.State("Ready"):
+                with m.If(self.flush):
+                    m.d.comb += self.busy.eq(1)
+                    m.d.sync += flush_line.eq(0)
+                    m.d.sync += flushing.eq(1)
+                    m.next = "Flush"
+                with m.Elif(self.invalidate):
+                    for w in range(self.ways):
+                        for s in range(self.sets):
+                            m.d.sync += valid[w][s].eq(0)
+                with m.Elif(self.proc.stb & self.proc.cyc):
+                    with m.If(hits.any()):
+                        m.d.comb += self.proc.ack.eq(1)
+                        m.d.sync += plru[index].eq(plru_update(lru, hit_way, self.ways))
+                        m.d.sync += refilled.eq(0)
+                        with m.If(~refilled):
+                            m.d.sync += hit_count.eq(hit_count + 1)
+                        with m.If(self.proc.w_en):
+                            m.d.comb += [
+                                write_port.addr.eq(Cat(word, index, hit_way)),
+                                write_port.data.eq(proc_data),
+                                write_port.en.eq(proc_sel)
+                            ]
+                            for w in range(self.ways):
+                                with m.If(hit_way == w):
+                                    m.d.sync += dirty[w][index].eq(1)
+                    with m.Else():
+                        # Cache miss, replace least recently used line
+                        victim = plru_victim(lru, self.ways)
+                        m.d.sync += [
+                            refill_tag.eq(tag),
+                            line_tag.eq(tag),
+                            line_index.eq(index),
+                            line_way.eq(victim),
+                            line_word.eq(0),
+                            byte_counter.eq(0),
+                            miss_count.eq(miss_count + 1)
+                        ]
+                        m.next = "Refill"
+                        for w in range(self.ways):
+                            with m.If((victim == w) & valid[w][index] & dirty[w][index]):
+                                # Write back before it is replaced
+                                m.d.sync += line_tag.eq(tags[w][index])
+                                m.next = "WriteBack"
+            with m.State("Flush"):
+                m.d.comb += self.busy.eq(1)
+                flush_index = flush_line[:set_bits]
+                flush_way = flush_line[set_bits:]
+                m.d.sync += [
+                    line_index.eq(flush_index),
+                    line_way.eq(flush_way),
+                    line_word.eq(0),
+                    byte_counter.eq(0)
+                ]
+                for w in range(self.ways):
+                    with m.If(flush_way == w):
+                        m.d.sync += line_tag.eq(tags[w][flush_index])
+                        with m.If(valid[w][flush_index] & dirty[w][flush_index]):
+                            m.next = "WriteBack"
+                        with m.Else():
+                            # Clean lines are dropped
+                            m.d.sync += valid[w][flush_index].eq(0)
+                            m.d.sync += flush_line.eq(flush_line + 1)
+                            with m.If(flush_line == self.sets * self.ways - 1):
+                                m.d.sync += flushing.eq(0)
+                                m.next = "Ready"
+            with m.State("WriteBack"):
+                # Store words of line to memory
+                m.d.comb += self.busy.eq(flushing)
+                m.d.comb += self.mem.stb.eq(1)
+                m.d.comb += self.mem.cyc.eq(1)
+                m.d.comb += self.mem.w_en.eq(1)
+                with m.If(self.mem.ack):
+                    m.d.sync += byte_counter.eq(byte_counter + 1)
+                    with m.If(word_done):
+                        m.d.sync += line_word.eq(line_word + 1)
+                        with m.If(line_done):
+                            for w in range(self.ways):
+                                with m.If(line_way == w):
+                                    m.d.sync += dirty[w][line_index].eq(0)
+                            m.d.sync += line_tag.eq(refill_tag)
+                            m.d.sync += writeback_count.eq(writeback_count + 1)
+                            with m.If(flushing):
+                                m.next = "Flush"
+                            with m.Else():
+                                m.next = "Refill"
+            with m.State("Refill"):
+                # Load words of line from memory
+                m.d.comb += self.mem.stb.eq(1)
+                m.d.comb += self.mem.cyc.eq(1)
+                m.d.comb += write_port.addr.eq(Cat(line_word, line_index, line_way))
+                m.d.comb += write_port.data.eq(refill_word)
+                with m.If(self.mem.ack):
+                    m.d.sync += line_data.eq(Cat(line_data[8:32], self.mem.r_data))
+                    m.d.sync += byte_counter.eq(byte_counter + 1)
+                    with m.If(word_done):
+                        # Finished reading word
+                        m.d.comb += write_port.en.eq(0b1111)
+                        m.d.sync += line_word.eq(line_word + 1)
+                        with m.If(line_done):
+                            # Line is ready
+                            for w in range(self.ways):
+                                with m.If(line_way == w):
+                                    m.d.sync += tags[w][line_index].eq(line_tag)
+                                    m.d.sync += valid[w][line_index].eq(1)
+                                    m.d.sync += dirty[w][line_index].eq(0)
+                            m.d.sync += refilled.eq(1)
+                            m.next = "Ready"
+                            
+        self.debug.hits = hit_count
+        self.debug.misses = miss_count
+        self.debug.writebacks = writeback_count
         self.debug.state = fsm.state
         
-        return m
\ No newline at end of file
+        return m
@@ -15,7 +15,7 @@ class DelegateRegister(enum.Enum):
     INTERRUPT_SIZE = 0x04
 
 class Delegate(wiring.Component):
-    def __init__(self, shape = 8, buffer_size = 16):
+    def __init__(self, shape = 8, buffer_size = 16, dest_shape = 1):
         self.buffer_size = buffer_size
         
         self.interrupt_msg = 0x01
@@ -24,7 +24,7 @@ class Delegate(wiring.Component):
         
         super().__init__({
             "bus": In(Bus(32, 8)),
-            "interrupt": Out(Bus(32, 8))
+            "interrupt": Out(Bus(32, 8, dest_shape = dest_shape))
         })
         
     def elaborate(self, platform):
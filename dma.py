@@ -0,0 +1,133 @@
+from amaranth import *
+from amaranth.lib import wiring, fifo
+from amaranth.lib.wiring import In, Out
+
+from signature import Bus
+from risc_core import Registers
+from delegate import DelegateRegister
+
+class DmaDebug(object):
+    def __init__(self):
+        self.busy = None
+        self.sent = None
+        
+class Dma(wiring.Component):
+    """
+    Sends a buffer from mem to a delegate without the core
+    
+    Registers are 32 bits at Registers * 4, written a byte at a
+    time. Writing the high byte of SEND_SIZE starts the transfer,
+    each byte of SEND_BUF is read from mem into a fifo of depth
+    bytes and written to WRITE_DATA of the delegate at SEND_DEST,
+    so reads run while earlier bytes are sent. When the last byte
+    is taken the done message is sent on interrupt. SEND_SIZE
+    reads back the bytes left to send with bit 31 set while busy,
+    writes to any register while busy are ignored.
+    """
+    def __init__(self, dest_shape = 1, depth = 4):
+        self.done_msg = 0x02
+        
+        self.depth = depth
+        
+        self.debug = DmaDebug()
+        
+        super().__init__({
+            "bus": In(Bus(32, 8)),
+            "mem": Out(Bus(32, 8)),
+            "send": Out(Bus(32, 8, dest_shape = dest_shape)),
+            "interrupt": Out(Bus(32, 8))
+        })
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        size = Signal(32)
+        dest = Signal(32)
+        buf = Signal(32)
+        
+        busy = Signal()
+        
+        # Bytes read from mem, waiting to be sent
+        queue = m.submodules.queue = fifo.SyncFIFO(width = 8, depth = self.depth)
+        
+        # Left to send, including the queue
+        left = Signal(32)
+        m.d.comb += left.eq(size + queue.level)
+        
+        registers = {
+            Registers.SEND_SIZE: (size, Cat(left[0:31], busy)),
+            Registers.SEND_DEST: (dest, dest),
+            Registers.SEND_BUF: (buf, buf)
+        }
+        
+        request = self.bus.cyc & self.bus.stb
+        index = self.bus.addr[2:]
+        lane = self.bus.addr[0:2]
+        
+        m.d.comb += self.bus.ack.eq(request)
+        
+        with m.Switch(index):
+            for register, (value, read) in registers.items():
+                with m.Case(register):
+                    m.d.comb += self.bus.r_data.eq(read.word_select(lane, 8))
+                    with m.If(request & self.bus.w_en & ~busy):
+                        m.d.sync += value.word_select(lane, 8).eq(self.bus.w_data)
+                        
+        # Stores write the low byte first, so the size is whole after the high byte
+        with m.If(request & self.bus.w_en & ~busy & (index == Registers.SEND_SIZE) & (lane == 3)):
+            m.d.sync += [
+                busy.eq(1),
+                self.interrupt.stb.eq(0),
+                self.interrupt.cyc.eq(0)
+            ]
+            
+        # Read ahead while there is room, a read only waits on its own ack
+        m.d.comb += [
+            self.mem.cyc.eq(busy & (size != 0) & queue.w_rdy),
+            self.mem.stb.eq(busy & (size != 0) & queue.w_rdy),
+            self.mem.addr.eq(buf),
+            queue.w_data.eq(self.mem.r_data),
+            queue.w_en.eq(self.mem.cyc & self.mem.ack)
+        ]
+        with m.If(self.mem.cyc & self.mem.ack):
+            m.d.sync += [
+                buf.eq(buf + 1),
+                size.eq(size - 1)
+            ]
+            
+        m.d.comb += [
+            self.send.cyc.eq(queue.r_rdy),
+            self.send.stb.eq(queue.r_rdy),
+            self.send.w_en.eq(1),
+            self.send.addr.eq(DelegateRegister.WRITE_DATA),
+            self.send.w_data.eq(queue.r_data),
+            self.send.dest.eq(dest),
+            queue.r_en.eq(self.send.ack)
+        ]
+        
+        # Done once the last byte is in the delegate
+        with m.If(busy & (size == 0) & ~queue.r_rdy):
+            m.d.sync += [
+                busy.eq(0),
+                self.interrupt.stb.eq(1),
+                self.interrupt.cyc.eq(1)
+            ]
+        with m.If(self.interrupt.ack):
+            m.d.sync += [
+                self.interrupt.stb.eq(0),
+                self.interrupt.cyc.eq(0)
+            ]
+            
+        m.d.comb += [
+            self.interrupt.w_en.eq(1),
+            self.interrupt.w_data.eq(self.done_msg)
+        ]
+        
+        sent = Signal(32)
+        with m.If(queue.r_rdy & self.send.ack):
+            m.d.sync += sent.eq(sent + 1)
+            
+        self.debug.busy = busy
+        self.debug.sent = sent
+        
+        return m
@@ -0,0 +1,561 @@
+"""
+Instruction level model of the RV32I core
+
+Runs programs far faster than simulating RiscCore, and can be
+run in lockstep with the core to check it
+"""
+import sys
+
+from risc_core import Instruction, Csr, SystemFunction, INTERRUPT_CAUSE
+from atomic import AtomicFunction
+
+MASK = 0xFFFFFFFF
+
+def signed(value):
+    if value & 0x80000000:
+        return value - (1 << 32)
+    return value
+    
+def sign_extend(value, bits):
+    if value & (1 << (bits - 1)):
+        return value - (1 << bits)
+    return value
+    
+def divide(a, b):
+    """
+    Signed division rounding towards zero,
+    divide by zero gives all ones and overflow gives the dividend
+    """
+    if b == 0:
+        return MASK
+    a, b = signed(a), signed(b)
+    quotient = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        return -quotient
+    return quotient
+    
+def remainder(a, b):
+    """
+    Signed remainder with the sign of the dividend
+    """
+    if b == 0:
+        return a
+    a, b = signed(a), signed(b)
+    value = abs(a) % abs(b)
+    if a < 0:
+        return -value
+    return value
+    
+class Halt(Exception):
+    """
+    Raised by ECALL/EBREAK to stop the emulator
+    """
+    pass
+    
+def lanes(function, a, b = 0):
+    """
+    Apply function to each byte of a and b
+    """
+    return sum(function((a >> s) & 0xFF, (b >> s) & 0xFF) << s for s in (0, 8, 16, 24))
+    
+class CounterRead(Exception):
+    """
+    Raised by counter reads, run knows how many
+    instructions have retired and writes rd
+    """
+    def __init__(self, rd, csr):
+        self.rd = rd
+        self.csr = csr
+        
+class IllegalInstruction(Exception):
+    def __init__(self, word, pc):
+        super().__init__("Illegal instruction 0x{:08X} at 0x{:08X}".format(word, pc))
+        self.word = word
+        self.pc = pc
+        
+class Emulator(object):
+    """
+    RV32I emulator
+    
+    Registers are kept as unsigned 32 bit ints, memory is a
+    bytearray starting at address 0. Decoded instructions are
+    cached by instruction word, so each word is only decoded once.
+    """
+    def __init__(self, memory_size = 1 << 16, program = [], hardwire_zero = True, muldiv = False,
+                 counters = False, simd = False, interrupts = False, atomics = False):
+        if sys.byteorder != "little":
+            raise Exception("Emulator memory views need a little endian host")
+            
+        self.memory = bytearray(memory_size)
+        
+        # Aligned views of memory
+        self.halves = memoryview(self.memory).cast("H")
+        self.words = memoryview(self.memory).cast("I")
+        
+        # Writes to x0 go to a spare register when it's hardwired
+        self.hardwire_zero = hardwire_zero
+        self.regs = [0] * 33
+        
+        # RV32M instructions
+        self.muldiv = muldiv
+        # Zicsr counter reads
+        self.counters = counters
+        # Packed pixel instructions
+        self.simd = simd
+        # Trap registers, mret and wfi
+        self.interrupts = interrupts
+        self.csrs = {csr: 0 for csr in (Csr.MSTATUS, Csr.MTVEC, Csr.MEPC, Csr.MCAUSE, Csr.INT_DATA)}
+        # RV32A, word reserved by LR. The only master, so SC fails only on another word
+        self.atomics = atomics
+        self.reservation = None
+        
+        self.pc = 0
+        self.retired = 0
+        
+        self.decode_cache = dict()
+        
+        self.load(program)
+        
+    def load(self, program, address = 0):
+        """
+        Load list of instruction words into memory
+        """
+        for word in program:
+            self.store_word(address, word)
+            address += 4
+            
+    def reg(self, index):
+        return self.regs[index]
+        
+    def load_byte(self, addr):
+        return self.memory[addr]
+        
+    def load_half(self, addr):
+        if addr & 1:
+            return self.memory[addr] | (self.memory[addr + 1] << 8)
+        return self.halves[addr >> 1]
+        
+    def load_word(self, addr):
+        if addr & 3:
+            return int.from_bytes(self.memory[addr:addr + 4], "little")
+        return self.words[addr >> 2]
+        
+    def store_byte(self, addr, value):
+        self.memory[addr] = value & 0xFF
+        
+    def store_half(self, addr, value):
+        self.memory[addr:addr + 2] = (value & 0xFFFF).to_bytes(2, "little")
+        
+    def store_word(self, addr, value):
+        self.memory[addr:addr + 4] = (value & MASK).to_bytes(4, "little")
+        
+    def step(self):
+        self.run(1)
+        
+    def interrupt(self, data = 0):
+        """
+        Take an interrupt before the instruction at pc
+        """
+        csrs = self.csrs
+        status = csrs[Csr.MSTATUS]
+        csrs[Csr.MSTATUS] = (status & ~0x88) | ((status & 0x8) << 4)
+        csrs[Csr.MEPC] = self.pc
+        csrs[Csr.MCAUSE] = INTERRUPT_CAUSE
+        csrs[Csr.INT_DATA] = data & 0xFF
+        self.pc = csrs[Csr.MTVEC]
+        
+    def run(self, count):
+        """
+        Run count instructions, stops early on ECALL/EBREAK
+        """
+        regs = self.regs
+        words = self.words
+        cache = self.decode_cache
+        decode = self.decode
+        
+        pc = self.pc
+        n = 0
+        try:
+            while n < count:
+                word = words[pc >> 2]
+                op = cache.get(word)
+                if op is None:
+                    op = cache[word] = decode(word)
+                try:
+                    pc = op(pc)
+                except CounterRead as read:
+                    regs[read.rd] = self.counter(read.csr, self.retired + n)
+                    pc += 4
+                n += 1
+        except Halt:
+            pass
+        finally:
+            self.pc = pc
+            self.retired += n
+            
+        return n
+        
+    def counter(self, csr, instret):
+        """
+        Value of counter, every instruction takes one cycle
+        and nothing stalls
+        """
+        cycle = instret
+        value = {
+            Csr.CYCLE: cycle,
+            Csr.TIME: cycle,
+            Csr.INSTRET: instret,
+            Csr.CYCLEH: cycle >> 32,
+            Csr.TIMEH: cycle >> 32,
+            Csr.INSTRETH: instret >> 32,
+            Csr.FETCH_STALL: 0,
+            Csr.MEMORY_STALL: 0
+        }[csr]
+        return value & MASK
+        
+    def decode(self, word):
+        """
+        Make function that executes the instruction at pc
+        and returns the next pc
+        """
+        regs = self.regs
+        
+        op = word & 0x7F
+        rd = (word >> 7) & 0x1F
+        f = (word >> 12) & 0x7
+        rs1 = (word >> 15) & 0x1F
+        rs2 = (word >> 20) & 0x1F
+        f_upper = word >> 25
+        
+        if rd == 0 and self.hardwire_zero:
+            rd = 32
+            
+        imm_i = sign_extend(word >> 20, 12)
+        imm_s = sign_extend(((word >> 25) << 5) | ((word >> 7) & 0x1F), 12)
+        imm_b = sign_extend(
+            (((word >> 31) & 0x1) << 12) |
+            (((word >> 7)  & 0x1) << 11) |
+            (((word >> 25) & 0x3F) << 5) |
+            (((word >> 8)  & 0xF) << 1), 13)
+        imm_u = word & 0xFFFFF000
+        imm_j = sign_extend(
+            (((word >> 31) & 0x1) << 20) |
+            (((word >> 12) & 0xFF) << 12) |
+            (((word >> 20) & 0x1) << 11) |
+            (((word >> 21) & 0x3FF) << 1), 21)
+            
+        def illegal(pc):
+            raise IllegalInstruction(word, pc)
+            
+        if op == Instruction.LUI.value:
+            def lui(pc):
+                regs[rd] = imm_u
+                return pc + 4
+            return lui
+            
+        if op == Instruction.AUIPC.value:
+            def auipc(pc):
+                regs[rd] = (pc + imm_u) & MASK
+                return pc + 4
+            return auipc
+            
+        if op == Instruction.JAL.value:
+            def jal(pc):
+                regs[rd] = pc + 4
+                return (pc + imm_j) & MASK
+            return jal
+            
+        if op == Instruction.JALR.value:
+            def jalr(pc):
+                target = (regs[rs1] + imm_i) & MASK & ~1
+                regs[rd] = pc + 4
+                return target
+            return jalr
+            
+        if op == Instruction.BRANCH.value:
+            taken = {
+                0b000: lambda a, b: a == b,
+                0b001: lambda a, b: a != b,
+                0b100: lambda a, b: signed(a) < signed(b),
+                0b101: lambda a, b: signed(a) >= signed(b),
+                0b110: lambda a, b: a < b,
+                0b111: lambda a, b: a >= b
+            }.get(f)
+            if taken is None:
+                return illegal
+            if f == 0b000:
+                def beq(pc):
+                    if regs[rs1] == regs[rs2]:
+                        return (pc + imm_b) & MASK
+                    return pc + 4
+                return beq
+            if f == 0b001:
+                def bne(pc):
+                    if regs[rs1] != regs[rs2]:
+                        return (pc + imm_b) & MASK
+                    return pc + 4
+                return bne
+            def branch(pc):
+                if taken(regs[rs1], regs[rs2]):
+                    return (pc + imm_b) & MASK
+                return pc + 4
+            return branch
+            
+        if op == Instruction.MEMORYLOAD.value:
+            load, extend = {
+                0b000: (self.load_byte, 8),
+                0b001: (self.load_half, 16),
+                0b010: (self.load_word, 0),
+                0b100: (self.load_byte, 0),
+                0b101: (self.load_half, 0)
+            }.get(f, (None, 0))
+            if load is None:
+                return illegal
+            if extend:
+                def load_signed(pc):
+                    regs[rd] = sign_extend(load((regs[rs1] + imm_i) & MASK), extend) & MASK
+                    return pc + 4
+                return load_signed
+            def load_unsigned(pc):
+                regs[rd] = load((regs[rs1] + imm_i) & MASK)
+                return pc + 4
+            return load_unsigned
+            
+        if op == Instruction.MEMORYSTORE.value:
+            store = {
+                0b000: self.store_byte,
+                0b001: self.store_half,
+                0b010: self.store_word
+            }.get(f)
+            if store is None:
+                return illegal
+            def store_op(pc):
+                store((regs[rs1] + imm_s) & MASK, regs[rs2])
+                return pc + 4
+            return store_op
+            
+        if op == Instruction.AMO.value:
+            function = f_upper >> 2
+            if not self.atomics or f != 0b010:
+                return illegal
+            if function == AtomicFunction.LR.value:
+                def lr(pc):
+                    regs[rd] = self.load_word(regs[rs1])
+                    self.reservation = regs[rs1] >> 2
+                    return pc + 4
+                return lr
+            if function == AtomicFunction.SC.value:
+                def sc(pc):
+                    if self.reservation == regs[rs1] >> 2:
+                        self.store_word(regs[rs1], regs[rs2])
+                        regs[rd] = 0
+                    else:
+                        regs[rd] = 1
+                    self.reservation = None
+                    return pc + 4
+                return sc
+            operation = {
+                AtomicFunction.ADD.value: lambda a, b: a + b,
+                AtomicFunction.SWAP.value: lambda a, b: b,
+                AtomicFunction.XOR.value: lambda a, b: a ^ b,
+                AtomicFunction.OR.value: lambda a, b: a | b,
+                AtomicFunction.AND.value: lambda a, b: a & b,
+                AtomicFunction.MIN.value: lambda a, b: a if signed(a) < signed(b) else b,
+                AtomicFunction.MAX.value: lambda a, b: b if signed(a) < signed(b) else a,
+                AtomicFunction.MINU.value: lambda a, b: a if a < b else b,
+                AtomicFunction.MAXU.value: lambda a, b: b if a < b else a
+            }.get(function)
+            if operation is None:
+                return illegal
+            def amo(pc):
+                address = regs[rs1]
+                old = self.load_word(address)
+                self.store_word(address, operation(old, regs[rs2]) & MASK)
+                regs[rd] = old
+                return pc + 4
+            return amo
+            
+        if op == Instruction.ARITHIMM.value:
+            imm = imm_i & MASK
+            shamt = rs2
+            if f == 0b001 and f_upper == 0:
+                operation = lambda a: a << shamt
+            elif f == 0b101 and f_upper == 0:
+                operation = lambda a: a >> shamt
+            elif f == 0b101 and f_upper == 0b0100000:
+                operation = lambda a: signed(a) >> shamt
+            elif f in (0b001, 0b101):
+                return illegal
+            else:
+                operation = {
+                    0b000: lambda a: a + imm,
+                    0b010: lambda a: int(signed(a) < imm_i),
+                    0b011: lambda a: int(a < imm),
+                    0b100: lambda a: a ^ imm,
+                    0b110: lambda a: a | imm,
+                    0b111: lambda a: a & imm
+                }[f]
+            if f == 0b000:
+                # Most common instruction
+                def addi(pc):
+                    regs[rd] = (regs[rs1] + imm) & MASK
+                    return pc + 4
+                return addi
+            def arith_imm(pc):
+                regs[rd] = operation(regs[rs1]) & MASK
+                return pc + 4
+            return arith_imm
+            
+        if op == Instruction.ARITH.value:
+            operation = {
+                (0b000, 0b0000000): lambda a, b: a + b,
+                (0b000, 0b0100000): lambda a, b: a - b,
+                (0b001, 0b0000000): lambda a, b: a << (b & 0x1F),
+                (0b010, 0b0000000): lambda a, b: int(signed(a) < signed(b)),
+                (0b011, 0b0000000): lambda a, b: int(a < b),
+                (0b100, 0b0000000): lambda a, b: a ^ b,
+                (0b101, 0b0000000): lambda a, b: a >> (b & 0x1F),
+                (0b101, 0b0100000): lambda a, b: signed(a) >> (b & 0x1F),
+                (0b110, 0b0000000): lambda a, b: a | b,
+                (0b111, 0b0000000): lambda a, b: a & b
+            }
+            if self.muldiv:
+                operation.update({
+                    (0b000, 0b0000001): lambda a, b: a * b,
+                    (0b001, 0b0000001): lambda a, b: (signed(a) * signed(b)) >> 32,
+                    (0b010, 0b0000001): lambda a, b: (signed(a) * b) >> 32,
+                    (0b011, 0b0000001): lambda a, b: (a * b) >> 32,
+                    (0b100, 0b0000001): divide,
+                    (0b101, 0b0000001): lambda a, b: a // b if b else MASK,
+                    (0b110, 0b0000001): remainder,
+                    (0b111, 0b0000001): lambda a, b: a % b if b else a
+                })
+            operation = operation.get((f, f_upper))
+            if operation is None:
+                return illegal
+            def arith(pc):
+                regs[rd] = operation(regs[rs1], regs[rs2]) & MASK
+                return pc + 4
+            return arith
+            
+        if op == Instruction.CUSTOM0.value and self.simd:
+            function = {
+                0b000: lambda x, y: min(x + y, 0xFF),
+                0b001: lambda x, y: max(x - y, 0),
+                0b010: lambda x, y: (x + y) >> 1,
+                0b011: min,
+                0b100: max
+            }.get(f)
+            if function is None or f_upper != 0:
+                return illegal
+            def packed(pc):
+                regs[rd] = lanes(function, regs[rs1], regs[rs2])
+                return pc + 4
+            return packed
+            
+        if op == Instruction.CUSTOM1.value and self.simd:
+            if f != 0:
+                return illegal
+            k = (word >> 20) & 0xFF
+            shift = (word >> 28) & 0xF
+            def scale(pc):
+                regs[rd] = lanes(lambda x, y: min((x * k) >> shift, 0xFF), regs[rs1])
+                return pc + 4
+            return scale
+            
+        if op == Instruction.FENCE.value:
+            def fence(pc):
+                return pc + 4
+            return fence
+            
+        if op == Instruction.E.value:
+            csrs = self.csrs
+            if f == 0b000:
+                if self.interrupts and (word >> 20) == SystemFunction.MRET.value:
+                    def mret(pc):
+                        status = csrs[Csr.MSTATUS]
+                        csrs[Csr.MSTATUS] = (status & ~0x8) | ((status >> 4) & 0x8) | 0x80
+                        return csrs[Csr.MEPC]
+                    return mret
+                if self.interrupts and (word >> 20) == SystemFunction.WFI.value:
+                    # Interrupts are given by interrupt, nothing to wait for
+                    def wfi(pc):
+                        return pc + 4
+                    return wfi
+                # ECALL and EBREAK
+                def halt(pc):
+                    raise Halt()
+                return halt
+            try:
+                csr = Csr(word >> 20)
+            except ValueError:
+                return illegal
+            if self.interrupts and csr in csrs:
+                # CSRRS and CSRRC with x0 write back the same value
+                operation = {
+                    0b01: lambda old, source: source,
+                    0b10: lambda old, source: old | source,
+                    0b11: lambda old, source: old & ~source
+                }.get(f & 0b011)
+                if operation is None:
+                    return illegal
+                def csr_op(pc):
+                    old = csrs[csr]
+                    source = rs1 if f & 0b100 else regs[rs1]
+                    if csr != Csr.INT_DATA:
+                        csrs[csr] = operation(old, source) & MASK
+                    regs[rd] = old
+                    return pc + 4
+                return csr_op
+            if not self.counters or csr in csrs or f == 0b100:
+                return illegal
+            # Counters are read only, like the core every
+            # Zicsr function reads and the write is ignored
+            def read_counter(pc):
+                raise CounterRead(rd, csr)
+            return read_counter
+            
+        return illegal
+        
+async def lockstep(ctx, core, emulator, count, timeout = 1000):
+    """
+    Testbench that checks core against emulator,
+    registers and pc are compared after each retired instruction
+    """
+    def trap():
+        # Emulator takes the same interrupt as the core
+        if core.debug.trap is not None and ctx.get(core.debug.trap):
+            emulator.interrupt(ctx.get(core.debug.trap_registers[Csr.INT_DATA]))
+            
+    while count > 0:
+        cycles = 0
+        while not ctx.get(core.debug.retire):
+            trap()
+            await ctx.tick()
+            cycles += 1
+            if cycles == timeout:
+                raise Exception("Timed out waiting for core to retire")
+                
+        pc = ctx.get(core.debug.pc)
+        assert pc == emulator.pc, \
+            "Core at 0x{:08X}, emulator at 0x{:08X}".format(pc, emulator.pc)
+            
+        word = emulator.load_word(pc)
+        
+        emulator.step()
+        trap()
+        await ctx.tick()
+        
+        if word & 0x7F == Instruction.E.value and (word >> 12) & 0x7 and \
+                (word >> 20) not in [Csr.INSTRET.value, Csr.INSTRETH.value] + [csr.value for csr in emulator.csrs]:
+            # Cycle counts depend on timing, take the value from the core
+            rd = (word >> 7) & 0x1F
+            emulator.regs[rd] = ctx.get(core.debug.reg[rd]) & MASK
+            
+        for i in range(32):
+            value = ctx.get(core.debug.reg[i]) & MASK
+            assert value == emulator.reg(i), \
+                "x{} is 0x{:08X}, emulator has 0x{:08X} after 0x{:08X}".format(
+                    i, value, emulator.reg(i), pc)
+                    
+        count -= 1
@@ -11,13 +11,16 @@ class DisplayRegister(enum.Enum):
     FILLB = 3
 
 class FrameBuffer(wiring.Component):
-    def __init__(self, shape = 24, width = 32, height = 32):
+    def __init__(self, shape = 24, width = 32, height = 32, pipelined = False):
         self.width = width
         self.height = height
         
+        # ram is Wishbone pipelined, pixels stream at a byte per cycle
+        self.pipelined = pipelined
+        
         super().__init__({
             "consume": In(Bus(32, 8)),
-            "ram": Out(Bus(32, 8)),
+            "ram": Out(Bus(32, 8, pipelined = pipelined)),
             "produce": Out(Stream(shape))
         })
         
@@ -33,25 +36,50 @@ class FrameBuffer(wiring.Component):
         
         pixel = Signal(24)
         
-        m.d.sync += self.produce.tdata.eq(pixel)
         m.d.sync += self.produce.tuser.eq(col_counter == self.width - 1)
         m.d.sync += self.produce.tlast.eq(address_counter >= (num_pixels*3) - 1)
         
+        # Reads issued ahead of acks when pipelined
+        request_counter = Signal(range(num_pixels*3))
+        pending = Signal(range(num_pixels*3 + 1))
+        
+        # Access has been taken by ram, waiting for ack
+        issued = Signal()
+        
         with m.FSM():
             with m.State("Stream"):
-                with m.If(self.consume.cyc):
-                    m.next = "Access"
-                
-                m.d.comb += self.ram.addr.eq(address_counter)
                 # Stream out data
                 m.d.comb += self.ram.cyc.eq(1)
-                m.d.comb += self.ram.stb.eq(self.produce.tready)
                 m.d.comb += self.ram.w_en.eq(0)
                 
+                if self.pipelined:
+                    # Stop issuing for an access, switch once every read is back
+                    with m.If(self.consume.cyc & (pending == 0)):
+                        m.next = "Access"
+                        
+                    m.d.comb += self.ram.addr.eq(request_counter)
+                    m.d.comb += self.ram.stb.eq(self.produce.tready & ~self.consume.cyc)
+                    
+                    accept = self.ram.stb & ~self.ram.stall
+                    with m.If(accept):
+                        with m.If(request_counter == num_pixels*3 - 1):
+                            m.d.sync += request_counter.eq(0)
+                        with m.Else():
+                            m.d.sync += request_counter.eq(request_counter + 1)
+                    m.d.sync += pending.eq(pending + accept - self.ram.ack)
+                else:
+                    with m.If(self.consume.cyc):
+                        m.next = "Access"
+                        
+                    m.d.comb += self.ram.addr.eq(address_counter)
+                    m.d.comb += self.ram.stb.eq(self.produce.tready)
+                
                 m.d.sync += self.produce.tvalid.eq((self.ram.ack) & (color_counter == 2))
                 
                 with m.If(self.ram.ack):
                     m.d.sync += pixel.eq((pixel << 8) + self.ram.r_data)
+                    # Include the byte just read
+                    m.d.sync += self.produce.tdata.eq((pixel << 8) + self.ram.r_data)
                     m.d.sync += address_counter.eq(address_counter + 1)
                     with m.If(color_counter == 2):
                         m.d.sync += color_counter.eq(0)
@@ -67,7 +95,6 @@ class FrameBuffer(wiring.Component):
                 
             with m.State("Access"):
                 m.d.comb += [
-                    self.ram.stb.eq(self.consume.stb),
                     self.ram.cyc.eq(self.consume.cyc),
                     self.consume.ack.eq(self.ram.ack),
                     self.ram.addr.eq(self.consume.addr),
@@ -75,6 +102,15 @@ class FrameBuffer(wiring.Component):
                     self.ram.w_data.eq(self.consume.w_data),
                     self.consume.r_data.eq(self.ram.r_data)
                 ]
+                if self.pipelined:
+                    # consume holds stb until ack, ram takes it once
+                    m.d.comb += self.ram.stb.eq(self.consume.stb & ~issued)
+                    with m.If(self.ram.stb & ~self.ram.stall):
+                        m.d.sync += issued.eq(1)
+                    with m.If(self.ram.ack):
+                        m.d.sync += issued.eq(0)
+                else:
+                    m.d.comb += self.ram.stb.eq(self.consume.stb)
                 with m.If(~self.consume.cyc):
                     m.next = "Stream"
         
@@ -0,0 +1,204 @@
+"""
+Inboxes for every core, any core can send to any other
+"""
+from amaranth import *
+from amaranth.lib import wiring, fifo, enum
+from amaranth.lib.wiring import In, Out
+
+from signature import Bus
+
+class MailboxRegister(enum.Enum):
+    SEND_DEST = 0x00
+    SEND_DATA = 0x01
+    READ_DATA = 0x02
+    READ_SOURCE = 0x03 # Source of the message at READ_DATA
+    LEVEL = 0x04
+    CREDITS = 0x05 # Messages that can be sent to SEND_DEST
+    INTERRUPT_SIZE = 0x06
+    
+class MailboxDebug(object):
+    def __init__(self):
+        self.sent = None # Messages sent by each core
+        self.received = None # Messages read by each core
+        self.stall = None # Cycles each core waited to send
+        
+class Mailbox(wiring.Component):
+    """
+    An inbox for each of n cores on c_XX, each holding a
+    message and its source
+    
+    Each source has credits messages in every inbox. A send
+    uses one of its credits for that inbox and it comes back
+    when the message is read, so a full source only waits on
+    its own bus and the others can still send. Sends to the
+    same inbox are taken round robin, one each cycle.
+    
+    When a message arrives with LEVEL equal to INTERRUPT_SIZE
+    the core is sent the interrupt message on i_XX.
+    """
+    def __init__(self, n = 2, credits = 4, shape = 8):
+        if n < 1:
+            raise ValueError("Need at least one inbox")
+        if credits < 1:
+            raise ValueError("Each source needs a credit")
+            
+        self.n = n
+        self.credits = credits
+        self.shape = shape
+        
+        self.source_shape = max((n - 1).bit_length(), 1)
+        self.depth = n * credits
+        
+        self.interrupt_msg = 0x03
+        
+        self.debug = MailboxDebug()
+        
+        ports = dict()
+        for i in range(n):
+            ports["c_{:02X}".format(i)] = In(Bus(32, 8))
+            ports["i_{:02X}".format(i)] = Out(Bus(32, 8))
+            
+        super().__init__(ports)
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        n = self.n
+        
+        buses = [getattr(self, "c_{:02X}".format(i)) for i in range(n)]
+        interrupts = [getattr(self, "i_{:02X}".format(i)) for i in range(n)]
+        
+        inboxes = list()
+        for i in range(n):
+            inboxes.append(fifo.SyncFIFO(width = self.shape + self.source_shape, depth = self.depth))
+            m.submodules["inbox{}".format(i)] = inboxes[i]
+            
+        dest = [Signal(8, name = "dest_{}".format(i)) for i in range(n)]
+        
+        # Credits of source s in inbox d
+        credits = [[Signal(range(self.credits + 1), init = self.credits, name = "credits_{}_{}".format(s, d))
+                    for d in range(n)] for s in range(n)]
+                    
+        # Source s has a message for inbox d
+        request = [[Signal(name = "request_{}_{}".format(s, d)) for d in range(n)] for s in range(n)]
+        grant = [[Signal(name = "grant_{}_{}".format(s, d)) for d in range(n)] for s in range(n)]
+        
+        # Credit returned to source s by inbox d
+        give = [[Signal(name = "give_{}_{}".format(s, d)) for d in range(n)] for s in range(n)]
+        
+        sending = [Signal(name = "sending_{}".format(i)) for i in range(n)]
+        
+        for s in range(n):
+            bus = buses[s]
+            
+            m.d.comb += sending[s].eq(bus.cyc & bus.stb & bus.w_en & (bus.addr == MailboxRegister.SEND_DATA))
+            for d in range(n):
+                m.d.comb += request[s][d].eq(sending[s] & (dest[s] == d) & (credits[s][d] != 0))
+                m.d.sync += credits[s][d].eq(credits[s][d] - grant[s][d] + give[s][d])
+                
+        for d in range(n):
+            inbox = inboxes[d]
+            last = Signal(range(n), name = "last_{}".format(d))
+            
+            # Round robin from the source after the last one taken
+            with m.Switch(last):
+                for l in range(n):
+                    with m.Case(l):
+                        for k in range(n):
+                            s = (l + 1 + k) % n
+                            with (m.If if k == 0 else m.Elif)(request[s][d]):
+                                m.d.comb += grant[s][d].eq(1)
+                                m.d.comb += inbox.w_data.eq(Cat(buses[s].w_data[0:self.shape], C(s, self.source_shape)))
+                                m.d.sync += last.eq(s)
+                                
+            # Credits keep the inbox from filling
+            m.d.comb += inbox.w_en.eq(Cat(grant[s][d] for s in range(n)).any())
+            
+        for i in range(n):
+            bus = buses[i]
+            inbox = inboxes[i]
+            interrupt = interrupts[i]
+            
+            request_i = bus.cyc & bus.stb
+            source = inbox.r_data[self.shape:]
+            
+            interrupt_size = Signal(range(self.depth + 1), name = "interrupt_size_{}".format(i))
+            
+            m.d.comb += interrupt.w_data.eq(self.interrupt_msg)
+            m.d.comb += interrupt.w_en.eq(1)
+            
+            with m.If(inbox.w_en & (inbox.level == interrupt_size)):
+                m.d.sync += interrupt.stb.eq(1)
+                m.d.sync += interrupt.cyc.eq(1)
+            with m.If(interrupt.ack):
+                m.d.sync += interrupt.stb.eq(0)
+                m.d.sync += interrupt.cyc.eq(0)
+                
+            with m.If(bus.w_en):
+                with m.Switch(bus.addr):
+                    with m.Case(MailboxRegister.SEND_DEST):
+                        m.d.comb += bus.ack.eq(request_i)
+                        with m.If(request_i):
+                            m.d.sync += dest[i].eq(bus.w_data)
+                    with m.Case(MailboxRegister.SEND_DATA):
+                        # Wait for a credit and the inbox, no inbox drops the message
+                        with m.If(dest[i] < n):
+                            m.d.comb += bus.ack.eq(Cat(grant[i][d] for d in range(n)).any())
+                        with m.Else():
+                            m.d.comb += bus.ack.eq(request_i)
+                    with m.Case(MailboxRegister.INTERRUPT_SIZE):
+                        m.d.comb += bus.ack.eq(request_i)
+                        with m.If(request_i):
+                            m.d.sync += interrupt_size.eq(bus.w_data)
+                    with m.Default():
+                        # Invalid write
+                        m.d.comb += bus.ack.eq(request_i)
+            with m.Else():
+                with m.Switch(bus.addr):
+                    with m.Case(MailboxRegister.READ_DATA):
+                        # Reading takes the message and gives back its credit
+                        m.d.comb += bus.r_data.eq(inbox.r_data[0:self.shape])
+                        m.d.comb += bus.ack.eq(inbox.r_rdy & request_i)
+                        m.d.comb += inbox.r_en.eq(request_i)
+                        with m.If(inbox.r_rdy & request_i):
+                            with m.Switch(source):
+                                for s in range(n):
+                                    with m.Case(s):
+                                        m.d.comb += give[s][i].eq(1)
+                    with m.Case(MailboxRegister.READ_SOURCE):
+                        m.d.comb += bus.r_data.eq(source)
+                        m.d.comb += bus.ack.eq(inbox.r_rdy & request_i)
+                    with m.Case(MailboxRegister.LEVEL):
+                        m.d.comb += bus.r_data.eq(inbox.level)
+                        m.d.comb += bus.ack.eq(request_i)
+                    with m.Case(MailboxRegister.CREDITS):
+                        m.d.comb += bus.r_data.eq(Array(credits[i])[dest[i]])
+                        m.d.comb += bus.ack.eq(request_i)
+                    with m.Case(MailboxRegister.SEND_DEST):
+                        m.d.comb += bus.r_data.eq(dest[i])
+                        m.d.comb += bus.ack.eq(request_i)
+                    with m.Case(MailboxRegister.INTERRUPT_SIZE):
+                        m.d.comb += bus.r_data.eq(interrupt_size)
+                        m.d.comb += bus.ack.eq(request_i)
+                    with m.Default():
+                        # Nothing to read
+                        m.d.comb += bus.ack.eq(request_i)
+                        
+        sent = [Signal(32, name = "sent_{}".format(i)) for i in range(n)]
+        received = [Signal(32, name = "received_{}".format(i)) for i in range(n)]
+        stall = [Signal(32, name = "stall_{}".format(i)) for i in range(n)]
+        
+        for i in range(n):
+            with m.If(Cat(grant[i][d] for d in range(n)).any()):
+                m.d.sync += sent[i].eq(sent[i] + 1)
+            with m.If(Cat(give[s][i] for s in range(n)).any()):
+                m.d.sync += received[i].eq(received[i] + 1)
+            with m.If(sending[i] & ~buses[i].ack):
+                m.d.sync += stall[i].eq(stall[i] + 1)
+                
+        self.debug.sent = sent
+        self.debug.received = received
+        self.debug.stall = stall
+        self.levels = [inbox.level for inbox in inboxes]
+        
+        return m
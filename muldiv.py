@@ -0,0 +1,111 @@
+"""
+RV32M multiply and divide
+"""
+from amaranth import *
+from amaranth.lib import wiring
+from amaranth.lib.wiring import In, Out
+
+def multiply(f, a, b):
+    """
+    Single cycle multiply by M function
+    
+    000 MUL, 001 MULH, 010 MULHSU, 011 MULHU
+    """
+    # Extend to 33 bits so one signed multiplier does all four
+    a_signed = (f[0:2] == 0b01) | (f[0:2] == 0b10)
+    b_signed = f[0:2] == 0b01
+    
+    a_ext = Cat(a, a[31] & a_signed).as_signed()
+    b_ext = Cat(b, b[31] & b_signed).as_signed()
+    
+    product = a_ext * b_ext
+    
+    return Mux(f[0:2] == 0, product[0:32], product[32:64])
+    
+class Divider(wiring.Component):
+    """
+    Iterative divider, one bit per cycle
+    
+    op is the lower two bits of the M function,
+    00 DIV, 01 DIVU, 10 REM, 11 REMU
+    
+    Operands are latched on start, busy is held until done,
+    result is valid while done is high for one cycle.
+    """
+    def __init__(self, width = 32):
+        self.width = width
+        
+        super().__init__({
+            "start": In(1),
+            "op": In(2),
+            "a": In(width),
+            "b": In(width),
+            "busy": Out(1),
+            "done": Out(1),
+            "result": Out(width)
+        })
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        n = self.width
+        
+        quotient = Signal(n)
+        remainder = Signal(n)
+        divisor = Signal(n)
+        
+        # Signs to restore at the end
+        negate_quotient = Signal()
+        negate_remainder = Signal()
+        want_remainder = Signal()
+        
+        count = Signal(range(n + 1))
+        
+        signed_op = ~self.op[0]
+        
+        a_negative = signed_op & self.a[-1]
+        b_negative = signed_op & self.b[-1]
+        
+        # Next remainder with the top bit of the dividend shifted in
+        shifted = Signal(n + 1)
+        difference = Signal(n + 2)
+        
+        m.d.comb += shifted.eq(Cat(quotient[-1], remainder))
+        m.d.comb += difference.eq(shifted - divisor)
+        
+        with m.FSM():
+            with m.State("Idle"):
+                with m.If(self.start):
+                    m.d.sync += [
+                        quotient.eq(Mux(a_negative, -self.a, self.a)),
+                        remainder.eq(0),
+                        divisor.eq(Mux(b_negative, -self.b, self.b)),
+                        # Divide by zero gives all ones, not negated
+                        negate_quotient.eq((a_negative ^ b_negative) & (self.b != 0)),
+                        negate_remainder.eq(a_negative),
+                        want_remainder.eq(self.op[1]),
+                        count.eq(n)
+                    ]
+                    m.next = "Divide"
+            with m.State("Divide"):
+                m.d.comb += self.busy.eq(1)
+                with m.If(difference[-1]):
+                    # Doesn't fit, keep remainder
+                    m.d.sync += remainder.eq(shifted)
+                    m.d.sync += quotient.eq(Cat(C(0, 1), quotient))
+                with m.Else():
+                    m.d.sync += remainder.eq(difference)
+                    m.d.sync += quotient.eq(Cat(C(1, 1), quotient))
+                m.d.sync += count.eq(count - 1)
+                with m.If(count == 1):
+                    m.next = "Done"
+            with m.State("Done"):
+                m.d.comb += self.busy.eq(1)
+                m.d.comb += self.done.eq(1)
+                with m.If(want_remainder):
+                    m.d.comb += self.result.eq(Mux(negate_remainder, -remainder, remainder))
+                with m.Else():
+                    m.d.comb += self.result.eq(Mux(negate_quotient, -quotient, quotient))
+                m.next = "Idle"
+                
+        return m
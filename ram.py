@@ -1,22 +1,53 @@
 from amaranth import *
 from amaranth.lib import wiring, memory, enum, data
 from amaranth.lib.wiring import In, Out
+from amaranth.utils import exact_log2
 
-from signature import Bus
+from signature import Bus, CycleType
+from atomic import reservations
 
 class WishboneMemory(wiring.Component):
     """
     Memory device for local core memory
     """
-    def __init__(self, shape, depth, init = [], granularity = 0):
+    def __init__(self, shape, depth, init = [], granularity = 0, byte_select = False, burst = False,
+                 pipelined = False, atomic = False):
+        if burst and pipelined:
+            raise ValueError("Memory is either burst or pipelined, not both")
+            
         self.shape = shape
         self.depth = depth
         self.init = init
         self.granularity = granularity
         
-        super().__init__({
-            "bus": In(Bus(32, shape))
-        })
+        # Write individual bytes of each word with bus.sel
+        self.byte_select = byte_select
+        
+        # Ack every cycle of an incrementing burst
+        self.burst = burst
+        
+        # Take a request every cycle, acks follow one cycle later
+        self.pipelined = pipelined
+        
+        # Atomic bus for a single master, nothing else can write so SC never fails
+        self.atomic = atomic
+        
+        super().__init__(self.ports())
+        
+    def bus_signature(self):
+        """
+        Signature of each port, from the options above
+        """
+        sel_shape = 0
+        if self.byte_select:
+            sel_shape = self.shape // 8
+        return Bus(32, self.shape, sel_shape = sel_shape, burst = self.burst, pipelined = self.pipelined,
+                   atomic = self.atomic)
+                   
+    def ports(self):
+        return {
+            "bus": In(self.bus_signature())
+        }
         
     def elaborate(self, platform):
         m = Module()
@@ -24,31 +55,396 @@ class WishboneMemory(wiring.Component):
         mem = m.submodules.mem = memory.Memory(shape = self.shape, depth = self.depth, init = self.init)
         
         read_port = mem.read_port()
-        write_port = mem.write_port()
         
-        # Access memory
-        with m.If(self.bus.w_en):
-            m.d.comb += write_port.en.eq(self.bus.stb & self.bus.cyc)
+        if self.byte_select:
+            write_port = mem.write_port(granularity = 8)
+        else:
+            write_port = mem.write_port()
+        
+        self.port(m, self.bus, read_port, write_port)
+        
+        return m
+        
+    def port(self, m, bus, read_port, write_port, mask = None, hold = None):
+        """
+        Access memory from bus through read_port and write_port
         
-        m.d.comb += read_port.en.eq((~self.bus.w_en) & self.bus.stb & self.bus.cyc)
+        Only bytes set in mask are written, while hold is high
+        writes wait without ack (stalled when pipelined).
+        """
+        request = bus.stb & bus.cyc
+        
+        if hold is not None:
+            request = request & ~(bus.w_en & hold)
+            if self.pipelined:
+                m.d.comb += bus.stall.eq(bus.w_en & hold)
             
+        # Access memory
+        with m.If(bus.w_en & request):
+            if self.byte_select:
+                enable = bus.sel
+            else:
+                enable = C(1, 1)
+            if mask is not None:
+                enable = enable & mask
+            m.d.comb += write_port.en.eq(enable)
+        
+        m.d.comb += read_port.en.eq((~bus.w_en) & request)
+        
         # Address
-        m.d.comb += write_port.addr.eq(self.bus.addr >> self.granularity)
-        m.d.comb += read_port.addr.eq(self.bus.addr >> self.granularity)
+        m.d.comb += write_port.addr.eq(bus.addr >> self.granularity)
+        
+        m.d.comb += bus.r_data.eq(read_port.data)
+        
+        m.d.comb += write_port.data.eq(bus.w_data)
         
+        if self.pipelined:
+            # Every request is acked next cycle, so reads and writes stay in order
+            ack = Signal()
+            m.d.sync += ack.eq(request)
+            m.d.comb += bus.ack.eq(ack)
+            m.d.comb += read_port.addr.eq(bus.addr >> self.granularity)
+            return
+            
         # Ack signal
         write_ok = Signal()
         
-        m.d.comb += write_ok.eq(write_port.en)
+        m.d.comb += write_ok.eq(bus.w_en & request)
         
         read_ok = Signal()
         
-        m.d.sync += read_ok.eq(read_port.en)
+        # Burst continues after this beat
+        burst_next = Signal()
+        
+        if self.burst:
+            m.d.comb += burst_next.eq(read_ok & (bus.cti == CycleType.INCREMENT))
+        
+        # Only ack once per request, otherwise a held strobe
+        # acks the next address with the previous data
+        m.d.sync += read_ok.eq(read_port.en & (~read_ok | burst_next))
         
-        m.d.comb += self.bus.ack.eq(write_ok | read_ok)
+        with m.If(burst_next):
+            # Read ahead for the next beat
+            m.d.comb += read_port.addr.eq((bus.addr >> self.granularity) + 1)
+        with m.Else():
+            m.d.comb += read_port.addr.eq(bus.addr >> self.granularity)
         
-        m.d.comb += self.bus.r_data.eq(read_port.data)
+        m.d.comb += bus.ack.eq(write_ok | read_ok)
         
-        m.d.comb += write_port.data.eq(self.bus.w_data)
+class Collision(enum.Enum):
+    A_WINS = 0 # Write from b is dropped
+    B_WINS = 1 # Write from a is dropped
+    STALL  = 2 # b waits a cycle, so its write lands after a, then a waits for b
+    
+class DualPortMemory(WishboneMemory):
+    """
+    Memory with two independent buses, a is bus and b is bus_b
+    
+    Both ports read and write every cycle. Reads see a write from
+    the other port in the same cycle, writes to the same address in
+    the same cycle are resolved by collision (by byte with byte_select).
+    """
+    def __init__(self, shape, depth, init = [], granularity = 0, byte_select = False, burst = False,
+                 pipelined = False, collision = Collision.STALL):
+        self.collision = Collision(collision)
+        
+        super().__init__(shape, depth, init, granularity, byte_select, burst, pipelined)
+        
+    def ports(self):
+        return super().ports() | {
+            "bus_b": In(self.bus_signature())
+        }
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        mem = m.submodules.mem = memory.Memory(shape = self.shape, depth = self.depth, init = self.init)
+        
+        if self.byte_select:
+            write_a = mem.write_port(granularity = 8)
+            write_b = mem.write_port(granularity = 8)
+        else:
+            write_a = mem.write_port()
+            write_b = mem.write_port()
+            
+        read_a = mem.read_port(transparent_for = (write_b,))
+        read_b = mem.read_port(transparent_for = (write_a,))
+        
+        a = self.bus
+        b = self.bus_b
+        
+        # Both ports write the same address
+        collide = Signal()
+        m.d.comb += collide.eq(
+            a.cyc & a.stb & a.w_en &
+            b.cyc & b.stb & b.w_en &
+            ((a.addr >> self.granularity) == (b.addr >> self.granularity))
+        )
+        
+        if self.byte_select:
+            overlap_a = a.sel
+            overlap_b = b.sel
+        else:
+            overlap_a = overlap_b = C(1, 1)
+            
+        if self.collision == Collision.A_WINS:
+            self.port(m, a, read_a, write_a)
+            self.port(m, b, read_b, write_b, mask = ~(overlap_a & Mux(collide, overlap_b, 0)))
+        elif self.collision == Collision.B_WINS:
+            self.port(m, a, read_a, write_a, mask = ~(overlap_b & Mux(collide, overlap_a, 0)))
+            self.port(m, b, read_b, write_b)
+        else:
+            # b waits on the first cycle of a collision, a on the next
+            waited = Signal()
+            m.d.sync += waited.eq(collide & ~waited)
+            self.port(m, a, read_a, write_a, hold = collide & waited)
+            self.port(m, b, read_b, write_b, hold = collide & ~waited)
+        
+        return m
+        
+class Scratchpad(wiring.Component):
+    """
+    Single cycle memory at a window of addresses in front of a bus
+    
+    Accesses from base to base + size are acked in the same cycle,
+    everything else is passed through to mem. size is in bytes and
+    base must be a multiple of it.
+    """
+    def __init__(self, base, size, data_width = 8, init = []):
+        if size < 4 or size & (size - 1):
+            raise ValueError("Scratchpad size must be a power of two, not {}".format(size))
+        if base % size:
+            raise ValueError("Scratchpad base 0x{:08X} is not aligned to its size".format(base))
+        if data_width not in (8, 32):
+            raise ValueError("Data width must be 8 or 32, not {}".format(data_width))
+            
+        self.base = base
+        self.size = size
+        self.data_width = data_width
+        self.init = init
+        
+        sel_shape = 0
+        if data_width == 32:
+            sel_shape = 4
+            
+        super().__init__({
+            "proc": In(Bus(32, data_width, sel_shape = sel_shape)),
+            "mem": Out(Bus(32, data_width, sel_shape = sel_shape))
+        })
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        size_bits = exact_log2(self.size)
+        
+        if self.data_width == 8:
+            mem = m.submodules.mem = memory.Memory(shape = 8, depth = self.size, init = self.init)
+            write_port = mem.write_port()
+            address = self.proc.addr[0:size_bits]
+        else:
+            mem = m.submodules.mem = memory.Memory(shape = 32, depth = self.size // 4, init = self.init)
+            write_port = mem.write_port(granularity = 8)
+            address = self.proc.addr[2:size_bits]
+            
+        read_port = mem.read_port(domain = "comb")
+        
+        m.d.comb += [
+            read_port.addr.eq(address),
+            write_port.addr.eq(address),
+            write_port.data.eq(self.proc.w_data)
+        ]
+        
+        hit = Signal()
+        m.d.comb += hit.eq(self.proc.addr[size_bits:] == (self.base >> size_bits))
+        
+        with m.If(hit):
+            m.d.comb += self.proc.ack.eq(self.proc.cyc & self.proc.stb)
+            m.d.comb += self.proc.r_data.eq(read_port.data)
+            with m.If(self.proc.cyc & self.proc.stb & self.proc.w_en):
+                if self.data_width == 8:
+                    m.d.comb += write_port.en.eq(1)
+                else:
+                    m.d.comb += write_port.en.eq(self.proc.sel)
+        with m.Else():
+            m.d.comb += [
+                self.mem.cyc.eq(self.proc.cyc),
+                self.mem.stb.eq(self.proc.stb),
+                self.mem.addr.eq(self.proc.addr),
+                self.mem.w_en.eq(self.proc.w_en),
+                self.mem.w_data.eq(self.proc.w_data),
+                self.proc.ack.eq(self.mem.ack),
+                self.proc.r_data.eq(self.mem.r_data),
+                self.proc.dest.eq(self.mem.dest)
+            ]
+            if self.data_width == 32:
+                m.d.comb += self.mem.sel.eq(self.proc.sel)
+                
+        return m
+        
+class BankedDebug(object):
+    def __init__(self):
+        self.conflicts = None # Cycles a master waited for a bank
+        
+class BankedMemory(wiring.Component):
+    """
+    Memory split into banks by the low bits of the word address,
+    with a bus for each master
+    
+    Masters accessing different banks are served in the same cycle,
+    masters on the same bank take turns. Acks are the same as
+    WishboneMemory, writes in the same cycle and reads the next.
+    
+    With atomic, a master holding lock has the memory to itself,
+    and each master keeps an LR/SC reservation on a word of byte
+    addresses. An SC without it is acked with fail and not written.
+    """
+    def __init__(self, shape, depth, banks = 4, masters = 2, init = [], granularity = 0, byte_select = False,
+                 atomic = False):
+        if banks < 1 or banks & (banks - 1):
+            raise ValueError("Number of banks must be a power of two, not {}".format(banks))
+        if depth % banks:
+            raise ValueError("Depth {} doesn't split into {} banks".format(depth, banks))
+            
+        self.shape = shape
+        self.depth = depth
+        self.banks = banks
+        self.masters = masters
+        self.init = init
+        self.granularity = granularity
+        self.byte_select = byte_select
+        self.atomic = atomic
+        
+        sel_shape = 0
+        if byte_select:
+            sel_shape = shape // 8
+            
+        self.debug = BankedDebug()
+        
+        super().__init__({
+            "bus_{:02X}".format(i): In(Bus(32, shape, sel_shape = sel_shape, atomic = atomic)) for i in range(masters)
+        })
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        buses = [getattr(self, "bus_{:02X}".format(i)) for i in range(self.masters)]
+        
+        bank_bits = exact_log2(self.banks)
+        
+        word = [bus.addr >> self.granularity for bus in buses]
+        bank = [w[0:bank_bits] for w in word]
+        row = [w[bank_bits:] for w in word]
+        
+        # Read acked this cycle, data from read_bank
+        read_ok = [Signal(name = "read_ok{}".format(i)) for i in range(self.masters)]
+        read_bank = [Signal(range(self.banks), name = "read_bank{}".format(i)) for i in range(self.masters)]
+        
+        request = [Signal(name = "request{}".format(i)) for i in range(self.masters)]
+        granted = [Signal(name = "granted{}".format(i)) for i in range(self.masters)]
+        
+        for i, bus in enumerate(buses):
+            m.d.comb += request[i].eq(bus.cyc & bus.stb & ~read_ok[i])
+            
+        if self.atomic:
+            # Store conditional that lost its reservation
+            failed = [Signal(name = "failed{}".format(i)) for i in range(self.masters)]
+            
+            # First master to raise lock takes the memory until it drops it
+            locked = Signal()
+            owner = Signal(range(self.masters))
+            claim = Signal(range(self.masters))
+            claiming = Signal()
+            
+            for i in reversed(range(self.masters)):
+                with m.If(buses[i].cyc & buses[i].lock):
+                    m.d.comb += claim.eq(i)
+                    m.d.comb += claiming.eq(1)
+                    
+            with m.If(locked):
+                with m.If(~(Array(buses)[owner].cyc & Array(buses)[owner].lock)):
+                    m.d.sync += locked.eq(0)
+            with m.Elif(claiming):
+                m.d.sync += locked.eq(1)
+                m.d.sync += owner.eq(claim)
+                
+            holder = Mux(locked, owner, claim)
+            
+            for i, bus in enumerate(buses):
+                with m.If((locked | claiming) & (holder != i)):
+                    m.d.comb += request[i].eq(0)
+                with m.If(failed[i]):
+                    m.d.comb += request[i].eq(0)
+                    
+        data = list()
+        
+        for b in range(self.banks):
+            mem = memory.Memory(shape = self.shape, depth = self.depth // self.banks, init = self.init[b::self.banks])
+            m.submodules["bank{}".format(b)] = mem
+            
+            read_port = mem.read_port()
+            if self.byte_select:
+                write_port = mem.write_port(granularity = 8)
+            else:
+                write_port = mem.write_port()
+                
+            data.append(read_port.data)
+            
+            # Masters waiting on this bank
+            waiting = Signal(self.masters, name = "waiting{}".format(b))
+            for i in range(self.masters):
+                m.d.comb += waiting[i].eq(request[i] & (bank[i] == b))
+                
+            # Round robin, starting after the last master served
+            last = Signal(range(self.masters), name = "last{}".format(b))
+            winner = Signal(range(self.masters), name = "winner{}".format(b))
+            
+            for offset in reversed(range(1, self.masters + 1)):
+                candidate = (last + offset) % self.masters
+                with m.If(waiting.bit_select(candidate, 1)):
+                    m.d.comb += winner.eq(candidate)
+                    
+            with m.If(waiting.any()):
+                m.d.sync += last.eq(winner)
+                
+            for i, bus in enumerate(buses):
+                with m.If(waiting.any() & (winner == i)):
+                    m.d.comb += granted[i].eq(1)
+                    m.d.comb += [
+                        read_port.addr.eq(row[i]),
+                        read_port.en.eq(~bus.w_en),
+                        write_port.addr.eq(row[i]),
+                        write_port.data.eq(bus.w_data)
+                    ]
+                    with m.If(bus.w_en):
+                        if self.byte_select:
+                            m.d.comb += write_port.en.eq(bus.sel)
+                        else:
+                            m.d.comb += write_port.en.eq(1)
+                            
+        data = Array(data)
+        
+        conflicts = Signal(32)
+        m.d.sync += conflicts.eq(conflicts + sum(request[i] & ~granted[i] for i in range(self.masters)))
+        
+        for i, bus in enumerate(buses):
+            m.d.sync += read_ok[i].eq(granted[i] & ~bus.w_en)
+            with m.If(granted[i]):
+                m.d.sync += read_bank[i].eq(bank[i])
+                
+            m.d.comb += bus.ack.eq((granted[i] & bus.w_en) | read_ok[i])
+            m.d.comb += bus.r_data.eq(data[read_bank[i]])
+            
+        if self.atomic:
+            held = reservations(m, "reservation", [bus.addr[2:] for bus in buses],
+                                 [granted[i] & ~bus.w_en & bus.reserve for i, bus in enumerate(buses)],
+                                 [granted[i] & bus.w_en for i, bus in enumerate(buses)])
+                                 
+            for i, bus in enumerate(buses):
+                m.d.comb += failed[i].eq(bus.cyc & bus.stb & bus.w_en & bus.reserve & ~held[i])
+                with m.If(failed[i]):
+                    m.d.comb += bus.ack.eq(1)
+                    m.d.comb += bus.fail.eq(1)
+                    
+        self.debug.conflicts = conflicts
         
-        return m
\ No newline at end of file
+        return m
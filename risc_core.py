@@ -2,13 +2,18 @@
 Implementation of RV32I instructions
 """
 from amaranth import *
-from amaranth.lib import wiring, enum, data
+from amaranth.lib import wiring, enum, data, memory
 from amaranth.lib.wiring import In, Out
 from signature import Bus
+from muldiv import Divider, multiply
+from simd import packed, scale, packed_defined, scale_defined
+from store_buffer import StoreBuffer
+from ram import Scratchpad
+from atomic import AtomicFunction, amo
 
 class Registers(enum.Enum):
-    SEND_SIZE = 0 # number of words to send
-    SEND_DEST = 1 # where to send words
+    SEND_SIZE = 0 # number of bytes to send
+    SEND_DEST = 1 # where to send bytes
     SEND_BUF  = 2 # location of buffer
 
 class Instruction(enum.Enum):
@@ -24,10 +29,41 @@ class Instruction(enum.Enum):
     ARITH       = 0b0110011
     FENCE       = 0b0001111
     E           = 0b1110011
+    AMO         = 0b0101111 # RV32A
+    # Packed pixel instructions
+    CUSTOM0     = 0b0001011
+    CUSTOM1     = 0b0101011
     
+class Csr(enum.Enum, shape = 12):
+    # Counters read with Zicsr instructions
+    CYCLE        = 0xC00
+    TIME         = 0xC01 # Same as cycle
+    INSTRET      = 0xC02
+    CYCLEH       = 0xC80
+    TIMEH        = 0xC81
+    INSTRETH     = 0xC82
+    # Custom read only counters
+    FETCH_STALL  = 0xCC0 # Cycles waiting on instruction fetch
+    MEMORY_STALL = 0xCC1 # Cycles waiting on data bus
+    # Machine trap registers
+    MSTATUS      = 0x300 # MIE is bit 3, MPIE bit 7
+    MTVEC        = 0x305 # Handler address
+    MEPC         = 0x341 # Instruction to return to
+    MCAUSE       = 0x342
+    INT_DATA     = 0xFC0 # Custom read only, data of the last int transaction
+    
+class SystemFunction(enum.Enum, shape = 12):
+    # Immediate of E instructions with no csr function
+    MRET = 0x302
+    WFI  = 0x105
+    
+# mcause of an interrupt from int, machine external interrupt
+INTERRUPT_CAUSE = 0x8000000B
+
 class MemoryStage(enum.Enum):
     SETUP = 0
     RUN = 1
+    WRITE = 2 # Write back of an AMO
     
 risc_instruction_layout = data.UnionLayout({
     "op": 7,
@@ -74,28 +110,286 @@ risc_instruction_layout = data.UnionLayout({
     })
 })
     
+def load_value(f, data):
+    """
+    Extend loaded data by load function,
+    lower two bits are the width, upper bit selects unsigned
+    """
+    byte = Mux(f[2], data[0:8], data[0:8].as_signed())
+    half = Mux(f[2], data[0:16], data[0:16].as_signed())
+    
+    return Mux(f[0:2] == 0, byte, Mux(f[0:2] == 1, half, data.as_signed()))
+    
+def b_offset(instruction):
+    """
+    Branch offset of B type instruction
+    """
+    return Cat(
+        C(0, 1),
+        instruction.b.offset_lower[1:5],
+        instruction.b.offset_upper[0:6],
+        instruction.b.offset_lower[0],
+        instruction.b.offset_upper[6]
+    ).as_signed()
+    
+def j_offset(instruction):
+    """
+    Jump offset of J type instruction
+    """
+    return Cat(
+        C(0, 1),
+        instruction.j.offset[9:19],
+        instruction.j.offset[8],
+        instruction.j.offset[0:8],
+        instruction.j.offset[19]
+    ).as_signed()
+    
+def static_prediction(instruction):
+    """
+    Backward branches and jal are predicted taken,
+    returns if taken and offset to the target
+    """
+    jump = instruction.op == Instruction.JAL
+    taken = jump | ((instruction.op == Instruction.BRANCH) & instruction.b.offset_upper[6])
+    
+    return taken, Mux(jump, j_offset(instruction), b_offset(instruction))
+    
+def lane_select(f, offset):
+    """
+    Byte enables for an access of width f at byte offset in the word
+    """
+    lanes = Mux(f[0:2] == 0, 0b0001, Mux(f[0:2] == 1, 0b0011, 0b1111))
+    
+    return (lanes << offset)[0:4]
+    
 class CoreDebug(object):
     def __init__(self):
         self.instruction = None
         self.reg = None
-        self.pc = None
+        self.pc = None # Address of instruction being executed
+        self.retire = None # Instruction finishes, registers are written on this cycle
+        self.counters = None # Counter values by Csr
+        self.trap = None # Interrupt taken, after any instruction retired on this cycle
+        self.trap_registers = None # Trap register values by Csr
     
 class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
-    def __init__(self, n_regs = 32):
+    def __init__(self, n_regs = 32, pipelined = False, data_width = 8, register_memory = False, muldiv = False,
+                 counters = False, simd = False, predict = False, store_buffer = 0,
+                 scratchpad = 0, scratchpad_base = 0x10000000, interrupts = False, atomics = False):
         self.n_regs = 32
         
+        # Registers in a Memory instead of flip flops, x0 is hardwired to zero
+        self.register_memory = register_memory
+        
+        # RV32M, single cycle multiply and iterative divide
+        self.muldiv = muldiv
+        
+        # cycle, time, instret and stall counters
+        self.counters = counters
+        
+        # Packed 4x8 bit pixel instructions in custom-0 and custom-1
+        self.simd = simd
+        
+        # Transactions on int trap to mtvec when mstatus.MIE is set, with mret and wfi
+        self.interrupts = interrupts
+        
+        # RV32A, AMOs lock the data bus between read and write, LR/SC use its reservations
+        if atomics and (store_buffer or scratchpad):
+            raise ValueError("Atomics go straight to the data bus, without a store buffer or scratchpad")
+        self.atomics = atomics
+        
+        # Static branch prediction, backward taken and forward not taken
+        self.predict = predict
+        
+        # Depth of posted write buffer on the data bus, 0 for none
+        self.store_buffer = store_buffer
+        
+        # Bytes of single cycle memory at scratchpad_base, 0 for none
+        self.scratchpad = scratchpad
+        self.scratchpad_base = scratchpad_base
+        
+        # Use fetch/decode/execute/writeback pipeline instead of the fsm
+        self.pipelined = pipelined
+        
+        # Data bus is either byte wide, or word wide with byte enables
+        if data_width not in (8, 32):
+            raise ValueError("Data width must be 8 or 32, not {}".format(data_width))
+        self.data_width = data_width
+        
+        sel_shape = 0
+        if data_width == 32:
+            sel_shape = 4
+        
         super().__init__({
-            "bus": Out(Bus(32, 8)),
+            "bus": Out(Bus(32, data_width, sel_shape = sel_shape, atomic = atomics)),
             "prog": Out(Bus(32, 32)),
             "int": In(Bus(32, 8))
         })
         
+    def register_file(self, m, rs1, rs2, rd, value, write):
+        """
+        Registers with two read ports and one write port
+        
+        Returns rs1 and rs2 values and the registers for debug.
+        As an Array the values are read in the same cycle, as a
+        Memory reads are registered and see writes from the same
+        cycle, so rs1 and rs2 are the registers needed next cycle.
+        """
+        if not self.register_memory:
+            reg = Array([Signal(signed(32), name = "r{:02X}".format(i)) for i in range(32)])
+            
+            with m.If(write):
+                m.d.sync += reg[rd].eq(value)
+                
+            return reg[rs1], reg[rs2], reg
+            
+        regfile = m.submodules.regfile = memory.Memory(shape = signed(32), depth = 32, init = [])
+        
+        write_port = regfile.write_port()
+        read1 = regfile.read_port(transparent_for = (write_port,))
+        read2 = regfile.read_port(transparent_for = (write_port,))
+        
+        # x0 is never written so always reads zero
+        m.d.comb += [
+            write_port.addr.eq(rd),
+            write_port.data.eq(value),
+            write_port.en.eq(write & (rd != 0)),
+            read1.addr.eq(rs1),
+            read2.addr.eq(rs2)
+        ]
+        
+        return read1.data, read2.data, [regfile.data[i] for i in range(32)]
+        
+    def data_bus(self, m):
+        """
+        Bus used for loads and stores, and whether every
+        store has reached the data bus
+        """
+        sel_shape = 0
+        if self.data_width == 32:
+            sel_shape = 4
+            
+        bus = wiring.flipped(self.bus)
+        empty = C(1, 1)
+        
+        if self.store_buffer:
+            buffer = m.submodules.store_buffer = StoreBuffer(self.store_buffer, self.data_width, sel_shape)
+            wiring.connect(m, buffer.mem, bus)
+            bus, empty = buffer.proc, buffer.empty
+            
+        if self.scratchpad:
+            # Scratchpad accesses don't wait behind buffered stores
+            scratchpad = m.submodules.scratchpad = Scratchpad(self.scratchpad_base, self.scratchpad, self.data_width)
+            wiring.connect(m, scratchpad.mem, bus)
+            bus = scratchpad.proc
+            
+        return bus, empty
+        
+    def performance_counters(self, m, bus, retire, address, value):
+        """
+        Counters read by Zicsr instructions, value is the
+        counter at address. Returns the counters by Csr
+        """
+        cycle = Signal(64)
+        instret = Signal(64)
+        fetch_stall = Signal(32)
+        memory_stall = Signal(32)
+        
+        m.d.sync += cycle.eq(cycle + 1)
+        with m.If(retire):
+            m.d.sync += instret.eq(instret + 1)
+        with m.If(self.prog.cyc & self.prog.stb & ~self.prog.ack):
+            m.d.sync += fetch_stall.eq(fetch_stall + 1)
+        with m.If(bus.cyc & bus.stb & ~bus.ack):
+            m.d.sync += memory_stall.eq(memory_stall + 1)
+            
+        counters = {
+            Csr.CYCLE: cycle[0:32],
+            Csr.TIME: cycle[0:32],
+            Csr.INSTRET: instret[0:32],
+            Csr.CYCLEH: cycle[32:64],
+            Csr.TIMEH: cycle[32:64],
+            Csr.INSTRETH: instret[32:64],
+            Csr.FETCH_STALL: fetch_stall,
+            Csr.MEMORY_STALL: memory_stall
+        }
+        
+        # Unknown counters read as zero
+        with m.Switch(address):
+            for csr, counter in counters.items():
+                with m.Case(csr):
+                    m.d.comb += value.eq(counter)
+                    
+        return counters
+        
+    def trap_registers(self, m, address, f, source, write, value, trap, trap_pc, mret):
+        """
+        Trap registers written by Zicsr instructions when write is
+        high, value is the register at address. trap enters the
+        handler from trap_pc and mret returns from it. Returns the
+        registers by Csr and whether an interrupt is waiting
+        """
+        mstatus = Signal(32)
+        mtvec = Signal(32)
+        mepc = Signal(32)
+        mcause = Signal(32)
+        data = Signal(8)
+        
+        registers = {
+            Csr.MSTATUS: mstatus,
+            Csr.MTVEC: mtvec,
+            Csr.MEPC: mepc,
+            Csr.MCAUSE: mcause,
+            Csr.INT_DATA: data
+        }
+        
+        with m.Switch(address):
+            for csr, register in registers.items():
+                with m.Case(csr):
+                    m.d.comb += value.eq(register)
+                    if csr != Csr.INT_DATA:
+                        with m.If(write):
+                            with m.Switch(f[0:2]):
+                                with m.Case(0b01):
+                                    m.d.sync += register.eq(source)
+                                with m.Case(0b10):
+                                    m.d.sync += register.eq(register | source)
+                                with m.Case(0b11):
+                                    m.d.sync += register.eq(register & ~source)
+                                    
+        # Take one transaction at a time, held until the trap
+        pending = Signal()
+        
+        with m.If(self.int.cyc & self.int.stb & ~pending):
+            m.d.comb += self.int.ack.eq(1)
+            m.d.sync += pending.eq(1)
+            m.d.sync += data.eq(self.int.w_data)
+            
+        with m.If(trap):
+            m.d.sync += [
+                pending.eq(0),
+                mepc.eq(trap_pc),
+                mcause.eq(INTERRUPT_CAUSE),
+                mstatus[3].eq(0),
+                mstatus[7].eq(mstatus[3])
+            ]
+        with m.Elif(mret):
+            m.d.sync += [
+                mstatus[3].eq(mstatus[7]),
+                mstatus[7].eq(1)
+            ]
+            
+        return registers, pending
+        
     def elaborate(self, platform):
+        if self.pipelined:
+            return self.elaborate_pipelined(platform)
+        
         m = Module()
         
-        enable = Signal(init = 1)
+        bus, bus_empty = self.data_bus(m)
         
-        reg = Array([Signal(signed(32), name = "r{:02X}".format(i)) for i in range(32)])
+        enable = Signal(init = 1)
         
         program_address_shape = 32
         
@@ -103,6 +397,9 @@ class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
         
         m.d.comb += self.prog.addr.eq(program_counter)
         
+        # Address of instruction being run
+        current_pc = Signal(program_address_shape)
+        
         instruction_cache = Signal(risc_instruction_layout)
         instruction_fetch = Signal(risc_instruction_layout)
         
@@ -110,15 +407,24 @@ class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
         mem_register = Signal(32)
         mem_address = Signal(32)
         
+        # Loaded data, lowest byte first
+        load_data = Signal(32)
+        # Access finishes on this ack
+        mem_done = Signal()
+        
+        # LR has reserved a word for SC
+        reserved = Signal()
+        reserved_address = Signal(30)
+        
         jal_offset = Signal(signed(21))
         
         # jal offset mapping
         # offset[20|10:1|11|19:12]
         m.d.comb += jal_offset.eq(
-            (instruction_fetch.j.offset[0:8] << 12) + # offset[19:12]
-            (instruction_fetch.j.offset[8]   << 11) + # offset[11]
-            (instruction_fetch.j.offset[9:19]<< 1)  + # offset[10:1]
-            (instruction_fetch.j.offset[19]  << 20)   # offset[20]
+            (instruction_cache.j.offset[0:8] << 12) + # offset[19:12]
+            (instruction_cache.j.offset[8]   << 11) + # offset[11]
+            (instruction_cache.j.offset[9:19]<< 1)  + # offset[10:1]
+            (instruction_cache.j.offset[19]  << 20)   # offset[20]
         )
         
         branch_offset = Signal(signed(13))
@@ -134,13 +440,18 @@ class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
         
         branch_next = Signal(32)
         
-        m.d.comb += branch_next.eq(
-            program_counter +
-            branch_offset - 4
-        )
+        # Branch condition is met
+        branch_taken = Signal()
         
         branch_en = Signal()
         
+        # Waiting on fetch from the wrong path
+        recover = Signal()
+        recover_pc = Signal(32)
+        
+        # Counter read by Zicsr instruction
+        csr_value = Signal(32)
+        
         # This is for debugging information
         opcode = Signal(Instruction)
         m.d.comb += opcode.eq(instruction_fetch.op)
@@ -156,11 +467,73 @@ class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
         
         m.d.comb += instruction_fetch.eq(self.prog.r_data)
         
+        # Register writes from the second stage
+        rd_write = Signal()
+        rd_value = Signal(signed(32))
+        
+        def write_rd(value):
+            return [rd_write.eq(1), rd_value.eq(value)]
+            
+        fetch_ack = self.prog.cyc & self.prog.stb & self.prog.ack
+        
+        if self.register_memory:
+            # Read operands of the instruction being fetched
+            rs1 = Mux(fetch_ack, instruction_fetch.r.rs1, instruction_cache.r.rs1)
+            rs2 = Mux(fetch_ack, instruction_fetch.r.rs2, instruction_cache.r.rs2)
+        else:
+            rs1 = instruction_cache.r.rs1
+            rs2 = instruction_cache.r.rs2
+            
+        src1, src2, reg = self.register_file(m, rs1, rs2, instruction_cache.r.rd, rd_value, rd_write)
+        
+        if self.muldiv:
+            divider = m.submodules.divider = Divider()
+            m.d.comb += [
+                divider.op.eq(instruction_cache.r.f_lower[0:2]),
+                divider.a.eq(src1),
+                divider.b.eq(src2)
+            ]
+        
         memorystage = Signal(MemoryStage)
         
+        # Interrupt taken instead of the fetched instruction
+        trap = Signal()
+        
+        if self.interrupts:
+            e_op = active & (instruction_cache.op == Instruction.E)
+            trap_registers, interrupt_pending = self.trap_registers(
+                m, instruction_cache.as_value()[20:32], instruction_cache.i.f,
+                Mux(instruction_cache.i.f[2], instruction_cache.r.rs1, src1),
+                e_op & (instruction_cache.i.f != 0),
+                csr_value, trap, program_counter,
+                e_op & (instruction_cache.i.f == 0) & (instruction_cache.as_value()[20:32] == SystemFunction.MRET)
+            )
+        else:
+            trap_registers = None
+            
+        if self.predict:
+            # Fetch went down the predicted path, go to the other one if it was wrong
+            with m.If(active & (instruction_cache.op == Instruction.BRANCH)):
+                m.d.comb += branch_en.eq(branch_taken != instruction_cache.b.offset_upper[6])
+            m.d.comb += branch_next.eq(
+                Mux(branch_taken, current_pc + branch_offset, current_pc + 4)
+            )
+        else:
+            m.d.comb += branch_en.eq(branch_taken)
+            m.d.comb += branch_next.eq(
+                current_pc +
+                branch_offset
+            )
+            
         with m.If(branch_en):
             m.d.sync += program_counter.eq(branch_next)
             m.d.sync += fetch.eq(1)
+            if self.predict:
+                with m.If(~fetch_ack):
+                    # Address has to be held until the fetch is acked
+                    m.d.sync += program_counter.eq(program_counter)
+                    m.d.sync += recover.eq(1)
+                    m.d.sync += recover_pc.eq(branch_next)
         
         #################################
         ## Second stage #################
@@ -176,35 +549,35 @@ class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
                     with m.Switch(instruction_cache.b.f):
                         with m.Case(0b000):
                             # Branch if Equal
-                            m.d.comb += branch_en.eq(
-                                reg[instruction_cache.b.rs1] == reg[instruction_cache.b.rs2]
+                            m.d.comb += branch_taken.eq(
+                                src1 == src2
                             )
                         with m.Case(0b001):
                             # Branch if not equal
-                            m.d.comb += branch_en.eq(
-                                reg[instruction_cache.b.rs1] != reg[instruction_cache.b.rs2]
+                            m.d.comb += branch_taken.eq(
+                                src1 != src2
                             )
                         with m.Case(0b100):
                             # Branch less than
-                            m.d.comb += branch_en.eq(
-                                reg[instruction_cache.b.rs1] < reg[instruction_cache.b.rs2]
+                            m.d.comb += branch_taken.eq(
+                                src1 < src2
                             )
                         with m.Case(0b101):
                             # Branch greater than or equal
-                            m.d.comb += branch_en.eq(
-                                reg[instruction_cache.b.rs1] >= reg[instruction_cache.b.rs2]
+                            m.d.comb += branch_taken.eq(
+                                src1 >= src2
                             )
                         with m.Case(0b110):
                             # Branch less than unsigned
-                            m.d.comb += branch_en.eq(
-                                reg[instruction_cache.b.rs1].as_unsigned() <
-                                reg[instruction_cache.b.rs2].as_unsigned()
+                            m.d.comb += branch_taken.eq(
+                                src1.as_unsigned() <
+                                src2.as_unsigned()
                             )
                         with m.Case(0b111):
                             # Branch less than signed
-                            m.d.comb += branch_en.eq(
-                                reg[instruction_cache.b.rs1].as_unsigned() >=
-                                reg[instruction_cache.b.rs2].as_unsigned()
+                            m.d.comb += branch_taken.eq(
+                                src1.as_unsigned() >=
+                                src2.as_unsigned()
                             )
                 ##################################
                 ### Load from memory #############
@@ -214,36 +587,51 @@ class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
                         with m.Case(MemoryStage.SETUP):
                             # Load value from memory
                             offset = instruction_cache.i.imm
-                            m.d.sync += mem_address.eq(reg[instruction_cache.i.rs] + offset.as_signed())
-                            m.d.sync += reg[instruction_cache.i.rd].eq(0)
-                            with m.Switch(instruction_cache.i.f):
-                                with m.Case(0b000):
+                            m.d.sync += mem_address.eq(src1 + offset.as_signed())
+                            with m.Switch(instruction_cache.i.f[0:2]):
+                                with m.Case(0b00):
                                     # Load byte
                                     m.d.sync += mem_counter.eq(0)
-                                with m.Case(0b001):
+                                with m.Case(0b01):
                                     # Load half word
                                     m.d.sync += mem_counter.eq(1)
-                                with m.Case(0b010):
+                                with m.Case(0b10):
                                     # Load word
-                                    m.d.sync += mem_counter.eq(2)
+                                    m.d.sync += mem_counter.eq(3)
                             m.d.sync += memorystage.eq(MemoryStage.RUN)
                         with m.Case(MemoryStage.RUN):
-                            # Run n bus transactions to load data
-                            m.d.comb += self.bus.cyc.eq(1)
-                            m.d.comb += self.bus.stb.eq(1)
-                            m.d.comb += self.bus.addr.eq(mem_address)
-                            with m.If(self.bus.ack):
+                            m.d.comb += bus.cyc.eq(1)
+                            m.d.comb += bus.stb.eq(1)
+                            if self.data_width == 8:
+                                # Run n bus transactions to load data
+                                m.d.comb += bus.addr.eq(mem_address)
+                                with m.Switch(instruction_cache.i.f[0:2]):
+                                    with m.Case(0b00):
+                                        m.d.comb += load_data.eq(bus.r_data)
+                                    with m.Case(0b01):
+                                        m.d.comb += load_data.eq(Cat(mem_register[24:32], bus.r_data))
+                                    with m.Default():
+                                        m.d.comb += load_data.eq(Cat(mem_register[8:32], bus.r_data))
+                            else:
+                                # Single transaction, select bytes from word
+                                m.d.comb += bus.addr.eq(Cat(C(0, 2), mem_address[2:]))
+                                m.d.comb += bus.sel.eq(lane_select(instruction_cache.i.f, mem_address[0:2]))
+                                m.d.comb += load_data.eq(bus.r_data >> (mem_address[0:2] * 8))
+                                m.d.comb += mem_done.eq(1)
+                            with m.If(bus.ack):
                                 # Read ready
                                 # Shift in data
-                                m.d.sync += reg[instruction_cache.i.rd].eq(
-                                                        (reg[instruction_cache.i.rd] << 8) +
-                                                        self.bus.r_data)
-                                with m.If(mem_counter == 0):
+                                m.d.sync += mem_register.eq(Cat(mem_register[8:32], bus.r_data))
+                                with m.If(mem_done | (mem_counter == 0)):
+                                    m.d.comb += write_rd(
+                                        load_value(instruction_cache.i.f, load_data)
+                                    )
                                     m.d.sync += active.eq(0)
                                     m.d.sync += fetch.eq(1)
                                     m.d.sync += memorystage.eq(MemoryStage.SETUP)
                                 with m.Else():
                                     m.d.sync += mem_counter.eq(mem_counter - 1)
+                                    m.d.sync += mem_address.eq(mem_address + 1)
                 ##########################################
                 ## Store memory ##########################
                 ##########################################
@@ -251,33 +639,39 @@ class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
                     with m.Switch(memorystage):
                         with m.Case(MemoryStage.SETUP):
                             offset = instruction_cache.s.imm_lower + (instruction_cache.s.imm_upper << 5)
-                            m.d.sync += mem_address.eq(reg[instruction_cache.s.rs1] + offset.as_signed())
+                            m.d.sync += mem_address.eq(src1 + offset.as_signed())
                             with m.Switch(instruction_cache.s.f):
                                 with m.Case(0b000):
                                     # Store byte
-                                    m.d.sync += mem_register.eq(reg[instruction_cache.s.rs2][0:8])
+                                    m.d.sync += mem_register.eq(src2[0:8])
                                     m.d.sync += mem_counter.eq(0)
                                 with m.Case(0b001):
                                     # Store 2 bytes
-                                    m.d.sync += mem_register.eq(reg[instruction_cache.s.rs2][0:16])
+                                    m.d.sync += mem_register.eq(src2[0:16])
                                     m.d.sync += mem_counter.eq(1)
                                 with m.Case(0b010):
                                     # Store word
-                                    m.d.sync += mem_register.eq(reg[instruction_cache.s.rs2][0:32])
+                                    m.d.sync += mem_register.eq(src2[0:32])
                                     m.d.sync += mem_counter.eq(3)
                             m.d.sync += memorystage.eq(MemoryStage.RUN)
                         with m.Case(MemoryStage.RUN):
-                            # Shift out bytes of data
-                            # Alternatively could add a flag for width of data
-                            m.d.comb += self.bus.cyc.eq(1)
-                            m.d.comb += self.bus.stb.eq(1)
-                            m.d.comb += self.bus.w_en.eq(1)
+                            m.d.comb += bus.cyc.eq(1)
+                            m.d.comb += bus.stb.eq(1)
+                            m.d.comb += bus.w_en.eq(1)
                             
-                            m.d.comb += self.bus.addr.eq(mem_address)
-                            m.d.comb += self.bus.w_data.eq(mem_register[0:8])
+                            if self.data_width == 8:
+                                # Shift out bytes of data
+                                m.d.comb += bus.addr.eq(mem_address)
+                                m.d.comb += bus.w_data.eq(mem_register[0:8])
+                            else:
+                                # Move data to its byte lanes
+                                m.d.comb += bus.addr.eq(Cat(C(0, 2), mem_address[2:]))
+                                m.d.comb += bus.sel.eq(lane_select(instruction_cache.s.f, mem_address[0:2]))
+                                m.d.comb += bus.w_data.eq(mem_register << (mem_address[0:2] * 8))
+                                m.d.comb += mem_done.eq(1)
                             
-                            with m.If(self.bus.ack):
-                                with m.If(mem_counter == 0):
+                            with m.If(bus.ack):
+                                with m.If(mem_done | (mem_counter == 0)):
                                     m.d.sync += active.eq(0)
                                     m.d.sync += fetch.eq(1)
                                     # Finished writing bytes to memory
@@ -291,87 +685,95 @@ class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
                 ###################################
                 with m.Case(Instruction.ARITH):
                     m.d.sync += active.eq(0)
-                    with m.Switch(instruction_cache.r.f_lower):
-                        with m.Case(0b000):
-                            with m.If(instruction_cache.r.f_upper == 0b0000000):
-                                # Add
-                                m.d.sync += reg[instruction_cache.r.rd].eq(
-                                    reg[instruction_cache.r.rs1] +
-                                    reg[instruction_cache.r.rs2]
-                                )
-                            with m.Elif(instruction_cache.r.f_upper == 0b0100000):
-                                # Subtract
-                                m.d.sync += reg[instruction_cache.r.rd].eq(
-                                    reg[instruction_cache.r.rs1] -
-                                    reg[instruction_cache.r.rs2]
+                    with m.If(instruction_cache.r.f_upper == 0b0000001):
+                        if self.muldiv:
+                            with m.If(~instruction_cache.r.f_lower[2]):
+                                # Multiply
+                                m.d.comb += write_rd(
+                                    multiply(instruction_cache.r.f_lower, src1, src2)
                                 )
                             with m.Else():
-                                m.d.sync += Assert(0, "Function not implemented")
-                        with m.Case(0b001):
-                            with m.If(instruction_cache.r.f_upper == 0b0000000):
-                                # Shift left
-                                # TODO not quite right,
-                                # if rs2 is above a value, it's 0,
-                                # otherwise actually shift
-                                with m.If(reg[instruction_cache.r.rs2] > 5):
-                                    m.d.sync += reg[instruction_cache.r.rd].eq(0)
+                                # Divide, wait for result
+                                m.d.comb += divider.start.eq(~divider.busy)
+                                m.d.sync += active.eq(~divider.done)
+                                with m.If(divider.done):
+                                    m.d.comb += write_rd(divider.result)
+                                    m.d.sync += fetch.eq(1)
+                        else:
+                            m.d.sync += Assert(0, "M extension not enabled")
+                    with m.Else():
+                        with m.Switch(instruction_cache.r.f_lower):
+                            with m.Case(0b000):
+                                with m.If(instruction_cache.r.f_upper == 0b0000000):
+                                    # Add
+                                    m.d.comb += write_rd(
+                                        src1 +
+                                        src2
+                                    )
+                                with m.Elif(instruction_cache.r.f_upper == 0b0100000):
+                                    # Subtract
+                                    m.d.comb += write_rd(
+                                        src1 -
+                                        src2
+                                    )
                                 with m.Else():
-                                    m.d.sync += reg[instruction_cache.r.rd].eq(
-                                        reg[instruction_cache.r.rs1] <<
-                                        reg[instruction_cache.r.rs2].as_unsigned()[0:3]
+                                    m.d.sync += Assert(0, "Function not implemented")
+                            with m.Case(0b001):
+                                with m.If(instruction_cache.r.f_upper == 0b0000000):
+                                    # Shift left, by lower 5 bits of rs2
+                                    m.d.comb += write_rd(
+                                        src1 <<
+                                        src2.as_unsigned()[0:5]
+                                    )
+                                with m.Else():
+                                    m.d.sync += Assert(0, "Function not implemented")
+                            with m.Case(0b010):
+                                with m.If(instruction_cache.r.f_upper == 0b0000000):
+                                    # Less than
+                                    m.d.comb += write_rd(
+                                        src1 <
+                                        src2
+                                    )
+                            with m.Case(0b011):
+                                with m.If(instruction_cache.r.f_upper == 0b0000000):
+                                    # Unsigned less than
+                                    m.d.comb += write_rd(
+                                        src1.as_unsigned() <
+                                        src2.as_unsigned()
+                                    )
+                            with m.Case(0b100):
+                                with m.If(instruction_cache.r.f_upper == 0b000000):
+                                    m.d.comb += write_rd(
+                                        src1 ^
+                                        src2
+                                    )
+                            with m.Case(0b101):
+                                with m.If(instruction_cache.r.f_upper == 0b00000_00):
+                                    # Logical shift right
+                                    m.d.comb += write_rd(
+                                        src1.as_unsigned() >>
+                                        src2.as_unsigned()[0:5]
+                                    )
+                                with m.Elif(instruction_cache.r.f_upper == 0b01000_00):
+                                    # Arithmetic shift right
+                                    m.d.comb += write_rd(
+                                        src1 >>
+                                        src2.as_unsigned()[0:5]
+                                    )
+                            with m.Case(0b110):
+                                # OR
+                                with m.If(instruction_cache.r.f_upper == 0b00000_00):
+                                    m.d.comb += write_rd(
+                                        src1 |
+                                        src2
+                                    )
+                            with m.Case(0b111):
+                                # AND
+                                with m.If(instruction_cache.r.f_upper == 0b00000_00):
+                                    m.d.comb += write_rd(
+                                        src1 &
+                                        src2
                                     )
-                            with m.Else():
-                                m.d.sync += Assert(0, "Function not implemented")
-                        with m.Case(0b010):
-                            with m.If(instruction_cache.r.f_upper == 0b0000000):
-                                # Less than
-                                m.d.sync += reg[instruction_cache.r.rd].eq(
-                                    reg[instruction_cache.r.rs1] <
-                                    reg[instruction_cache.r.rs2]
-                                )
-                        with m.Case(0b011):
-                            with m.If(instruction_cache.r.f_upper == 0b0000000):
-                                # Unsigned less than
-                                m.d.sync += reg[instruction_cache.r.rd].eq(
-                                    reg[instruction_cache.r.rs1].as_unsigned() <
-                                    reg[instruction_cache.r.rs2].as_unsigned()
-                                )
-                        with m.Case(0b100):
-                            with m.If(instruction_cache.r.f_upper == 0b000000):
-                                m.d.sync += reg[instruction_cache.r.rd].eq(
-                                    reg[instruction_cache.r.rs1] ^
-                                    reg[instruction_cache.r.rs2]
-                                )
-                        with m.Case(0b101):
-                            with m.If(instruction_cache.r.f_upper == 0b00000_00):
-                                # Logical shift right
-                                m.d.sync += reg[instruction_cache.r.rd].eq(
-                                    reg[instruction_cache.r.rs1] >>
-                                    reg[instruction_cache.r.rs2].as_unsigned()
-                                )
-                            with m.Elif(instruction_cache.r.f_upper == 0b01000_00):
-                                # Arithmetic shift right
-                                m.d.sync += reg[instruction_cache.r.rd][0:31].eq(
-                                    reg[instruction_cache.r.rs1] >>
-                                            reg[instruction_cache.r.rs2].as_unsigned()
-                                        )
-                                m.d.sync += reg[instruction_cache.r.rd][-1].eq(
-                                    reg[instruction_cache.r.rs1][-1]
-                                )
-                        with m.Case(0b110):
-                            # OR
-                            with m.If(instruction_cache.r.f_upper == 0b00000_00):
-                                m.d.sync += reg[instruction_cache.r.rd].eq(
-                                    reg[instruction_cache.r.rs1] |
-                                    reg[instruction_cache.r.rs2]
-                                )
-                        with m.Case(0b111):
-                            # AND
-                            with m.If(instruction_cache.r.f_upper == 0b00000_00):
-                                m.d.sync += reg[instruction_cache.r.rd].eq(
-                                    reg[instruction_cache.r.rs1] &
-                                    reg[instruction_cache.r.rs2]
-                                )
                 #################################
                 ### immediate instructions ######
                 #################################
@@ -380,116 +782,832 @@ class RiscCore(wiring.Component): # RISCV 32I implementation (32E has 16 regs)
                     with m.Switch(instruction_cache.i.f):
                         with m.Case(0b000): # ADDI
                             # Add immediate
-                            m.d.sync += reg[instruction_cache.i.rd].eq(
-                                reg[instruction_cache.i.rs] +
+                            m.d.comb += write_rd(
+                                src1 +
                                 instruction_cache.i.imm
                             )
                         with m.Case(0b010): #SLTI
                             # Set less than immeddiate
-                            m.d.sync += reg[instruction_cache.i.rd].eq(
-                                reg[instruction_cache.i.rs] <
+                            m.d.comb += write_rd(
+                                src1 <
                                 instruction_cache.i.imm
                             )
                         with m.Case(0b011): # SLTIU
                             # Set less than immediate unsigned
-                            m.d.sync += reg[instruction_cache.i.rd].eq(
-                                reg[instruction_cache.i.rs].as_unsigned() <
+                            m.d.comb += write_rd(
+                                src1.as_unsigned() <
                                 instruction_cache.i.imm.as_unsigned()
                             )
                         with m.Case(0b100): # XORI
                             # bitwise xori
-                            m.d.sync += reg[instruction_cache.i.rd].eq(
-                                reg[instruction_cache.i.rs] ^
+                            m.d.comb += write_rd(
+                                src1 ^
+                                instruction_cache.i.imm
+                            )
+                        with m.Case(0b110): # ORI
+                            # Or immediate
+                            m.d.comb += write_rd(
+                                src1 |
                                 instruction_cache.i.imm
                             )
                         with m.Case(0b111): # ANDI
                             # And immediate
-                            m.d.sync += reg[instruction_cache.i.rd].eq(
-                                reg[instruction_cache.i.rs] &
+                            m.d.comb += write_rd(
+                                src1 &
                                 instruction_cache.i.imm
                             )
                         with m.Case(0b001): # SLLI
                             # Shift left
-                            m.d.sync += reg[instruction_cache.i.rd].eq(
-                                reg[instruction_cache.i.rs] <<
+                            m.d.comb += write_rd(
+                                src1 <<
                                 instruction_cache.i.imm[0:5].as_unsigned()
                             )
                         with m.Case(0b101): # SRLI
                             with m.If(instruction_cache.as_value()[27:] == 0b00000):
                                 # Shift right logical
-                                m.d.sync += reg[instruction_cache.i.rd].eq(
-                                    reg[instruction_cache.i.rs] >>
+                                m.d.comb += write_rd(
+                                    src1.as_unsigned() >>
                                     instruction_cache.i.imm[0:5].as_unsigned()
                                 )
                             with m.Elif(instruction_cache.as_value()[27:] == 0b01000):
                                 # Shift right arithmetic
-                                m.d.sync += reg[instruction_cache.i.rd][0:31].eq(
-                                    reg[instruction_cache.i.rs] >>
+                                m.d.comb += write_rd(
+                                    src1 >>
                                     instruction_cache.i.imm[0:5].as_unsigned()
                                 )
-                                m.d.sync += reg[instruction_cache.i.rd][-1].eq(
-                                    reg[instruction_cache.i.rs][-1]
-                                )
                             with m.Else():
                                 m.d.sync += Assert(0, "Shift function not implemented")
                         with m.Default():
                             m.d.sync += Assert(0, "Function not implemented")
+                with m.Case(Instruction.CUSTOM0):
+                    if self.simd:
+                        # Packed pixel operation
+                        m.d.sync += active.eq(0)
+                        with m.If(packed_defined(instruction_cache.r.f_lower, instruction_cache.r.f_upper)):
+                            m.d.comb += write_rd(
+                                packed(instruction_cache.r.f_lower, src1, src2)
+                            )
+                        with m.Else():
+                            m.d.sync += Assert(0, "Function not implemented")
+                with m.Case(Instruction.CUSTOM1):
+                    if self.simd:
+                        # Scale pixel channels by constant
+                        m.d.sync += active.eq(0)
+                        with m.If(scale_defined(instruction_cache.i.f)):
+                            m.d.comb += write_rd(
+                                scale(instruction_cache.i.imm, src1)
+                            )
+                        with m.Else():
+                            m.d.sync += Assert(0, "Function not implemented")
                 with m.Case(Instruction.LUI):
                     # Load upper immediate
                     m.d.sync += active.eq(0)
-                    m.d.sync += reg[instruction_cache.u.rd].eq(
+                    m.d.comb += write_rd(
                         instruction_cache.u.imm << 12
                     )
                 with m.Case(Instruction.AUIPC):
                     # Add upper immediate to pc
                     m.d.sync += active.eq(0)
-                    m.d.sync += reg[instruction_cache.u.rd].eq(
-                        program_counter +
+                    m.d.comb += write_rd(
+                        current_pc +
                         (instruction_cache.u.imm << 12)
                     )
                 with m.Case(Instruction.JAL):
                     # jump and link
                     m.d.sync += active.eq(0)
-                    m.d.sync += reg[instruction_cache.j.rd].eq(
-                        program_counter + 4
+                    m.d.sync += fetch.eq(1)
+                    m.d.comb += write_rd(
+                        current_pc + 4
                     )
                     m.d.sync += program_counter.eq(
-                        program_counter + jal_offset
+                        current_pc + jal_offset
                     )
                 with m.Case(Instruction.JALR):
                     # jump and link register
                     m.d.sync += active.eq(0)
-                    m.d.sync += reg[instruction_cache.i.rd].eq(
-                        program_counter + 4
+                    m.d.sync += fetch.eq(1)
+                    m.d.comb += write_rd(
+                        current_pc + 4
                     )
                     m.d.sync += program_counter.eq(
-                        (reg[instruction_cache.i.rs] +
+                        (src1 +
                         instruction_cache.i.imm.as_signed())
                         & ~1
                     )
+                if self.atomics:
+                    with m.Case(Instruction.AMO):
+                        function = instruction_cache.r.f_upper[2:7]
+                        
+                        m.d.comb += bus.lock.eq(memorystage != MemoryStage.SETUP)
+                        m.d.comb += bus.reserve.eq((function == AtomicFunction.LR) | (function == AtomicFunction.SC))
+                        
+                        with m.Switch(memorystage):
+                            with m.Case(MemoryStage.SETUP):
+                                m.d.sync += mem_address.eq(src1)
+                                m.d.sync += mem_counter.eq(3)
+                                with m.If(function != AtomicFunction.SC):
+                                    m.d.sync += memorystage.eq(MemoryStage.RUN)
+                                with m.Elif(reserved & (src1[2:] == reserved_address)):
+                                    m.d.sync += mem_register.eq(src2)
+                                    m.d.sync += memorystage.eq(MemoryStage.WRITE)
+                                with m.Else():
+                                    # Nothing reserved, SC fails without going to the bus
+                                    m.d.comb += write_rd(1)
+                                    m.d.sync += reserved.eq(0)
+                                    m.d.sync += active.eq(0)
+                                    m.d.sync += fetch.eq(1)
+                            with m.Case(MemoryStage.RUN):
+                                # Read the word
+                                m.d.comb += bus.cyc.eq(1)
+                                m.d.comb += bus.stb.eq(1)
+                                if self.data_width == 8:
+                                    m.d.comb += bus.addr.eq(mem_address)
+                                    m.d.comb += load_data.eq(Cat(mem_register[8:32], bus.r_data))
+                                else:
+                                    m.d.comb += bus.addr.eq(Cat(C(0, 2), mem_address[2:]))
+                                    m.d.comb += bus.sel.eq(0b1111)
+                                    m.d.comb += load_data.eq(bus.r_data)
+                                    m.d.comb += mem_done.eq(1)
+                                with m.If(bus.ack):
+                                    m.d.sync += mem_register.eq(Cat(mem_register[8:32], bus.r_data))
+                                    with m.If(mem_done | (mem_counter == 0)):
+                                        m.d.comb += write_rd(load_data)
+                                        with m.If(function == AtomicFunction.LR):
+                                            m.d.sync += reserved.eq(1)
+                                            m.d.sync += reserved_address.eq(src1[2:])
+                                            m.d.sync += active.eq(0)
+                                            m.d.sync += fetch.eq(1)
+                                            m.d.sync += memorystage.eq(MemoryStage.SETUP)
+                                        with m.Else():
+                                            # Bus stays locked for the write
+                                            m.d.sync += mem_register.eq(amo(function, load_data, src2))
+                                            m.d.sync += mem_counter.eq(3)
+                                            m.d.sync += mem_address.eq(src1)
+                                            m.d.sync += memorystage.eq(MemoryStage.WRITE)
+                                    with m.Else():
+                                        m.d.sync += mem_counter.eq(mem_counter - 1)
+                                        m.d.sync += mem_address.eq(mem_address + 1)
+                            with m.Case(MemoryStage.WRITE):
+                                m.d.comb += bus.cyc.eq(1)
+                                m.d.comb += bus.stb.eq(1)
+                                m.d.comb += bus.w_en.eq(1)
+                                if self.data_width == 8:
+                                    m.d.comb += bus.addr.eq(mem_address)
+                                    m.d.comb += bus.w_data.eq(mem_register[0:8])
+                                else:
+                                    m.d.comb += bus.addr.eq(Cat(C(0, 2), mem_address[2:]))
+                                    m.d.comb += bus.sel.eq(0b1111)
+                                    m.d.comb += bus.w_data.eq(mem_register)
+                                    m.d.comb += mem_done.eq(1)
+                                with m.If(bus.ack):
+                                    with m.If(mem_done | (mem_counter == 0)):
+                                        with m.If(function == AtomicFunction.SC):
+                                            m.d.comb += write_rd(bus.fail)
+                                            m.d.sync += reserved.eq(0)
+                                        m.d.sync += active.eq(0)
+                                        m.d.sync += fetch.eq(1)
+                                        m.d.sync += memorystage.eq(MemoryStage.SETUP)
+                                    with m.Else():
+                                        m.d.sync += mem_register.eq(mem_register >> 8)
+                                        m.d.sync += mem_counter.eq(mem_counter - 1)
+                                        m.d.sync += mem_address.eq(mem_address + 1)
+                with m.Case(Instruction.FENCE):
+                    # Wait for buffered stores to reach the bus
+                    with m.If(bus_empty):
+                        m.d.sync += active.eq(0)
+                        m.d.sync += fetch.eq(1)
+                with m.Case(Instruction.E):
+                    if self.counters or self.interrupts:
+                        with m.If(instruction_cache.i.f != 0):
+                            # Read counter, writes are ignored
+                            m.d.sync += active.eq(0)
+                            m.d.sync += fetch.eq(1)
+                            m.d.comb += write_rd(csr_value)
+                    if self.interrupts:
+                        with m.If(instruction_cache.i.f == 0):
+                            with m.Switch(instruction_cache.as_value()[20:32]):
+                                with m.Case(SystemFunction.MRET):
+                                    m.d.sync += active.eq(0)
+                                    m.d.sync += fetch.eq(1)
+                                    m.d.sync += program_counter.eq(trap_registers[Csr.MEPC])
+                                with m.Case(SystemFunction.WFI):
+                                    # Sleep until there is an interrupt
+                                    with m.If(interrupt_pending):
+                                        m.d.sync += active.eq(0)
+                                        m.d.sync += fetch.eq(1)
+                                        
+        # Instruction finishes this cycle
+        retire = Signal()
         
+        with m.If(active):
+            with m.Switch(instruction_cache.op):
+                with m.Case(Instruction.MEMORYLOAD, Instruction.MEMORYSTORE):
+                    m.d.comb += retire.eq(
+                        (memorystage == MemoryStage.RUN) &
+                        bus.ack &
+                        (mem_done | (mem_counter == 0))
+                    )
+                with m.Case(Instruction.BRANCH, Instruction.ARITH, Instruction.ARITHIMM,
+                            Instruction.LUI, Instruction.AUIPC, Instruction.JAL, Instruction.JALR):
+                    m.d.comb += retire.eq(1)
+                with m.Case(Instruction.FENCE):
+                    m.d.comb += retire.eq(bus_empty)
+                    
+        if self.muldiv:
+            with m.If(active & (instruction_cache.op == Instruction.ARITH) &
+                      (instruction_cache.r.f_upper == 0b0000001) & instruction_cache.r.f_lower[2]):
+                m.d.comb += retire.eq(divider.done)
+                
+        if self.simd:
+            with m.If(active & ((instruction_cache.op == Instruction.CUSTOM0) |
+                                (instruction_cache.op == Instruction.CUSTOM1))):
+                m.d.comb += retire.eq(1)
+                
+        if self.atomics:
+            with m.If(active & (instruction_cache.op == Instruction.AMO)):
+                function = instruction_cache.r.f_upper[2:7]
+                last = bus.ack & (mem_done | (mem_counter == 0))
+                with m.Switch(memorystage):
+                    with m.Case(MemoryStage.SETUP):
+                        m.d.comb += retire.eq((function == AtomicFunction.SC) &
+                                              ~(reserved & (src1[2:] == reserved_address)))
+                    with m.Case(MemoryStage.RUN):
+                        m.d.comb += retire.eq(last & (function == AtomicFunction.LR))
+                    with m.Case(MemoryStage.WRITE):
+                        m.d.comb += retire.eq(last)
+                
+        if self.counters or self.interrupts:
+            with m.If(active & (instruction_cache.op == Instruction.E)):
+                m.d.comb += retire.eq(instruction_cache.i.f != 0)
+                
+        if self.interrupts:
+            with m.If(active & (instruction_cache.op == Instruction.E) & (instruction_cache.i.f == 0)):
+                with m.Switch(instruction_cache.as_value()[20:32]):
+                    with m.Case(SystemFunction.MRET):
+                        m.d.comb += retire.eq(1)
+                    with m.Case(SystemFunction.WFI):
+                        m.d.comb += retire.eq(interrupt_pending)
+                        
+        if self.counters:
+            counters = self.performance_counters(m, bus, retire, instruction_cache.as_value()[20:32], csr_value)
+        else:
+            counters = None
+            
         ####################
         ## Fetch ###########
         ####################
         # Instruction is ready
-        with m.If(self.prog.cyc & self.prog.stb & self.prog.ack):
+        if self.predict:
+            with m.If(fetch_ack & recover):
+                # Instruction is from the wrong path, drop it
+                m.d.sync += program_counter.eq(recover_pc)
+                m.d.sync += recover.eq(0)
+            fetch_ok = fetch_ack & ~branch_en & ~recover
+        else:
+            fetch_ok = fetch_ack
+            
+        with m.If(fetch_ok):
             m.d.sync += instruction_cache.eq(self.prog.r_data)
+            m.d.sync += current_pc.eq(program_counter)
             m.d.sync += program_counter.eq(program_counter + 4)
             m.d.sync += active.eq(1)
             
             m.d.sync += fetch.eq(0)
             
             # Fetch can occur while operation is running
-            # These all always take one cycle
-            for single in (Instruction.ARITH, Instruction.ARITHIMM, Instruction.AUIPC, Instruction.LUI, Instruction.JAL, Instruction.JALR):
+            # These all always take one cycle and don't change pc
+            for single in (Instruction.ARITH, Instruction.ARITHIMM, Instruction.AUIPC, Instruction.LUI):
                 with m.If(opcode == single):
                     m.d.sync += fetch.eq(1)
+                    
+            if self.simd:
+                for single in (Instruction.CUSTOM0, Instruction.CUSTOM1):
+                    with m.If(opcode == single):
+                        m.d.sync += fetch.eq(1)
+                        
+            if self.predict:
+                # Keep fetching down the predicted path
+                taken, offset = static_prediction(instruction_fetch)
+                with m.If(taken):
+                    m.d.sync += program_counter.eq(program_counter + offset)
+                with m.If((opcode == Instruction.BRANCH) | (opcode == Instruction.JAL)):
+                    m.d.sync += fetch.eq(1)
+                        
+            if self.muldiv:
+                # Except divide, which waits for the divider
+                with m.If((opcode == Instruction.ARITH) &
+                          (instruction_fetch.r.f_upper == 0b0000001) &
+                          instruction_fetch.r.f_lower[2]):
+                    m.d.sync += fetch.eq(0)
+                    
+        if self.interrupts:
+            m.d.comb += trap.eq(fetch_ok & interrupt_pending & trap_registers[Csr.MSTATUS][3])
+            with m.If(trap):
+                # Fetched instruction runs after the handler returns
+                m.d.sync += program_counter.eq(trap_registers[Csr.MTVEC])
+                m.d.sync += active.eq(0)
+                m.d.sync += fetch.eq(1)
                    
         self.debug = CoreDebug()
         
-        self.debug.pc = program_counter
+        self.debug.pc = current_pc
         self.debug.reg = reg
+        self.debug.retire = retire
+        self.debug.counters = counters
+        self.debug.trap = trap
+        self.debug.trap_registers = trap_registers
         self.instruction = instruction_fetch
         
         return m
-    
\ No newline at end of file
+        
+    def elaborate_pipelined(self, platform):
+        """
+        Four stage pipeline
+        
+        fetch -> decode -> execute -> writeback
+        
+        Results are forwarded from writeback to decode and execute,
+        so dependent instructions don't stall. Memory operations hold
+        execute until the bus transaction finishes while fetch keeps
+        running. Jumps and taken branches resolve in execute and
+        flush decode.
+        """
+        m = Module()
+        
+        bus, bus_empty = self.data_bus(m)
+        
+        # Pipeline registers
+        id_valid = Signal()
+        id_ir = Signal(risc_instruction_layout)
+        id_pc = Signal(32)
+        
+        ex_valid = Signal()
+        ex_ir = Signal(risc_instruction_layout)
+        ex_pc = Signal(32)
+        ex_a = Signal(signed(32))
+        ex_b = Signal(signed(32))
+        
+        wb_valid = Signal()
+        wb_rd = Signal(5)
+        wb_value = Signal(signed(32))
+        wb_retire = Signal()
+        wb_pc = Signal(32)
+        
+        # Hazard control
+        id_advance = Signal()
+        ex_done = Signal()
+        
+        redirect = Signal()
+        redirect_pc = Signal(32)
+        
+        m.d.comb += id_advance.eq(~ex_valid | ex_done)
+        
+        ####################
+        ## Fetch ###########
+        ####################
+        fetch_pc = Signal(32)
+        fetch_ok = Signal()
+        
+        # Redirect waiting on an outstanding fetch
+        pending = Signal()
+        pending_pc = Signal(32)
+        
+        fetch_ir = Signal(risc_instruction_layout)
+        m.d.comb += fetch_ir.eq(self.prog.r_data)
+        
+        m.d.comb += [
+            self.prog.addr.eq(fetch_pc),
+            self.prog.cyc.eq(~id_valid | id_advance),
+            self.prog.stb.eq(~id_valid | id_advance),
+            fetch_ok.eq(self.prog.cyc & self.prog.stb & self.prog.ack)
+        ]
+        
+        with m.If(fetch_ok):
+            with m.If(redirect):
+                m.d.sync += fetch_pc.eq(redirect_pc)
+            with m.Elif(pending):
+                # Instruction is from the wrong path, drop it
+                m.d.sync += fetch_pc.eq(pending_pc)
+                m.d.sync += pending.eq(0)
+            with m.Else():
+                m.d.sync += fetch_pc.eq(fetch_pc + 4)
+                if self.predict:
+                    taken, offset = static_prediction(fetch_ir)
+                    with m.If(taken):
+                        m.d.sync += fetch_pc.eq(fetch_pc + offset)
+        with m.Elif(redirect):
+            # Address has to be held until the fetch is acked
+            m.d.sync += pending.eq(1)
+            m.d.sync += pending_pc.eq(redirect_pc)
+        
+        with m.If(redirect):
+            m.d.sync += id_valid.eq(0)
+        with m.Elif(fetch_ok & ~pending):
+            m.d.sync += [
+                id_valid.eq(1),
+                id_ir.eq(self.prog.r_data),
+                id_pc.eq(fetch_pc)
+            ]
+        with m.Elif(id_advance):
+            m.d.sync += id_valid.eq(0)
+        
+        ####################
+        ## Decode ##########
+        ####################
+        if self.register_memory:
+            # Read operands of the instruction entering decode
+            rs1 = Mux(fetch_ok & ~pending, self.prog.r_data[15:20], id_ir.r.rs1)
+            rs2 = Mux(fetch_ok & ~pending, self.prog.r_data[20:25], id_ir.r.rs2)
+        else:
+            rs1 = id_ir.r.rs1
+            rs2 = id_ir.r.rs2
+            
+        src1, src2, reg = self.register_file(m, rs1, rs2, wb_rd, wb_value, wb_valid)
+        
+        def forward(index, value):
+            # Use result in writeback before it reaches register file
+            return Mux(wb_valid & (wb_rd == index), wb_value, value)
+        
+        with m.If(redirect):
+            m.d.sync += ex_valid.eq(0)
+        with m.Elif(id_advance):
+            m.d.sync += [
+                ex_valid.eq(id_valid),
+                ex_ir.eq(id_ir),
+                ex_pc.eq(id_pc),
+                ex_a.eq(forward(id_ir.r.rs1, src1)),
+                ex_b.eq(forward(id_ir.r.rs2, src2))
+            ]
+        
+        ####################
+        ## Execute #########
+        ####################
+        a = Signal(signed(32))
+        b = Signal(signed(32))
+        
+        m.d.comb += a.eq(forward(ex_ir.r.rs1, ex_a))
+        m.d.comb += b.eq(forward(ex_ir.r.rs2, ex_b))
+        
+        if self.muldiv:
+            divider = m.submodules.divider = Divider()
+            m.d.comb += [
+                divider.op.eq(ex_ir.r.f_lower[0:2]),
+                divider.a.eq(a),
+                divider.b.eq(b)
+            ]
+            
+        with m.If(~id_advance):
+            # Keep operands up to date while stalled
+            m.d.sync += ex_a.eq(a)
+            m.d.sync += ex_b.eq(b)
+        
+        imm_s = Signal(signed(12))
+        m.d.comb += imm_s.eq(Cat(ex_ir.s.imm_lower, ex_ir.s.imm_upper))
+        
+        branch_offset = Signal(signed(13))
+        m.d.comb += branch_offset.eq(b_offset(ex_ir))
+        
+        jal_offset = Signal(signed(21))
+        m.d.comb += jal_offset.eq(j_offset(ex_ir))
+        
+        shift_imm = ex_ir.i.imm[0:5].as_unsigned()
+        shift_reg = b[0:5]
+        
+        result = Signal(signed(32))
+        write = Signal()
+        
+        csr_value = Signal(32)
+        
+        # Memory access, one byte per transaction on a byte wide bus
+        mem_index = Signal(2)
+        mem_last = Signal()
+        mem_data = Signal(32)
+        mem_address = Signal(32)
+        load_data = Signal(32)
+        
+        # AMO writes back after its read, LR has reserved a word for SC
+        amo_write = Signal()
+        amo_value = Signal(32)
+        amo_old = Signal(32)
+        reserved = Signal()
+        reserved_address = Signal(30)
+        
+        with m.Switch(ex_ir.op):
+            with m.Case(Instruction.MEMORYSTORE):
+                m.d.comb += mem_address.eq(a + imm_s)
+            with m.Case(Instruction.AMO):
+                m.d.comb += mem_address.eq(a)
+            with m.Default():
+                m.d.comb += mem_address.eq(a + ex_ir.i.imm)
+        
+        if self.data_width == 8:
+            m.d.comb += bus.addr.eq(mem_address + mem_index)
+            m.d.comb += bus.w_data.eq(b.as_unsigned().word_select(mem_index, 8))
+            
+            # Data is shifted in from the top
+            m.d.comb += load_data.eq(Cat(mem_data[8:32], bus.r_data) >> ((3 - mem_index).as_unsigned() * 8))
+            
+            with m.Switch(ex_ir.i.f[0:2]):
+                with m.Case(0b00):
+                    m.d.comb += mem_last.eq(mem_index == 0)
+                with m.Case(0b01):
+                    m.d.comb += mem_last.eq(mem_index == 1)
+                with m.Default():
+                    m.d.comb += mem_last.eq(mem_index == 3)
+        else:
+            m.d.comb += [
+                bus.addr.eq(Cat(C(0, 2), mem_address[2:])),
+                bus.sel.eq(lane_select(ex_ir.i.f, mem_address[0:2])),
+                bus.w_data.eq(b << (mem_address[0:2] * 8)),
+                load_data.eq(bus.r_data >> (mem_address[0:2] * 8)),
+                mem_last.eq(1)
+            ]
+            
+        if self.atomics:
+            with m.If(ex_ir.op == Instruction.AMO):
+                if self.data_width == 8:
+                    m.d.comb += bus.w_data.eq(amo_value.word_select(mem_index, 8))
+                else:
+                    m.d.comb += bus.w_data.eq(amo_value)
+        
+        # Interrupt taken instead of the instruction entering execute
+        trap = Signal()
+        
+        if self.interrupts:
+            e_op = ex_valid & (ex_ir.op == Instruction.E)
+            system = ex_ir.as_value()[20:32]
+            trap_registers, interrupt_pending = self.trap_registers(
+                m, system, ex_ir.i.f, Mux(ex_ir.i.f[2], ex_ir.r.rs1, a),
+                e_op & ex_done & (ex_ir.i.f != 0),
+                csr_value, trap, id_pc,
+                e_op & (ex_ir.i.f == 0) & (system == SystemFunction.MRET)
+            )
+        else:
+            trap_registers = None
+            
+        with m.If(ex_valid):
+            m.d.comb += ex_done.eq(1)
+            with m.Switch(ex_ir.op):
+                with m.Case(Instruction.BRANCH):
+                    taken = Signal()
+                    with m.Switch(ex_ir.b.f):
+                        with m.Case(0b000):
+                            m.d.comb += taken.eq(a == b)
+                        with m.Case(0b001):
+                            m.d.comb += taken.eq(a != b)
+                        with m.Case(0b100):
+                            m.d.comb += taken.eq(a < b)
+                        with m.Case(0b101):
+                            m.d.comb += taken.eq(a >= b)
+                        with m.Case(0b110):
+                            m.d.comb += taken.eq(a.as_unsigned() < b.as_unsigned())
+                        with m.Case(0b111):
+                            m.d.comb += taken.eq(a.as_unsigned() >= b.as_unsigned())
+                    if self.predict:
+                        # Fetch went down the predicted path
+                        m.d.comb += redirect.eq(taken != ex_ir.b.offset_upper[6])
+                        m.d.comb += redirect_pc.eq(Mux(taken, ex_pc + branch_offset, ex_pc + 4))
+                    else:
+                        m.d.comb += redirect.eq(taken)
+                        m.d.comb += redirect_pc.eq(ex_pc + branch_offset)
+                with m.Case(Instruction.MEMORYLOAD):
+                    m.d.comb += [
+                        bus.cyc.eq(1),
+                        bus.stb.eq(1),
+                        ex_done.eq(bus.ack & mem_last),
+                        write.eq(1),
+                        result.eq(load_value(ex_ir.i.f, load_data))
+                    ]
+                    with m.If(bus.ack):
+                        m.d.sync += mem_data.eq(Cat(mem_data[8:32], bus.r_data))
+                        m.d.sync += mem_index.eq(Mux(mem_last, 0, mem_index + 1))
+                with m.Case(Instruction.MEMORYSTORE):
+                    m.d.comb += [
+                        bus.cyc.eq(1),
+                        bus.stb.eq(1),
+                        bus.w_en.eq(1),
+                        ex_done.eq(bus.ack & mem_last)
+                    ]
+                    with m.If(bus.ack):
+                        m.d.sync += mem_index.eq(Mux(mem_last, 0, mem_index + 1))
+                if self.atomics:
+                    with m.Case(Instruction.AMO):
+                        function = ex_ir.r.f_upper[2:7]
+                        sc = function == AtomicFunction.SC
+                        
+                        m.d.comb += [
+                            bus.lock.eq(1),
+                            bus.reserve.eq((function == AtomicFunction.LR) | sc),
+                            write.eq(1),
+                            result.eq(Mux(amo_write, Mux(sc, bus.fail, amo_old), Mux(sc, 1, load_data)))
+                        ]
+                        with m.If(~amo_write & sc):
+                            with m.If(reserved & (a[2:] == reserved_address)):
+                                m.d.comb += ex_done.eq(0)
+                                m.d.sync += amo_write.eq(1)
+                                m.d.sync += amo_value.eq(b)
+                            with m.Else():
+                                # Nothing reserved, SC fails without going to the bus
+                                m.d.sync += reserved.eq(0)
+                        with m.Elif(~amo_write):
+                            # Read the word
+                            m.d.comb += [
+                                bus.cyc.eq(1),
+                                bus.stb.eq(1),
+                                ex_done.eq(bus.ack & mem_last & (function == AtomicFunction.LR))
+                            ]
+                            with m.If(bus.ack):
+                                m.d.sync += mem_data.eq(Cat(mem_data[8:32], bus.r_data))
+                                m.d.sync += mem_index.eq(Mux(mem_last, 0, mem_index + 1))
+                                with m.If(mem_last & (function == AtomicFunction.LR)):
+                                    m.d.sync += reserved.eq(1)
+                                    m.d.sync += reserved_address.eq(a[2:])
+                                with m.Elif(mem_last):
+                                    # Bus stays locked for the write
+                                    m.d.sync += amo_write.eq(1)
+                                    m.d.sync += amo_value.eq(amo(function, load_data, b))
+                                    m.d.sync += amo_old.eq(load_data)
+                        with m.Else():
+                            m.d.comb += [
+                                bus.cyc.eq(1),
+                                bus.stb.eq(1),
+                                bus.w_en.eq(1),
+                                ex_done.eq(bus.ack & mem_last)
+                            ]
+                            with m.If(bus.ack):
+                                m.d.sync += mem_index.eq(Mux(mem_last, 0, mem_index + 1))
+                                with m.If(mem_last):
+                                    m.d.sync += amo_write.eq(0)
+                                    with m.If(sc):
+                                        m.d.sync += reserved.eq(0)
+                with m.Case(Instruction.ARITH):
+                    m.d.comb += write.eq(1)
+                    with m.If(ex_ir.r.f_upper == 0b0000001):
+                        if self.muldiv:
+                            with m.If(~ex_ir.r.f_lower[2]):
+                                m.d.comb += result.eq(multiply(ex_ir.r.f_lower, a, b))
+                            with m.Else():
+                                # Hold execute until divider is done
+                                m.d.comb += [
+                                    divider.start.eq(~divider.busy),
+                                    ex_done.eq(divider.done),
+                                    result.eq(divider.result)
+                                ]
+                        else:
+                            m.d.sync += Assert(0, "M extension not enabled")
+                    with m.Else():
+                        with m.Switch(ex_ir.r.f_lower):
+                            with m.Case(0b000):
+                                with m.If(ex_ir.r.f_upper == 0b0000000):
+                                    m.d.comb += result.eq(a + b)
+                                with m.Elif(ex_ir.r.f_upper == 0b0100000):
+                                    m.d.comb += result.eq(a - b)
+                                with m.Else():
+                                    m.d.sync += Assert(0, "Function not implemented")
+                            with m.Case(0b001):
+                                m.d.comb += result.eq(a << shift_reg)
+                            with m.Case(0b010):
+                                m.d.comb += result.eq(a < b)
+                            with m.Case(0b011):
+                                m.d.comb += result.eq(a.as_unsigned() < b.as_unsigned())
+                            with m.Case(0b100):
+                                m.d.comb += result.eq(a ^ b)
+                            with m.Case(0b101):
+                                with m.If(ex_ir.r.f_upper == 0b0100000):
+                                    m.d.comb += result.eq(a >> shift_reg)
+                                with m.Else():
+                                    m.d.comb += result.eq(a.as_unsigned() >> shift_reg)
+                            with m.Case(0b110):
+                                m.d.comb += result.eq(a | b)
+                            with m.Case(0b111):
+                                m.d.comb += result.eq(a & b)
+                with m.Case(Instruction.ARITHIMM):
+                    m.d.comb += write.eq(1)
+                    with m.Switch(ex_ir.i.f):
+                        with m.Case(0b000): # ADDI
+                            m.d.comb += result.eq(a + ex_ir.i.imm)
+                        with m.Case(0b010): # SLTI
+                            m.d.comb += result.eq(a < ex_ir.i.imm)
+                        with m.Case(0b011): # SLTIU
+                            m.d.comb += result.eq(a.as_unsigned() < ex_ir.i.imm.as_unsigned())
+                        with m.Case(0b100): # XORI
+                            m.d.comb += result.eq(a ^ ex_ir.i.imm)
+                        with m.Case(0b110): # ORI
+                            m.d.comb += result.eq(a | ex_ir.i.imm)
+                        with m.Case(0b111): # ANDI
+                            m.d.comb += result.eq(a & ex_ir.i.imm)
+                        with m.Case(0b001): # SLLI
+                            m.d.comb += result.eq(a << shift_imm)
+                        with m.Case(0b101):
+                            with m.If(ex_ir.as_value()[30]):
+                                # SRAI
+                                m.d.comb += result.eq(a >> shift_imm)
+                            with m.Else():
+                                # SRLI
+                                m.d.comb += result.eq(a.as_unsigned() >> shift_imm)
+                with m.Case(Instruction.CUSTOM0):
+                    if self.simd:
+                        with m.If(packed_defined(ex_ir.r.f_lower, ex_ir.r.f_upper)):
+                            m.d.comb += write.eq(1)
+                            m.d.comb += result.eq(packed(ex_ir.r.f_lower, a, b))
+                        with m.Else():
+                            m.d.sync += Assert(0, "Function not implemented")
+                with m.Case(Instruction.CUSTOM1):
+                    if self.simd:
+                        with m.If(scale_defined(ex_ir.i.f)):
+                            m.d.comb += write.eq(1)
+                            m.d.comb += result.eq(scale(ex_ir.i.imm, a))
+                        with m.Else():
+                            m.d.sync += Assert(0, "Function not implemented")
+                with m.Case(Instruction.LUI):
+                    m.d.comb += write.eq(1)
+                    m.d.comb += result.eq(ex_ir.u.imm << 12)
+                with m.Case(Instruction.AUIPC):
+                    m.d.comb += write.eq(1)
+                    m.d.comb += result.eq(ex_pc + (ex_ir.u.imm << 12))
+                with m.Case(Instruction.JAL):
+                    m.d.comb += [
+                        write.eq(1),
+                        result.eq(ex_pc + 4),
+                        redirect_pc.eq(ex_pc + jal_offset)
+                    ]
+                    if not self.predict:
+                        # Otherwise already taken at fetch
+                        m.d.comb += redirect.eq(1)
+                with m.Case(Instruction.JALR):
+                    m.d.comb += [
+                        write.eq(1),
+                        result.eq(ex_pc + 4),
+                        redirect.eq(1),
+                        redirect_pc.eq((a + ex_ir.i.imm) & ~1)
+                    ]
+                with m.Case(Instruction.FENCE):
+                    m.d.comb += ex_done.eq(bus_empty)
+                with m.Case(Instruction.E):
+                    if self.counters or self.interrupts:
+                        # Read counter, writes are ignored
+                        m.d.comb += write.eq(ex_ir.i.f != 0)
+                        m.d.comb += result.eq(csr_value)
+                    if self.interrupts:
+                        with m.If(ex_ir.i.f == 0):
+                            with m.Switch(ex_ir.as_value()[20:32]):
+                                with m.Case(SystemFunction.MRET):
+                                    m.d.comb += redirect.eq(1)
+                                    m.d.comb += redirect_pc.eq(trap_registers[Csr.MEPC])
+                                with m.Case(SystemFunction.WFI):
+                                    # Sleep until there is an interrupt
+                                    m.d.comb += ex_done.eq(interrupt_pending)
+                                    
+        if self.interrupts:
+            # Not while execute changes pc or trap registers, except wfi
+            control = Signal()
+            with m.Switch(ex_ir.op):
+                with m.Case(Instruction.BRANCH, Instruction.JAL, Instruction.JALR):
+                    m.d.comb += control.eq(1)
+                with m.Case(Instruction.E):
+                    m.d.comb += control.eq((ex_ir.i.f != 0) | (system != SystemFunction.WFI))
+                    
+            m.d.comb += trap.eq(interrupt_pending & trap_registers[Csr.MSTATUS][3] &
+                                id_valid & id_advance & ~(ex_valid & control))
+            with m.If(trap):
+                m.d.comb += redirect.eq(1)
+                m.d.comb += redirect_pc.eq(trap_registers[Csr.MTVEC])
+                
+        if self.counters:
+            # Counted in execute so a counter read sees every instruction before it
+            counters = self.performance_counters(m, bus, ex_valid & ex_done, ex_ir.as_value()[20:32], csr_value)
+        else:
+            counters = None
+            
+        ####################
+        ## Writeback #######
+        ####################
+        if self.register_memory:
+            # Nothing to write or forward for x0
+            write_back = write & (ex_ir.r.rd != 0)
+        else:
+            write_back = write
+            
+        # Trap shows after the instruction in execute retires
+        wb_trap = Signal()
+        
+        m.d.sync += [
+            wb_valid.eq(ex_valid & ex_done & write_back),
+            wb_rd.eq(ex_ir.r.rd),
+            wb_value.eq(result),
+            wb_retire.eq(ex_valid & ex_done),
+            wb_pc.eq(ex_pc),
+            wb_trap.eq(trap)
+        ]
+        
+        self.debug = CoreDebug()
+        
+        self.debug.pc = wb_pc
+        self.debug.reg = reg
+        self.debug.retire = wb_retire
+        self.debug.instruction = ex_ir
+        self.debug.counters = counters
+        self.debug.trap = wb_trap
+        self.debug.trap_registers = trap_registers
+        
+        return m
@@ -1,9 +1,15 @@
-from amaranth.lib import wiring
+from amaranth.lib import wiring, enum
 from amaranth.lib.wiring import In, Out
 
+class CycleType(enum.Enum, shape = 3):
+    CLASSIC   = 0b000
+    INCREMENT = 0b010 # Incrementing burst, next address follows
+    END       = 0b111 # Last beat of burst
+
 class Bus(wiring.Signature):
-    def __init__(self, address_shape, data_shape, dest_shape = 1, user = None):
-        super().__init__({
+    def __init__(self, address_shape, data_shape, dest_shape = 1, user = None, sel_shape = 0, burst = False,
+                 pipelined = False, atomic = False):
+        members = {
             "cyc": Out(1),
             "stb": Out(1),
             "ack": In(1),
@@ -12,7 +18,29 @@ class Bus(wiring.Signature):
             "w_data": Out(data_shape),
             "r_data": In(data_shape),
             "dest": In(dest_shape)
-        })
+        }
+        
+        # Byte enables, one per byte lane of data
+        if sel_shape:
+            members["sel"] = Out(sel_shape)
+            
+        # Registered feedback bursts
+        if burst:
+            members["cti"] = Out(CycleType)
+        
+        # Wishbone B4 pipelined, a request is taken every cycle
+        # stb is high without stall, acks follow in order
+        if pipelined:
+            members["stall"] = In(1)
+            
+        # RV32A, lock keeps the bus from the read to the write of an AMO,
+        # reserve marks LR and SC and fail acks an SC that lost its reservation
+        if atomic:
+            members["lock"] = Out(1)
+            members["reserve"] = Out(1)
+            members["fail"] = In(1)
+            
+        super().__init__(members)
         
 class Stream(wiring.Signature):
     def __init__(self, data_shape, user_shape = 1):
@@ -0,0 +1,62 @@
+"""
+Packed 4x8 bit pixel instructions
+
+custom-0 is R type, f selects the function.
+custom-1 is I type and scales each byte by a constant,
+imm[0:8] is the multiplier and imm[8:12] the right shift.
+"""
+from amaranth import *
+from amaranth.lib import enum
+
+class SimdFunction(enum.Enum, shape = 3):
+    UKADD8 = 0b000 # Add with unsigned saturation
+    UKSUB8 = 0b001 # Subtract with unsigned saturation
+    URADD8 = 0b010 # Average, rounds down
+    UMIN8  = 0b011
+    UMAX8  = 0b100
+    
+def lanes(function, *values):
+    """
+    Apply function to each byte of values
+    """
+    return Cat(*(function(*(v.as_unsigned().word_select(i, 8) for v in values)) for i in range(4)))
+    
+def saturate(x):
+    return Mux(x > 0xFF, 0xFF, x[0:8])
+    
+def packed_defined(f, f_upper):
+    """
+    custom-0 encoding is one of SimdFunction, the rest are illegal
+    """
+    return Cat(*(f == function for function in SimdFunction)).any() & (f_upper == 0)
+    
+def scale_defined(f):
+    """
+    custom-1 only has f 0
+    """
+    return f == 0
+    
+def packed(f, a, b):
+    """
+    Result of custom-0 function f, 0 if f is undefined
+    """
+    add = lanes(lambda x, y: saturate(x + y), a, b)
+    sub = lanes(lambda x, y: Mux(x < y, 0, (x - y)[0:8]), a, b)
+    average = lanes(lambda x, y: (x + y)[1:9], a, b)
+    low = lanes(lambda x, y: Mux(x < y, x, y), a, b)
+    high = lanes(lambda x, y: Mux(x < y, y, x), a, b)
+    
+    return Mux(f == SimdFunction.UKADD8, add,
+           Mux(f == SimdFunction.UKSUB8, sub,
+           Mux(f == SimdFunction.URADD8, average,
+           Mux(f == SimdFunction.UMIN8, low,
+           Mux(f == SimdFunction.UMAX8, high, 0)))))
+           
+def scale(imm, a):
+    """
+    Result of custom-1, multiply each byte by imm[0:8] >> imm[8:12]
+    """
+    k = imm.as_unsigned()[0:8]
+    shift = imm.as_unsigned()[8:12]
+    
+    return lanes(lambda x: saturate((x * k) >> shift), a)
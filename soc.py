@@ -0,0 +1,144 @@
+from amaranth import *
+from amaranth.lib import wiring
+from amaranth.lib.wiring import In, Out
+
+from signature import Stream
+from risc_core import RiscCore
+from cache import InstructionCache
+from delegate import Delegate
+from dma import Dma
+from framebuffer import FrameBuffer
+from switch import BusSwitch, SwitchPortDef, AddressDecoder
+from ram import WishboneMemory
+
+RAM_BASE      = 0x00000000
+FB_BASE       = 0x01000000
+DELEGATE_BASE = 0x02000000
+DMA_BASE      = 0x03000000
+
+def memory_map(ram_size, width, height):
+    """
+    Regions as (base, size, name), each a power of two so the decoder uses prefixes
+    """
+    fb_size = 1 << (width * height * 3 - 1).bit_length()
+    return [
+        (RAM_BASE, ram_size, "ram"),
+        (FB_BASE, fb_size, "fb"),
+        (DELEGATE_BASE, 8, "delegate"),
+        (DMA_BASE, 16, "dma")
+    ]
+    
+def forward(m, master, slave, dest):
+    """
+    Connect master to slave with dest set by the master side
+    """
+    m.d.comb += [
+        slave.cyc.eq(master.cyc),
+        slave.stb.eq(master.stb),
+        slave.addr.eq(master.addr),
+        slave.w_en.eq(master.w_en),
+        slave.w_data.eq(master.w_data),
+        slave.dest.eq(dest),
+        master.ack.eq(slave.ack),
+        master.r_data.eq(slave.r_data)
+    ]
+    
+class SoC(wiring.Component):
+    """
+    Cores sharing ram and a framebuffer
+    
+    Each core fetches through its own instruction cache and
+    has a delegate and a dma. Programs and data are in ram from
+    0, pixels are written through the framebuffer region and
+    streamed out on video. A dma sends from ram to the delegate
+    of the core numbered SEND_DEST, and signals its own core
+    on int when done. Delegates signal the core numbered
+    INTERRUPT_DEST on int.
+    """
+    def __init__(self, cores = 2, program = [], ram_size = 4096, width = 32, height = 32,
+                 sets = 4, ways = 2, line_size = 16, max_grant = 16, **core_kwargs):
+        if ram_size & (ram_size - 1):
+            raise ValueError("Ram size must be a power of two, not {}".format(ram_size))
+        if core_kwargs.get("data_width", 8) != 8:
+            raise ValueError("Cores share a byte wide bus")
+            
+        self.n = cores
+        self.ram_size = ram_size
+        
+        # Ram is shared by every fetch and data bus, inputs give way after max_grant cycles
+        self.max_grant = max_grant
+        
+        self.memory_map = memory_map(ram_size, width, height)
+        
+        image = [(p >> (8 * i)) & 0xFF for p in program for i in range(4)]
+        
+        self.ram = WishboneMemory(8, ram_size, init = image)
+        self.vram = WishboneMemory(8, width * height * 3)
+        self.fb = FrameBuffer(width = width, height = height)
+        
+        self.cores = [RiscCore(**core_kwargs) for _ in range(cores)]
+        self.caches = [InstructionCache(sets, ways, line_size) for _ in range(cores)]
+        
+        self.dest_shape = max((cores - 1).bit_length(), 1)
+        
+        self.delegates = [Delegate(dest_shape = self.dest_shape) for _ in range(cores)]
+        self.dmas = [Dma(self.dest_shape) for _ in range(cores)]
+        
+        super().__init__({
+            "video": Out(Stream(24))
+        })
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        m.submodules.ram = self.ram
+        m.submodules.vram = self.vram
+        m.submodules.fb = self.fb
+        
+        # Fetch, data and dma bus of each core
+        ram_switch = m.submodules.ram_switch = BusSwitch([SwitchPortDef(32, 8)], 1, 32, 8, num_inputs = 3 * self.n,
+                                                         max_grant = self.max_grant)
+        fb_switch = m.submodules.fb_switch = BusSwitch([SwitchPortDef(32, 8)], 1, 32, 8, num_inputs = self.n,
+                                                       max_grant = self.max_grant)
+                                                       
+        # Cores reach their own delegate, dmas any of them
+        delegate_switch = m.submodules.delegate_switch = BusSwitch([SwitchPortDef(32, 8) for _ in range(self.n)],
+                                                                   self.dest_shape, 32, 8, num_inputs = 2 * self.n,
+                                                                   crossbar = True)
+                                                                   
+        # Dma and delegate interrupts, each to the int of a core
+        int_switch = m.submodules.int_switch = BusSwitch([SwitchPortDef(32, 8) for _ in range(self.n)],
+                                                         self.dest_shape, 32, 8, num_inputs = 2 * self.n,
+                                                         crossbar = True)
+                                                         
+        wiring.connect(m, ram_switch.p_00, self.ram.bus)
+        wiring.connect(m, fb_switch.p_00, self.fb.consume)
+        wiring.connect(m, self.fb.ram, self.vram.bus)
+        wiring.connect(m, self.fb.produce, wiring.flipped(self.video))
+        
+        for i in range(self.n):
+            core = m.submodules["core{}".format(i)] = self.cores[i]
+            cache = m.submodules["cache{}".format(i)] = self.caches[i]
+            delegate = m.submodules["delegate{}".format(i)] = self.delegates[i]
+            dma = m.submodules["dma{}".format(i)] = self.dmas[i]
+            decoder = m.submodules["decoder{}".format(i)] = AddressDecoder(self.memory_map, 32, 8)
+            
+            wiring.connect(m, core.prog, cache.proc)
+            wiring.connect(m, cache.mem, getattr(ram_switch, "c_{:02X}".format(2 * i)))
+            
+            wiring.connect(m, core.bus, decoder.consume)
+            wiring.connect(m, decoder.ram, getattr(ram_switch, "c_{:02X}".format(2 * i + 1)))
+            wiring.connect(m, decoder.fb, getattr(fb_switch, "c_{:02X}".format(i)))
+            wiring.connect(m, decoder.dma, dma.bus)
+            wiring.connect(m, dma.mem, getattr(ram_switch, "c_{:02X}".format(2 * self.n + i)))
+            
+            forward(m, decoder.delegate, getattr(delegate_switch, "c_{:02X}".format(i)), i)
+            forward(m, dma.send, getattr(delegate_switch, "c_{:02X}".format(self.n + i)), dma.send.dest)
+            
+            wiring.connect(m, getattr(delegate_switch, "p_{:02X}".format(i)), delegate.bus)
+            
+            forward(m, dma.interrupt, getattr(int_switch, "c_{:02X}".format(i)), i)
+            forward(m, delegate.interrupt, getattr(int_switch, "c_{:02X}".format(self.n + i)), delegate.interrupt.dest)
+            wiring.connect(m, getattr(int_switch, "p_{:02X}".format(i)), core.int)
+            
+        return m
@@ -0,0 +1,133 @@
+from amaranth import *
+from amaranth.lib import wiring
+from amaranth.lib.wiring import In, Out
+
+from signature import Bus
+
+class StoreBufferDebug(object):
+    def __init__(self):
+        self.count = None
+        self.forwarded = None
+        
+class StoreBuffer(wiring.Component):
+    """
+    Posted write FIFO between a core and its data bus
+    
+    Writes are acked as soon as there is space and drained
+    to mem in order. Reads of an address with a buffered write
+    are forwarded from the newest one, or wait for it to drain
+    if it doesn't cover every byte read. Other reads wait for
+    every buffered write to drain, so reads of device registers
+    see the writes before them.
+    """
+    def __init__(self, depth = 4, data_width = 8, sel_shape = 0):
+        if depth < 1 or depth & (depth - 1):
+            raise ValueError("Store buffer depth must be a power of two, not {}".format(depth))
+            
+        self.depth = depth
+        self.data_width = data_width
+        self.sel_shape = sel_shape
+        
+        self.debug = StoreBufferDebug()
+        
+        super().__init__({
+            "proc": In(Bus(32, data_width, sel_shape = sel_shape)),
+            "mem": Out(Bus(32, data_width, sel_shape = sel_shape)),
+            "empty": Out(1)
+        })
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        addr = Array([Signal(32, name = "addr{}".format(i)) for i in range(self.depth)])
+        data = Array([Signal(self.data_width, name = "data{}".format(i)) for i in range(self.depth)])
+        sel = Array([Signal(max(self.sel_shape, 1), name = "sel{}".format(i)) for i in range(self.depth)])
+        
+        head = Signal(range(self.depth))
+        count = Signal(range(self.depth + 1))
+        
+        tail = Signal(range(self.depth))
+        m.d.comb += tail.eq(head + count)
+        
+        m.d.comb += self.empty.eq(count == 0)
+        
+        request = self.proc.cyc & self.proc.stb
+        
+        if self.sel_shape:
+            proc_sel = self.proc.sel
+        else:
+            proc_sel = C(1, 1)
+            
+        # Newest buffered write to the read address
+        match = Signal()
+        covered = Signal()
+        match_data = Signal(self.data_width)
+        
+        for k in range(self.depth):
+            slot = (head + k)[:len(head)]
+            with m.If((k < count) & (addr[slot] == self.proc.addr)):
+                m.d.comb += [
+                    match.eq(1),
+                    covered.eq((sel[slot] & proc_sel) == proc_sel),
+                    match_data.eq(data[slot])
+                ]
+                
+        push = Signal()
+        pop = Signal()
+        
+        # Read forwarded from buffer
+        forward = Signal()
+        m.d.comb += forward.eq(request & ~self.proc.w_en & match & covered)
+        
+        # Read goes to mem
+        read = Signal()
+        m.d.comb += read.eq(request & ~self.proc.w_en & ~match)
+        
+        with m.If(request & self.proc.w_en & (count != self.depth)):
+            m.d.comb += self.proc.ack.eq(1)
+            m.d.comb += push.eq(1)
+            m.d.sync += [
+                addr[tail].eq(self.proc.addr),
+                data[tail].eq(self.proc.w_data),
+                sel[tail].eq(proc_sel)
+            ]
+        with m.Elif(forward):
+            m.d.comb += self.proc.ack.eq(1)
+            m.d.comb += self.proc.r_data.eq(match_data)
+            
+        with m.If(read & (count == 0)):
+            # Reads go after buffered writes
+            m.d.comb += [
+                self.mem.cyc.eq(1),
+                self.mem.stb.eq(1),
+                self.mem.addr.eq(self.proc.addr),
+                self.proc.ack.eq(self.mem.ack),
+                self.proc.r_data.eq(self.mem.r_data)
+            ]
+            if self.sel_shape:
+                m.d.comb += self.mem.sel.eq(self.proc.sel)
+        with m.Elif(count != 0):
+            # Write at head of buffer is on mem, hold until acked
+            m.d.comb += [
+                self.mem.cyc.eq(1),
+                self.mem.stb.eq(1),
+                self.mem.w_en.eq(1),
+                self.mem.addr.eq(addr[head]),
+                self.mem.w_data.eq(data[head])
+            ]
+            if self.sel_shape:
+                m.d.comb += self.mem.sel.eq(sel[head])
+            with m.If(self.mem.ack):
+                m.d.comb += pop.eq(1)
+                m.d.sync += head.eq(head + 1)
+                
+        m.d.sync += count.eq(count + push - pop)
+        
+        forwarded = Signal(32)
+        with m.If(forward):
+            m.d.sync += forwarded.eq(forwarded + 1)
+            
+        self.debug.count = count
+        self.debug.forwarded = forwarded
+        
+        return m
@@ -1,18 +1,138 @@
 from amaranth import *
+from amaranth.utils import exact_log2
 from amaranth.lib import wiring, memory, enum
 from amaranth.lib.wiring import In, Out
 
-from signature import Bus
+from signature import Bus, CycleType
+from atomic import reservations
 
 class SwitchPortDef(object):
-    def __init__(self, addr, data):
+    def __init__(self, addr, data, sel = 0, burst = False):
         self.addr = addr
         self.data = data
+        self.sel = sel
+        self.burst = burst
 
+class BusRegister(wiring.Component):
+    """
+    Register slice, adds a cycle to the request and a cycle to the response
+    
+    Classic buses take one request at a time, pipelined buses
+    keep a request every cycle with a skid register for stalls
+    """
+    def __init__(self, addr = 32, data = 32, dest_shape = 1, sel = 0, pipelined = False):
+        self.sel = sel
+        self.pipelined = pipelined
+        
+        super().__init__({
+            "consume": In(Bus(addr, data, dest_shape, sel_shape = sel, pipelined = pipelined)),
+            "produce": Out(Bus(addr, data, dest_shape, sel_shape = sel, pipelined = pipelined))
+        })
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        fields = ["addr", "w_en", "w_data", "dest"]
+        if self.sel:
+            fields.append("sel")
+            
+        request = self.consume.cyc & self.consume.stb
+        
+        # Response
+        ack = Signal()
+        r_data = Signal.like(self.consume.r_data)
+        
+        m.d.comb += [
+            self.consume.ack.eq(ack),
+            self.consume.r_data.eq(r_data)
+        ]
+        
+        # Request on produce
+        active = Signal()
+        
+        for f in fields:
+            value = Signal.like(getattr(self.consume, f), name = "request_" + f)
+            m.d.comb += getattr(self.produce, f).eq(value)
+            
+            if self.pipelined:
+                skid = Signal.like(value, name = "skid_" + f)
+                with m.If(~active | ~self.produce.stall):
+                    m.d.sync += value.eq(Mux(self.consume.stall, skid, getattr(self.consume, f)))
+                with m.Elif(~self.consume.stall):
+                    m.d.sync += skid.eq(getattr(self.consume, f))
+            else:
+                with m.If(~active & ~ack & request):
+                    m.d.sync += value.eq(getattr(self.consume, f))
+                    
+        m.d.comb += self.produce.stb.eq(active)
+        
+        if self.pipelined:
+            # Request caught while produce was stalled
+            full = Signal()
+            m.d.comb += self.consume.stall.eq(full)
+            
+            with m.If(~active | ~self.produce.stall):
+                m.d.sync += [
+                    active.eq(full | request),
+                    full.eq(0)
+                ]
+            with m.Elif(request & ~full):
+                m.d.sync += full.eq(1)
+                
+            m.d.comb += self.produce.cyc.eq(self.consume.cyc | active)
+            
+            # Acks follow every cycle
+            m.d.sync += [
+                ack.eq(self.produce.ack),
+                r_data.eq(self.produce.r_data)
+            ]
+        else:
+            # Hold cyc so switches stay with this input
+            cyc = Signal()
+            m.d.sync += cyc.eq(self.consume.cyc)
+            m.d.comb += self.produce.cyc.eq(cyc | active)
+            
+            # Take the request once the last ack has been seen
+            with m.If(~active & ~ack & request):
+                m.d.sync += active.eq(1)
+            with m.If(active & self.produce.ack):
+                m.d.sync += [
+                    active.eq(0),
+                    r_data.eq(self.produce.r_data)
+                ]
+            m.d.sync += ack.eq(active & self.produce.ack)
+            
+        return m
+        
+def register(m, name, consume, addr = 32, data = 32, dest_shape = 1, sel = 0, pipelined = False):
+    """
+    Put a BusRegister after consume, returns the bus to use in its place
+    """
+    reg = m.submodules[name] = BusRegister(addr, data, dest_shape, sel, pipelined)
+    
+    fields = ["cyc", "stb", "addr", "w_en", "w_data", "dest"]
+    if sel:
+        fields.append("sel")
+    for f in fields:
+        m.d.comb += getattr(reg.consume, f).eq(getattr(consume, f))
+        
+    m.d.comb += [
+        consume.ack.eq(reg.consume.ack),
+        consume.r_data.eq(reg.consume.r_data)
+    ]
+    if pipelined:
+        m.d.comb += consume.stall.eq(reg.consume.stall)
+        
+    return reg.produce
+    
 class RangeToDest(wiring.Component):
-    def __init__(self, data_shape = 8, major = (16,32), minor = (0,16), dest_shape = 1):
+    def __init__(self, data_shape = 8, major = (16,32), minor = (0,16), dest_shape = 1, registered = False):
         self.major = major
         self.minor = minor
+        self.data_shape = data_shape
+        
+        # Register slice on consume
+        self.registered = registered
         
         super().__init__({
             "consume": In(Bus(32, data_shape)),
@@ -22,28 +142,36 @@ class RangeToDest(wiring.Component):
     def elaborate(self, platform):
         m = Module()
         
+        consume = self.consume
+        if self.registered:
+            consume = register(m, "register", self.consume, 32, self.data_shape)
+            
         m.d.comb += [
             # Split address and destination at points
-            self.produce.addr.eq(self.consume.addr[self.minor[0]:self.minor[1]]),
-            self.produce.dest.eq(self.consume.addr[self.major[0]:self.major[1]]),
+            self.produce.addr.eq(consume.addr[self.minor[0]:self.minor[1]]),
+            self.produce.dest.eq(consume.addr[self.major[0]:self.major[1]]),
             
             # Transaction
-            self.produce.stb.eq(self.consume.stb),
-            self.produce.cyc.eq(self.consume.cyc),
-            self.consume.ack.eq(self.produce.ack),
+            self.produce.stb.eq(consume.stb),
+            self.produce.cyc.eq(consume.cyc),
+            consume.ack.eq(self.produce.ack),
             
-            self.produce.w_en.eq(self.consume.w_en),
+            self.produce.w_en.eq(consume.w_en),
             
             # Data
-            self.produce.w_data.eq(self.consume.w_data),
-            self.consume.r_data.eq(self.produce.r_data)
+            self.produce.w_data.eq(consume.w_data),
+            consume.r_data.eq(self.produce.r_data)
         ]
         
         return m
 
 class DestToAddress(wiring.Component):
-    def __init__(self, shift = 16, dest_shape = 1):
+    def __init__(self, shift = 16, dest_shape = 1, registered = False):
         self.shift = shift
+        self.dest_shape = dest_shape
+        
+        # Register slice on consume
+        self.registered = registered
         
         super().__init__({
             "consume": In(Bus(32, 32, dest_shape = dest_shape)),
@@ -53,21 +181,25 @@ class DestToAddress(wiring.Component):
     def elaborate(self, platform):
         m = Module()
         
+        consume = self.consume
+        if self.registered:
+            consume = register(m, "register", self.consume, 32, 32, self.dest_shape)
+            
         m.d.comb += [
             # Split address and destination at points
-            self.produce.addr.eq(self.consume.addr + (self.consume.dest << self.shift)),
+            self.produce.addr.eq(consume.addr + (consume.dest << self.shift)),
             self.produce.dest.eq(0),
             
             # Transaction
-            self.produce.stb.eq(self.consume.stb),
-            self.produce.cyc.eq(self.consume.cyc),
-            self.consume.ack.eq(self.produce.ack),
+            self.produce.stb.eq(consume.stb),
+            self.produce.cyc.eq(consume.cyc),
+            consume.ack.eq(self.produce.ack),
             
-            self.produce.w_en.eq(self.consume.w_en),
+            self.produce.w_en.eq(consume.w_en),
             
             # Data
-            self.produce.w_data.eq(self.consume.w_data),
-            self.consume.r_data.eq(self.produce.r_data)
+            self.produce.w_data.eq(consume.w_data),
+            consume.r_data.eq(self.produce.r_data)
         ]
         
         return m
@@ -76,71 +208,253 @@ class BusDebug(object):
     def __init__(self, size = 2):
         self.cyc = [None for _ in range(size)]
         self.w_en = [None for _ in range(size)]
+        self.wait = [None for _ in range(size)]
         self.select = None
+        
+class Arbitration(enum.Enum):
+    ROUND_ROBIN = 0 # Next input in turn, after max_grant cycles
+    PRIORITY    = 1 # Lowest numbered input first
+    WEIGHTED    = 2 # Round robin, input i holds for weights[i] cycles
 
 class BusSwitch(wiring.Component):
-    def __init__(self, ports, dest_shape, addr = 16, data = 32, num_inputs = 2):
+    def __init__(self, ports, dest_shape, addr = 16, data = 32, num_inputs = 2, sel = 0, burst = False,
+                 pipelined = False, crossbar = False, arbitration = Arbitration.ROUND_ROBIN, max_grant = 0,
+                 weights = None, registered = False, atomic = False):
+        if atomic and (pipelined or registered):
+            raise ValueError("Atomic inputs need a classic bus without register slices")
+        if burst and registered:
+            # Slice takes one request at a time, a burst needs a beat every cycle
+            raise ValueError("Burst inputs can't go through register slices")
+            
         self.n = len(ports)
         
         self.num_inputs = num_inputs
         
+        self.ports = ports
+        self.sel = sel
+        self.burst = burst
+        
+        # Every input and port is Wishbone pipelined
+        self.pipelined = pipelined
+        
+        # Each port has its own select, inputs to different ports run at once
+        self.crossbar = crossbar
+        
+        # Register slice on each input
+        self.registered = registered
+        
+        # Inputs take lock and LR/SC, reservations are kept here for every port
+        self.atomic = atomic
+        self.addr = addr
+        self.data = data
+        self.dest_shape = dest_shape
+        
+        # Grant length in cycles for each input, 0 holds until cyc drops
+        self.arbitration = arbitration
+        if arbitration == Arbitration.WEIGHTED:
+            if weights is None or len(weights) != num_inputs:
+                raise ValueError("Weighted arbitration needs a weight for each of {} inputs".format(num_inputs))
+            self.limits = list(weights)
+        else:
+            self.limits = [max_grant for _ in range(num_inputs)]
+            
         p = dict()
         for i in range(len(ports)):
-            p["p_{:02X}".format(i)] = Out(Bus(ports[i].addr, ports[i].data))
+            p["p_{:02X}".format(i)] = Out(Bus(ports[i].addr, ports[i].data, sel_shape = ports[i].sel, burst = ports[i].burst,
+                                              pipelined = pipelined))
         
         c = dict()
         for i in range(num_inputs):
-            c["c_{:02X}".format(i)] = In(Bus(addr, data, dest_shape))
+            c["c_{:02X}".format(i)] = In(Bus(addr, data, dest_shape, sel_shape = sel, burst = burst, pipelined = pipelined,
+                                             atomic = atomic))
         
         super().__init__(c | p)
         
+    def connect(self, m, c, i, hold):
+        p = getattr(self, "p_{:02X}".format(i))
+        m.d.comb += [
+            p.stb.eq(c.stb),
+            p.cyc.eq(c.cyc),
+            c.ack.eq(p.ack),
+            p.addr.eq(c.addr),
+            p.w_en.eq(c.w_en),
+            p.w_data.eq(c.w_data),
+            c.r_data.eq(p.r_data)
+        ]
+        if self.ports[i].sel:
+            if self.sel:
+                m.d.comb += p.sel.eq(c.sel)
+            else:
+                # Full width access
+                m.d.comb += p.sel.eq(-1)
+        if self.ports[i].burst and self.burst:
+            m.d.comb += p.cti.eq(c.cti)
+        if self.pipelined:
+            m.d.comb += c.stall.eq(p.stall | hold)
+            with m.If(hold):
+                # Outstanding acks still come back
+                m.d.comb += p.stb.eq(0)
+                
+    def arbitrate(self, m, select, request, consume, name):
+        """
+        Move select on when the input drops its request, or when it
+        has to give way at the end of a transaction. Returns hold,
+        high while a pipelined input waits for its acks before giving way
+        """
+        c = Array(consume)[select]
+        
+        # Input has to give way
+        give = Signal(name = name + "_give")
+        
+        if any(self.limits):
+            grant = Signal(range(max(self.limits) + 1), name = name + "_grant")
+            limit = Array([C(l, len(grant)) for l in self.limits])[select]
+            with m.If((limit != 0) & (grant >= limit)):
+                m.d.comb += give.eq(1)
+            with m.Elif(Array(request)[select]):
+                m.d.sync += grant.eq(grant + 1)
+                
+        if self.arbitration == Arbitration.PRIORITY:
+            # Higher priority input waiting
+            for k in range(len(consume)):
+                with m.If((k < select) & request[k]):
+                    m.d.comb += give.eq(1)
+                    
+        if self.atomic:
+            # Never in the middle of an AMO
+            with m.If(c.lock):
+                m.d.comb += give.eq(0)
+                
+        hold = Signal(name = name + "_hold")
+        boundary = Signal(name = name + "_boundary")
+        
+        if self.pipelined:
+            pending = Signal(8, name = name + "_pending")
+            m.d.comb += hold.eq(give)
+            m.d.comb += boundary.eq((pending == 0) | ((pending == 1) & c.ack))
+            with m.If(Array(request)[select]):
+                m.d.sync += pending.eq(pending + (c.stb & ~c.stall) - c.ack)
+            with m.Else():
+                m.d.sync += pending.eq(0)
+        elif self.burst:
+            # Memory has read ahead for the next beat, only the last beat ends a burst
+            m.d.comb += boundary.eq(~c.stb | (c.ack & (c.cti != CycleType.INCREMENT)))
+        else:
+            # Between transactions, or the current one is finishing
+            m.d.comb += boundary.eq(~c.stb | c.ack)
+            
+        with m.If(~Array(request)[select] | (give & boundary)):
+            if self.arbitration == Arbitration.PRIORITY:
+                # Lowest numbered waiting input
+                for k in reversed(range(len(consume))):
+                    with m.If(request[k]):
+                        m.d.sync += select.eq(k)
+            else:
+                # Check other input
+                with m.If(select == len(consume) - 1):
+                    m.d.sync += select.eq(0)
+                with m.Else():
+                    m.d.sync += select.eq(select + 1)
+            if any(self.limits):
+                m.d.sync += grant.eq(0)
+                
+        return hold
+        
     def elaborate(self, platform):
         m = Module()
         
-        select = Signal(range(self.num_inputs))
-        
         consume = [getattr(self, "c_{:02X}".format(i)) for i in range(self.num_inputs)]
         
+        if self.registered:
+            consume = [register(m, "register_{:02X}".format(i), consume[i], self.addr, self.data, self.dest_shape,
+                                self.sel, self.pipelined) for i in range(self.num_inputs)]
+                                
         # For visualizing
-        self.debug = BusDebug()
+        self.debug = BusDebug(self.num_inputs)
         
         self.debug.cyc = [c.cyc for c in consume]
         self.debug.ack = [c.ack for c in consume]
         
         self.debug.w_en = [c.w_en for c in consume]
         
-        self.debug.select = select
-        
+        if self.pipelined:
+            # Inputs wait until they are connected
+            for c in consume:
+                m.d.comb += c.stall.eq(1)
+                
+        # Input is connected and able to make requests
+        granted = [Signal(name = "granted_{:02X}".format(i)) for i in range(self.num_inputs)]
+        
+        if self.crossbar:
+            selects = list()
+            for j in range(self.n):
+                select = Signal(range(self.num_inputs), name = "select_{:02X}".format(j))
+                selects.append(select)
+                request = [c.cyc & (c.dest == j) for c in consume]
+                hold = self.arbitrate(m, select, request, consume, "port_{:02X}".format(j))
+                for i in range(len(consume)):
+                    c = consume[i]
+                    with m.If((select == i) & request[i]):
+                        self.connect(m, c, j, hold)
+                        m.d.comb += granted[i].eq(~hold)
+                                
+            self.debug.select = selects
+        else:
+            select = Signal(range(self.num_inputs))
+            
+            self.debug.select = select
+            
+            hold = self.arbitrate(m, select, [c.cyc for c in consume], consume, "switch")
+            
+            for i in range(len(consume)):
+                c = consume[i]
+                with m.If(select == i):
+                    m.d.comb += granted[i].eq(~hold)
+                    with m.Switch(c.dest):
+                        # Connect
+                        for i in range(self.n):
+                            with m.Case(i):
+                                self.connect(m, c, i, hold)
+                                
+        # Cycles spent waiting for the switch
         for i in range(len(consume)):
             c = consume[i]
-            with m.If(select == i):
-                with m.If(~c.cyc):
-                    # Check other input
-                    with m.If(select == len(consume) - 1):
-                        m.d.sync += select.eq(0)
-                    with m.Else():
-                        m.d.sync += select.eq(select + 1)
-                with m.Switch(c.dest):
-                    # Connect
-                    for i in range(self.n):
-                        with m.Case(i):
-                            p = getattr(self, "p_{:02X}".format(i))
-                            m.d.comb += [
-                                p.stb.eq(c.stb),
-                                p.cyc.eq(c.cyc),
-                                c.ack.eq(p.ack),
-                                p.addr.eq(c.addr),
-                                p.w_en.eq(c.w_en),
-                                p.w_data.eq(c.w_data),
-                                c.r_data.eq(p.r_data)
-                            ]
+            wait = Signal(32, name = "wait_{:02X}".format(i))
+            with m.If(c.cyc & c.stb & ~granted[i]):
+                m.d.sync += wait.eq(wait + 1)
+            self.debug.wait[i] = wait
+            
+        if self.atomic:
+            failed = [Signal(name = "failed_{:02X}".format(i)) for i in range(self.num_inputs)]
+            
+            held = reservations(m, "reservation", [Cat(c.addr[2:], c.dest) for c in consume],
+                                 [c.ack & ~c.w_en & c.reserve for c in consume],
+                                 [c.ack & c.w_en & ~failed[i] for i, c in enumerate(consume)])
+                                 
+            # Store conditional without its reservation is acked here and goes no further
+            for i in range(len(consume)):
+                c = consume[i]
+                m.d.comb += failed[i].eq(c.cyc & c.stb & c.w_en & c.reserve & ~held[i])
+                with m.If(failed[i]):
+                    m.d.comb += c.ack.eq(1)
+                    m.d.comb += c.fail.eq(1)
+                    
+            selects = self.debug.select if self.crossbar else [self.debug.select] * self.n
+            for j in range(self.n):
+                p = getattr(self, "p_{:02X}".format(j))
+                with m.If(Array(failed)[selects[j]]):
+                    m.d.comb += p.stb.eq(0)
+                    m.d.comb += p.w_en.eq(0)
         
         return m
         
 class AddressSwitch(wiring.Component):
-    def __init__(self, split = 256):
+    def __init__(self, split = 256, registered = False):
         self.split = split
         
+        # Register slice on consume
+        self.registered = registered
+        
         super().__init__({
             "consume": In(Bus(32, 32)),
             "a": Out(Bus(32, 32)),
@@ -150,40 +464,158 @@ class AddressSwitch(wiring.Component):
     def elaborate(self, platform):
         m = Module()
         
+        consume = self.consume
+        if self.registered:
+            consume = register(m, "register", self.consume)
+            
         anb = Signal()
         
-        m.d.comb += anb.eq(self.consume.addr < self.split)
+        m.d.comb += anb.eq(consume.addr < self.split)
         
         b_address = Signal(32)
         
-        m.d.comb += b_address.eq(self.consume.addr - self.split)
+        m.d.comb += b_address.eq(consume.addr - self.split)
         
         m.d.comb += [
-            self.a.addr.eq(self.consume.addr),
-            self.a.w_en.eq(self.consume.w_en),
-            self.a.w_data.eq(self.consume.w_data)
+            self.a.addr.eq(consume.addr),
+            self.a.w_en.eq(consume.w_en),
+            self.a.w_data.eq(consume.w_data)
         ]
         
         m.d.comb += [
             self.b.addr.eq(b_address),
-            self.b.w_en.eq(self.consume.w_en),
-            self.b.w_data.eq(self.consume.w_data)
+            self.b.w_en.eq(consume.w_en),
+            self.b.w_data.eq(consume.w_data)
         ]
         
         # Direct to a or b
         with m.If(anb):
             m.d.comb += [
-                self.a.stb.eq(self.consume.stb),
-                self.a.cyc.eq(self.consume.cyc),
-                self.consume.ack.eq(self.a.ack),
-                self.consume.r_data.eq(self.a.r_data)
+                self.a.stb.eq(consume.stb),
+                self.a.cyc.eq(consume.cyc),
+                consume.ack.eq(self.a.ack),
+                consume.r_data.eq(self.a.r_data)
             ]
         with m.Else():
             m.d.comb += [
-                self.b.stb.eq(self.consume.stb),
-                self.b.cyc.eq(self.consume.cyc),
-                self.consume.ack.eq(self.b.ack),
-                self.consume.r_data.eq(self.b.r_data)
+                self.b.stb.eq(consume.stb),
+                self.b.cyc.eq(consume.cyc),
+                consume.ack.eq(self.b.ack),
+                consume.r_data.eq(self.b.r_data)
             ]
         
-        return m
\ No newline at end of file
+        return m
+        
+class AddressDecoder(wiring.Component):
+    """
+    Memory map, one port for each (base, size, name) region
+    
+    Regions aligned to a power of two size are decoded on the
+    address prefix, otherwise a balanced tree of compares picks
+    the region. Addresses outside every region are acked with 0
+    """
+    def __init__(self, regions, addr = 32, data = 32, sel = 0, strip = True, registered = False):
+        self.regions = sorted(regions, key = lambda r: r[0])
+        
+        for i in range(len(self.regions)):
+            base, size, name = self.regions[i]
+            if size <= 0:
+                raise ValueError("Region {} is empty".format(name))
+            if i > 0 and self.regions[i - 1][0] + self.regions[i - 1][1] > base:
+                raise ValueError("Region {} overlaps {}".format(name, self.regions[i - 1][2]))
+                
+        self.addr = addr
+        self.data = data
+        self.sel = sel
+        
+        # Ports see addresses from 0
+        self.strip = strip
+        
+        # Register slice on consume
+        self.registered = registered
+        
+        # Every region is a power of two size, aligned to its size
+        self.aligned = all(size & (size - 1) == 0 and base % size == 0 for base, size, _ in self.regions)
+        
+        ports = dict()
+        for base, size, name in self.regions:
+            ports[name] = Out(Bus(addr, data, sel_shape = sel))
+            
+        super().__init__({
+            "consume": In(Bus(addr, data, sel_shape = sel))
+        } | ports)
+        
+    def tree(self, m, index, addr, regions):
+        # Split on the middle base, compare bounds at the leaf
+        if len(regions) == 1:
+            i, (base, size, _) = regions[0]
+            with m.If((addr >= base) & (addr < base + size)):
+                m.d.comb += index.eq(i)
+            return
+        mid = len(regions) // 2
+        with m.If(addr < regions[mid][1][0]):
+            self.tree(m, index, addr, regions[:mid])
+        with m.Else():
+            self.tree(m, index, addr, regions[mid:])
+            
+    def elaborate(self, platform):
+        m = Module()
+        
+        consume = self.consume
+        if self.registered:
+            consume = register(m, "register", self.consume, self.addr, self.data, sel = self.sel)
+            
+        n = len(self.regions)
+        
+        # Region of the request, n if unmapped
+        index = Signal(range(n + 1))
+        
+        if self.aligned:
+            hits = list()
+            for i, (base, size, name) in enumerate(self.regions):
+                bits = exact_log2(size)
+                hit = Signal(name = "hit_" + name)
+                m.d.comb += hit.eq(consume.addr[bits:] == (base >> bits))
+                hits.append(hit)
+            # Regions don't overlap, so at most one hits
+            with m.If(~Cat(*hits).any()):
+                m.d.comb += index.eq(n)
+            with m.Else():
+                for i, hit in enumerate(hits):
+                    with m.If(hit):
+                        m.d.comb += index.eq(i)
+        else:
+            m.d.comb += index.eq(n)
+            self.tree(m, index, consume.addr, list(enumerate(self.regions)))
+            
+        for i, (base, size, name) in enumerate(self.regions):
+            p = getattr(self, name)
+            
+            if not self.strip:
+                offset = consume.addr
+            elif self.aligned:
+                offset = consume.addr[:exact_log2(size)]
+            else:
+                offset = consume.addr - base
+                
+            m.d.comb += [
+                p.addr.eq(offset),
+                p.w_en.eq(consume.w_en),
+                p.w_data.eq(consume.w_data)
+            ]
+            if self.sel:
+                m.d.comb += p.sel.eq(consume.sel)
+                
+            with m.If(index == i):
+                m.d.comb += [
+                    p.stb.eq(consume.stb),
+                    p.cyc.eq(consume.cyc),
+                    consume.ack.eq(p.ack),
+                    consume.r_data.eq(p.r_data)
+                ]
+                
+        with m.If(index == n):
+            # Nothing mapped here
+            m.d.comb += consume.ack.eq(consume.cyc & consume.stb)
+            
+        return m
@@ -0,0 +1,233 @@
+import unittest
+from amaranth.sim import *
+from amaranth.lib import wiring
+from amaranth import *
+
+from bus_sim import *
+from cache import InstructionCache, DataCache
+import ram
+
+def cache_with_memory(contents, mem_width = 8, burst = False, pipelined = False, **kwargs):
+    m = Module()
+    
+    cache = m.submodules.cache = InstructionCache(mem_width = mem_width, burst = burst, pipelined = pipelined, **kwargs)
+    
+    if mem_width == 8:
+        mem = m.submodules.mem = ram.WishboneMemory(8, len(contents), init = contents, burst = burst,
+                                                    pipelined = pipelined)
+    else:
+        words = [int.from_bytes(bytes(contents[i:i + 4]), "little") for i in range(0, len(contents), 4)]
+        mem = m.submodules.mem = ram.WishboneMemory(32, len(words), init = words, granularity = 2, burst = burst,
+                                                    pipelined = pipelined)
+    
+    wiring.connect(m, cache.mem, mem.bus)
+    
+    return m, cache, mem
+    
+def data_cache_with_memory(contents, width = 8, **kwargs):
+    m = Module()
+    
+    cache = m.submodules.cache = DataCache(data_width = width, mem_width = width, **kwargs)
+    
+    if width == 8:
+        mem = m.submodules.mem = ram.WishboneMemory(8, len(contents), init = contents)
+    else:
+        words = [int.from_bytes(bytes(contents[i:i + 4]), "little") for i in range(0, len(contents), 4)]
+        mem = m.submodules.mem = ram.WishboneMemory(32, len(words), init = words, granularity = 2, byte_select = True)
+        
+    wiring.connect(m, cache.mem, mem.bus)
+    
+    return m, cache, mem
+    
+async def access(ctx, port, addr, data = None):
+    """
+    Single load or store, returns read data and cycles to ack
+    """
+    ctx.set(port.addr, addr)
+    ctx.set(port.stb, 1)
+    ctx.set(port.cyc, 1)
+    ctx.set(port.w_en, data is not None)
+    if data is not None:
+        ctx.set(port.w_data, data)
+    count = 0
+    while not ctx.get(port.ack):
+        count += 1
+        await ctx.tick()
+    r_data = ctx.get(port.r_data)
+    await ctx.tick()
+    ctx.set(port.stb, 0)
+    ctx.set(port.cyc, 0)
+    ctx.set(port.w_en, 0)
+    return r_data, count
+    
+def word(addr):
+    return (addr * 0x01010101 + 0x03020100) & 0xFFFFFFFF
+    
+class TestInstructionCache(unittest.TestCase):
+    def test_loop_hits(self):
+        contents = [i & 0xFF for i in range(64)]
+        
+        dut, cache, mem = cache_with_memory(contents)
+        
+        async def bench(ctx):
+            for first in (True, False, False):
+                refills = 0
+                for addr in range(0, 32, 4):
+                    ctx.set(cache.proc.addr, addr)
+                    ctx.set(cache.proc.stb, 1)
+                    ctx.set(cache.proc.cyc, 1)
+                    while not ctx.get(cache.proc.ack):
+                        refills += ctx.get(mem.bus.ack)
+                        await ctx.tick()
+                    assert ctx.get(cache.proc.r_data) == word(addr)
+                    await ctx.tick()
+                    
+                # Only the first pass goes to memory
+                if first:
+                    assert refills == 32
+                else:
+                    assert refills == 0
+                    
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_replace_least_recent(self):
+        contents = [i & 0xFF for i in range(64)]
+        
+        # Single set, every line conflicts
+        dut, cache, mem = cache_with_memory(contents, sets = 1, ways = 2, line_size = 4)
+        
+        async def bench(ctx):
+            for addr, hit in ((0, 0), (4, 0), (0, 1), (8, 0), (0, 1), (4, 0)):
+                ctx.set(cache.proc.addr, addr)
+                ctx.set(cache.proc.stb, 1)
+                ctx.set(cache.proc.cyc, 1)
+                assert ctx.get(cache.proc.ack) == hit
+                data = await single_read(ctx, cache.proc, addr)
+                assert data == word(addr)
+                
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_refill_width(self):
+        contents = [i & 0xFF for i in range(64)]
+        
+        # Cycles to refill a four word line
+        for mem_width, burst, pipelined, cycles in ((8, False, False, 33), (8, True, False, 18), (8, False, True, 18),
+                                                    (32, False, False, 9), (32, True, False, 6), (32, False, True, 6)):
+            dut, cache, mem = cache_with_memory(contents, mem_width, burst, pipelined)
+            
+            async def bench(ctx):
+                ctx.set(cache.proc.addr, 16)
+                ctx.set(cache.proc.stb, 1)
+                ctx.set(cache.proc.cyc, 1)
+                
+                count = 0
+                while not ctx.get(cache.proc.ack):
+                    count += 1
+                    await ctx.tick()
+                assert count == cycles
+                
+                for addr in range(16, 32, 4):
+                    ctx.set(cache.proc.addr, addr)
+                    assert ctx.get(cache.proc.ack)
+                    assert ctx.get(cache.proc.r_data) == word(addr)
+                    
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+        
+class TestDataCache(unittest.TestCase):
+    def test_write_back(self):
+        contents = [i & 0xFF for i in range(128)]
+        
+        # One way of two lines, so 0 and 32 replace each other
+        dut, cache, mem = data_cache_with_memory(contents, sets = 2, ways = 1)
+        
+        async def bench(ctx):
+            _, count = await access(ctx, cache.proc, 1, 0xAA)
+            assert count > 0
+            data, count = await access(ctx, cache.proc, 1)
+            assert (data, count) == (0xAA, 0)
+            data, count = await access(ctx, cache.proc, 2)
+            assert (data, count) == (2, 0)
+            
+            # Dirty line is written back before the refill
+            data, _ = await access(ctx, cache.proc, 33)
+            assert data == 33
+            assert ctx.get(cache.debug.writebacks) == 1
+            
+            data, _ = await access(ctx, cache.proc, 1)
+            assert data == 0xAA
+            
+            # Clean line isn't written back
+            await access(ctx, cache.proc, 32)
+            assert ctx.get(cache.debug.writebacks) == 1
+            assert ctx.get(cache.debug.hits) == 2
+            assert ctx.get(cache.debug.misses) == 4
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_flush(self):
+        contents = [i & 0xFF for i in range(128)]
+        
+        dut, cache, mem = data_cache_with_memory(contents, width = 32)
+        
+        async def bench(ctx):
+            ctx.set(cache.proc.sel, 0b1111)
+            for addr in (0, 20, 36, 100):
+                await access(ctx, cache.proc, addr, 0x1000 + addr)
+                
+            ctx.set(cache.proc.sel, 0b0010)
+            await access(ctx, cache.proc, 64, 0xBB00)
+            ctx.set(cache.proc.sel, 0b1111)
+            
+            # Invalidate drops the line without writing it back
+            ctx.set(cache.invalidate, 1)
+            await ctx.tick()
+            ctx.set(cache.invalidate, 0)
+            data, _ = await access(ctx, cache.proc, 100)
+            assert data == word(100)
+            
+            for addr in (0, 20, 36):
+                await access(ctx, cache.proc, addr, 0x2000 + addr)
+            ctx.set(cache.proc.sel, 0b0010)
+            await access(ctx, cache.proc, 64, 0xBB00)
+            ctx.set(cache.proc.sel, 0b1111)
+            
+            ctx.set(cache.flush, 1)
+            await ctx.tick()
+            ctx.set(cache.flush, 0)
+            while ctx.get(cache.busy):
+                await ctx.tick()
+            assert ctx.get(cache.debug.writebacks) == 4
+            
+            # Everything is read back from memory
+            misses = ctx.get(cache.debug.misses)
+            for addr in (0, 20, 36):
+                data, _ = await access(ctx, cache.proc, addr)
+                assert data == 0x2000 + addr
+            data, _ = await access(ctx, cache.proc, 64)
+            assert data == (word(64) & 0xFFFF00FF) | 0xBB00
+            assert ctx.get(cache.debug.misses) == misses + 4
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+if __name__ == "__main__":
+    unittest.main()
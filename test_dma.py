@@ -0,0 +1,161 @@
+import unittest
+from amaranth.sim import *
+from amaranth.lib import wiring
+from amaranth import *
+
+from dma import Dma
+from delegate import Delegate
+from risc_core import Registers
+from test_risc_core import InstructionBuilder, core_with_program
+import ram
+
+def dma_with_delegate(contents):
+    m = Module()
+    
+    dma = m.submodules.dma = Dma()
+    mem = m.submodules.mem = ram.WishboneMemory(8, len(contents), init = contents)
+    delegate = m.submodules.delegate = Delegate()
+    
+    wiring.connect(m, dma.mem, mem.bus)
+    
+    m.d.comb += [
+        delegate.bus.cyc.eq(dma.send.cyc),
+        delegate.bus.stb.eq(dma.send.stb),
+        delegate.bus.addr.eq(dma.send.addr),
+        delegate.bus.w_en.eq(dma.send.w_en),
+        delegate.bus.w_data.eq(dma.send.w_data),
+        dma.send.ack.eq(delegate.bus.ack)
+    ]
+    
+    return m, dma, delegate
+    
+async def write_register(ctx, dma, register, value):
+    # Low byte first like a store from the core, the high byte starts the transfer
+    for lane in range(4):
+        ctx.set(dma.bus.addr, register.value * 4 + lane)
+        ctx.set(dma.bus.w_data, (value >> (8 * lane)) & 0xFF)
+        ctx.set(dma.bus.w_en, 1)
+        ctx.set(dma.bus.stb, 1)
+        ctx.set(dma.bus.cyc, 1)
+        await ctx.tick()
+    ctx.set(dma.bus.stb, 0)
+    ctx.set(dma.bus.cyc, 0)
+    ctx.set(dma.bus.w_en, 0)
+    
+async def read_register(ctx, dma, register):
+    value = 0
+    for lane in range(4):
+        ctx.set(dma.bus.addr, register.value * 4 + lane)
+        ctx.set(dma.bus.stb, 1)
+        ctx.set(dma.bus.cyc, 1)
+        value |= ctx.get(dma.bus.r_data) << (8 * lane)
+        await ctx.tick()
+    ctx.set(dma.bus.stb, 0)
+    ctx.set(dma.bus.cyc, 0)
+    return value
+    
+class TestDma(unittest.TestCase):
+    def test_send(self):
+        contents = [0x40 + i for i in range(32)]
+        dut, dma, delegate = dma_with_delegate(contents)
+        
+        async def bench(ctx):
+            await write_register(ctx, dma, Registers.SEND_DEST, 0)
+            await write_register(ctx, dma, Registers.SEND_BUF, 5)
+            await write_register(ctx, dma, Registers.SEND_SIZE, 12)
+            
+            # Bytes taken by the delegate, in order
+            received = list()
+            count = 0
+            while not ctx.get(dma.interrupt.stb):
+                if ctx.get(dma.send.stb & delegate.bus.ack):
+                    received.append(ctx.get(dma.send.w_data))
+                count += 1
+                await ctx.tick()
+            assert ctx.get(dma.interrupt.w_data) == 0x02
+            assert received == contents[5:17]
+            assert ctx.get(delegate.level) == 12
+            # Reads run while earlier bytes are sent, two cycles for each read from mem
+            assert count <= 12 * 2 + 2
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_busy(self):
+        contents = [0x40 + i for i in range(32)]
+        dut, dma, delegate = dma_with_delegate(contents)
+        
+        async def bench(ctx):
+            await write_register(ctx, dma, Registers.SEND_BUF, 2)
+            await write_register(ctx, dma, Registers.SEND_SIZE, 8)
+            
+            # Writes while busy are ignored
+            await write_register(ctx, dma, Registers.SEND_BUF, 20)
+            await write_register(ctx, dma, Registers.SEND_SIZE, 3)
+            assert await read_register(ctx, dma, Registers.SEND_SIZE) >> 31 == 1
+            
+            while not ctx.get(dma.interrupt.stb):
+                await ctx.tick()
+            assert received == contents[2:10]
+            assert await read_register(ctx, dma, Registers.SEND_SIZE) == 0
+            
+        received = list()
+        
+        async def collect(ctx):
+            done = 0
+            while not done:
+                _, _, stb, ack, data, done = await ctx.tick().sample(dma.send.stb, delegate.bus.ack, dma.send.w_data,
+                                                                     dma.interrupt.stb)
+                if stb and ack:
+                    received.append(data)
+                    
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        sim.add_testbench(collect)
+        
+        sim.run()
+        
+    def test_core(self):
+        # Size over a byte from a store word, its low byte alone is 0
+        size = 0x100
+        contents = [i & 0xFF for i in range(512)]
+        
+        prog = [
+            InstructionBuilder.addi(size, 0, 1),
+            InstructionBuilder.storeword(Registers.SEND_SIZE.value * 4, 1, 0),
+            InstructionBuilder.jal(0)
+        ]
+        
+        dut, core, _ = core_with_program([p.value() for p in prog])
+        
+        dma = dut.submodules.dma = Dma()
+        mem = dut.submodules.mem = ram.WishboneMemory(8, len(contents), init = contents)
+        
+        wiring.connect(dut, core.bus, dma.bus)
+        wiring.connect(dut, dma.mem, mem.bus)
+        
+        async def bench(ctx):
+            ctx.set(dma.send.ack, 1)
+            
+            received = list()
+            for _ in range(size * 4):
+                if ctx.get(dma.interrupt.stb):
+                    break
+                if ctx.get(dma.send.stb):
+                    received.append(ctx.get(dma.send.w_data))
+                await ctx.tick()
+            assert ctx.get(dma.interrupt.stb)
+            assert received == contents[:size]
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,514 @@
+import unittest
+from amaranth.sim import *
+
+from emulator import Emulator, IllegalInstruction, lockstep
+from risc_core import Csr, INTERRUPT_CAUSE
+from test_risc_core import InstructionBuilder, core_with_memory, core_with_unified_memory, cores_with_banked_memory
+
+def mixed_program():
+    prog = list()
+    
+    prog.append(InstructionBuilder.lui(0x12345, 1))
+    prog.append(InstructionBuilder.addi(0x678, 1, 1))
+    prog.append(InstructionBuilder.auipc(1, 2))
+    prog.append(InstructionBuilder.i(0x404, 1, 0b101, 3, 0b0010011)) # SRAI
+    prog.append(InstructionBuilder.i(3, 1, 0b001, 4, 0b0010011))     # SLLI
+    prog.append(InstructionBuilder.sub(1, 4, 5))
+    prog.append(InstructionBuilder.r(0, 4, 1, 0b011, 6))             # SLTU
+    prog.append(InstructionBuilder.r(0, 5, 1, 0b100, 7))             # XOR
+    
+    # Loop five times
+    prog.append(InstructionBuilder.addi(5, 0, 8))
+    prog.append(InstructionBuilder.addi(3, 9, 9))
+    prog.append(InstructionBuilder.addi(-1, 8, 8))
+    prog.append(InstructionBuilder.bne(-8, 0, 8))
+    
+    prog.append(InstructionBuilder.storeword(128, 1, 0))
+    prog.append(InstructionBuilder.load(129, 0, 10, 0b000))         # LB
+    prog.append(InstructionBuilder.load(130, 0, 11, 0b101))         # LHU
+    
+    # Jump over one instruction, then back through a register
+    prog.append(InstructionBuilder.jal(8, 12))
+    prog.append(InstructionBuilder.addi(1, 0, 13))
+    prog.append(InstructionBuilder.jalr(8, 12, 14))
+    prog.append(InstructionBuilder.r(0, 11, 10, 0b110, 15))         # OR
+    prog.append(InstructionBuilder.beq(0, 0, 0))
+    
+    return [p.value() for p in prog]
+    
+def muldiv_program():
+    prog = list()
+    
+    prog.append(InstructionBuilder.lui(0x87654, 1))
+    prog.append(InstructionBuilder.addi(0x321, 1, 1))
+    prog.append(InstructionBuilder.addi(-7, 0, 2))
+    
+    # Every M function, then using the result straight away
+    for f in range(8):
+        prog.append(InstructionBuilder.r(0b0000001, 2, 1, f, 3 + f))
+        prog.append(InstructionBuilder.add(3 + f, 2, 2))
+        
+    prog.append(InstructionBuilder.r(0b0000001, 0, 1, 0b100, 11))    # DIV by zero
+    prog.append(InstructionBuilder.r(0b0000001, 0, 1, 0b111, 12))    # REMU by zero
+    prog.append(InstructionBuilder.beq(0, 0, 0))
+    
+    return [p.value() for p in prog]
+    
+def simd_program():
+    prog = list()
+    
+    prog.append(InstructionBuilder.lui(0xF0804, 1))
+    prog.append(InstructionBuilder.addi(0x010, 1, 1))   # 0xF0804010
+    prog.append(InstructionBuilder.lui(0x20C08, 2))
+    prog.append(InstructionBuilder.addi(0x7FF, 2, 2))   # 0x20C087FF
+    
+    prog.append(InstructionBuilder.ukadd8(2, 1, 3))
+    prog.append(InstructionBuilder.uksub8(2, 1, 4))
+    prog.append(InstructionBuilder.uradd8(2, 1, 5))
+    prog.append(InstructionBuilder.umin8(2, 1, 6))
+    prog.append(InstructionBuilder.umax8(2, 1, 7))
+    prog.append(InstructionBuilder.uscale8(192, 7, 1, 8))   # x1.5
+    prog.append(InstructionBuilder.uscale8(128, 8, 8, 9))   # x0.5 of the result
+    prog.append(InstructionBuilder.ukadd8(9, 9, 10))
+    prog.append(InstructionBuilder.beq(0, 0, 0))
+    
+    return [p.value() for p in prog]
+    
+def interrupt_program(sleep = True):
+    prog = list()
+    
+    # Handler at 0x40, enable interrupts
+    prog.append(InstructionBuilder.addi(0x40, 0, 1))
+    prog.append(InstructionBuilder.csrrw(Csr.MTVEC.value, 1, 0))
+    prog.append(InstructionBuilder.csrrsi(Csr.MSTATUS.value, 8, 0))
+    prog.append(InstructionBuilder.addi(0, 0, 2))
+    
+    prog.append(InstructionBuilder.addi(1, 2, 2))
+    if sleep:
+        prog.append(InstructionBuilder.wfi())
+    else:
+        prog.append(InstructionBuilder.addi(3, 6, 6))
+    prog.append(InstructionBuilder.jal(-8))
+    
+    prog = [p.value() for p in prog]
+    prog += [0] * (16 - len(prog))
+    
+    # x0 isn't hardwired, jal writes it, so reads set from x9
+    handler = list()
+    handler.append(InstructionBuilder.csrrs(Csr.MCAUSE.value, 9, 3))
+    handler.append(InstructionBuilder.csrrs(Csr.INT_DATA.value, 9, 4))
+    handler.append(InstructionBuilder.add(4, 5, 5))
+    handler.append(InstructionBuilder.csrrs(Csr.MEPC.value, 9, 8))
+    handler.append(InstructionBuilder.mret())
+    
+    return prog + [p.value() for p in handler]
+    
+def atomic_program():
+    prog = list()
+    
+    prog.append(InstructionBuilder.addi(0xC0, 0, 1))
+    prog.append(InstructionBuilder.addi(0xC4, 0, 19))
+    prog.append(InstructionBuilder.lui(0x80000, 2))
+    prog.append(InstructionBuilder.addi(5, 2, 2))
+    prog.append(InstructionBuilder.addi(-3, 0, 3))
+    prog.append(InstructionBuilder.storeword(0, 2, 1))
+    
+    # Every AMO, alternating a negative and a positive operand
+    amos = (InstructionBuilder.amoswap, InstructionBuilder.amoadd, InstructionBuilder.amoxor, InstructionBuilder.amoand,
+            InstructionBuilder.amoor, InstructionBuilder.amomin, InstructionBuilder.amomax, InstructionBuilder.amominu,
+            InstructionBuilder.amomaxu)
+    for k, op in enumerate(amos):
+        prog.append(op(2 + k % 2, 1, 4))
+        prog.append(InstructionBuilder.add(4, 5, 5))
+        prog.append(InstructionBuilder.load(0, 1, 6, 0b010))
+        
+    # rd is rs2
+    prog.append(InstructionBuilder.amoadd(3, 1, 3))
+    
+    # Reserved, not reserved, then reserved on another word
+    prog.append(InstructionBuilder.lr(1, 7))
+    prog.append(InstructionBuilder.addi(1, 7, 7))
+    prog.append(InstructionBuilder.sc(7, 1, 8))
+    prog.append(InstructionBuilder.load(0, 1, 6, 0b010))
+    prog.append(InstructionBuilder.sc(7, 1, 9))
+    prog.append(InstructionBuilder.lr(1, 10))
+    prog.append(InstructionBuilder.sc(7, 19, 11))
+    prog.append(InstructionBuilder.load(0, 19, 12, 0b010))
+    prog.append(InstructionBuilder.beq(0, 0, 0))
+    
+    return [p.value() for p in prog]
+    
+def store_program():
+    prog = list()
+    
+    prog.append(InstructionBuilder.lui(0x89ABC, 1))
+    prog.append(InstructionBuilder.addi(0x7EF, 1, 1))
+    prog.append(InstructionBuilder.addi(-3, 0, 2))
+    
+    # Stores then loads of the same word straight away
+    prog.append(InstructionBuilder.storeword(128, 1, 0))
+    prog.append(InstructionBuilder.storebyte(129, 2, 0))
+    prog.append(InstructionBuilder.storehalf(134, 2, 0))
+    prog.append(InstructionBuilder.load(128, 0, 3, 0b010))          # LW over the byte store
+    prog.append(InstructionBuilder.load(129, 0, 4, 0b000))          # LB
+    prog.append(InstructionBuilder.load(134, 0, 5, 0b101))          # LHU
+    
+    # More stores than the buffer holds
+    for i in range(6):
+        prog.append(InstructionBuilder.storeword(140 + 4 * i, 3, 0))
+        prog.append(InstructionBuilder.addi(1, 3, 3))
+    prog.append(InstructionBuilder.load(144, 0, 6, 0b010))
+    prog.append(InstructionBuilder.fence())
+    prog.append(InstructionBuilder.load(160, 0, 7, 0b010))
+    prog.append(InstructionBuilder.load(4, 0, 8, 0b010))            # Program copy, never stored
+    prog.append(InstructionBuilder.beq(0, 0, 0))
+    
+    return [p.value() for p in prog]
+    
+class TestEmulator(unittest.TestCase):
+    def test_run(self):
+        emu = Emulator(256, mixed_program())
+        
+        emu.run(100)
+        
+        assert emu.reg(1) == 0x12345678
+        assert emu.reg(2) == 0x1008
+        assert emu.reg(3) == 0x01234567
+        assert emu.reg(8) == 0
+        assert emu.reg(9) == 15
+        assert emu.reg(10) == 0x56
+        assert emu.reg(11) == 0x1234
+        assert emu.reg(12) == 64
+        assert emu.reg(13) == 0
+        assert emu.reg(14) == 72
+        assert emu.pc == 76
+        
+    def test_illegal(self):
+        emu = Emulator(256, [InstructionBuilder.r(0b0000001, 1, 1, 0b000, 1).value()])
+        
+        with self.assertRaises(IllegalInstruction):
+            emu.step()
+            
+        # No such counter
+        emu = Emulator(256, [InstructionBuilder.i(0xCFF, 1, 0b001, 1, 0b1110011).value()], counters = True)
+        
+        with self.assertRaises(IllegalInstruction):
+            emu.step()
+            
+    def test_lockstep(self):
+        prog = mixed_program()
+        
+        for pipelined in (False, True):
+            for data_width in (8, 32):
+                for register_memory in (False, True):
+                    dut, core, data = core_with_memory(prog, pipelined, data_width,
+                                                       register_memory = register_memory)
+                    
+                    # Only the memory register file has x0 hardwired
+                    emu = Emulator(256, prog, hardwire_zero = register_memory)
+                    
+                    async def bench(ctx):
+                        await lockstep(ctx, core, emu, 33)
+                        
+                    sim = Simulator(dut)
+                    sim.add_clock(1e-8)
+                    sim.add_testbench(bench)
+                    
+                    sim.run()
+                    
+    def test_lockstep_muldiv(self):
+        prog = muldiv_program()
+        
+        for pipelined in (False, True):
+            dut, core, data = core_with_memory(prog, pipelined, muldiv = True)
+            
+            emu = Emulator(256, prog, hardwire_zero = False, muldiv = True)
+            
+            async def bench(ctx):
+                await lockstep(ctx, core, emu, 21)
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_lockstep_counters(self):
+        prog = mixed_program()
+        
+        # Read counters in the loop instead of the constant
+        prog[9] = InstructionBuilder.csrrs(Csr.INSTRET.value, 0, 9).value()
+        prog[4] = InstructionBuilder.csrrs(Csr.CYCLE.value, 0, 4).value()
+        
+        for pipelined in (False, True):
+            dut, core, data = core_with_memory(prog, pipelined, counters = True)
+            
+            emu = Emulator(256, prog, hardwire_zero = False, counters = True)
+            
+            async def bench(ctx):
+                await lockstep(ctx, core, emu, 33)
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_lockstep_counter_write(self):
+        # Writes to counters are ignored, rd still gets the counter
+        prog = [
+            InstructionBuilder.addi(7, 0, 1),
+            InstructionBuilder.csrrw(Csr.CYCLE.value, 1, 5),
+            InstructionBuilder.csrrs(Csr.INSTRET.value, 1, 6),
+            InstructionBuilder.csrrc(Csr.INSTRET.value, 1, 7),
+            InstructionBuilder.i(Csr.INSTRET.value, 3, 0b101, 8, 0b1110011), # csrrwi
+            InstructionBuilder.addi(1, 1, 1),
+            InstructionBuilder.jal(-20)
+        ]
+        prog = [p.value() for p in prog]
+        
+        for pipelined in (False, True):
+            dut, core, data = core_with_memory(prog, pipelined, counters = True)
+            
+            emu = Emulator(256, prog, hardwire_zero = False, counters = True)
+            
+            async def bench(ctx):
+                await lockstep(ctx, core, emu, 20)
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_simd(self):
+        emu = Emulator(256, simd_program(), simd = True)
+        
+        emu.run(12)
+        
+        assert emu.reg(3) == 0xFFFFC7FF
+        assert emu.reg(4) == 0xD0000000
+        assert emu.reg(5) == 0x88A06387
+        assert emu.reg(6) == 0x20804010
+        assert emu.reg(7) == 0xF0C087FF
+        assert emu.reg(8) == 0xFFC06018
+        assert emu.reg(9) == 0x7F60300C
+        assert emu.reg(10) == 0xFEC06018
+        
+    def test_lockstep_simd(self):
+        prog = simd_program()
+        
+        for pipelined in (False, True):
+            dut, core, data = core_with_memory(prog, pipelined, simd = True)
+            
+            emu = Emulator(256, prog, hardwire_zero = False, simd = True)
+            
+            async def bench(ctx):
+                await lockstep(ctx, core, emu, 14)
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_illegal_simd(self):
+        # Undefined custom-0 function, custom-0 with f_upper set, custom-1 with f set
+        for word in (InstructionBuilder.r(0, 2, 1, 0b101, 3, 0b0001011), InstructionBuilder.r(1, 2, 1, 0b000, 3, 0b0001011),
+                     InstructionBuilder.i(0x010, 1, 0b001, 3, 0b0101011)):
+            prog = [InstructionBuilder.addi(5, 0, 1).value(), word.value(), InstructionBuilder.jal(0).value()]
+            
+            emu = Emulator(256, prog, simd = True)
+            emu.step()
+            with self.assertRaises(IllegalInstruction):
+                emu.step()
+                
+            # Core stops on the same instruction instead of writing rd
+            for pipelined in (False, True):
+                dut, core, data = core_with_memory(prog, pipelined, simd = True)
+                
+                async def bench(ctx):
+                    for _ in range(100):
+                        await ctx.tick()
+                        
+                sim = Simulator(dut)
+                sim.add_clock(1e-8)
+                sim.add_testbench(bench)
+                
+                with self.assertRaises(AssertionError):
+                    sim.run()
+                    
+    def test_lockstep_predict(self):
+        prog = mixed_program()
+        
+        for pipelined in (False, True):
+            for register_memory in (False, True):
+                for cached in (False, True):
+                    dut, core, data = core_with_memory(prog, pipelined, predict = True, cached = cached,
+                                                       register_memory = register_memory)
+                    
+                    emu = Emulator(256, prog, hardwire_zero = register_memory)
+                    
+                    async def bench(ctx):
+                        await lockstep(ctx, core, emu, 33)
+                        
+                    sim = Simulator(dut)
+                    sim.add_clock(1e-8)
+                    sim.add_testbench(bench)
+                    
+                    sim.run()
+                
+    def test_lockstep_store_buffer(self):
+        prog = store_program()
+        
+        for pipelined in (False, True):
+            for data_width in (8, 32):
+                for depth in (1, 4):
+                    dut, core, data = core_with_memory(prog, pipelined, data_width, store_buffer = depth)
+                    
+                    emu = Emulator(256, prog, hardwire_zero = False)
+                    
+                    async def bench(ctx):
+                        await lockstep(ctx, core, emu, len(prog) - 1)
+                        
+                    sim = Simulator(dut)
+                    sim.add_clock(1e-8)
+                    sim.add_testbench(bench)
+                    
+                    sim.run()
+                    
+    def test_lockstep_data_cache(self):
+        for prog, count in ((mixed_program(), 33), (store_program(), 25)):
+            for pipelined in (False, True):
+                for data_width in (8, 32):
+                    dut, core, data = core_with_memory(prog, pipelined, data_width, data_cache = True)
+                    
+                    emu = Emulator(256, prog, hardwire_zero = False)
+                    
+                    async def bench(ctx):
+                        await lockstep(ctx, core, emu, count)
+                        
+                    sim = Simulator(dut)
+                    sim.add_clock(1e-8)
+                    sim.add_testbench(bench)
+                    
+                    sim.run()
+                    
+    def test_lockstep_scratchpad(self):
+        prog = store_program()
+        
+        for pipelined in (False, True):
+            for data_width in (8, 32):
+                for store_buffer in (0, 4):
+                    # Scratchpad covers the stores, it starts cleared like the data memory there
+                    dut, core, data = core_with_memory(prog, pipelined, data_width, store_buffer = store_buffer,
+                                                       scratchpad = 64, scratchpad_base = 128)
+                                                       
+                    emu = Emulator(256, prog, hardwire_zero = False)
+                    
+                    async def bench(ctx):
+                        await lockstep(ctx, core, emu, len(prog) - 1)
+                        
+                    sim = Simulator(dut)
+                    sim.add_clock(1e-8)
+                    sim.add_testbench(bench)
+                    
+                    sim.run()
+                    
+    def test_lockstep_unified(self):
+        for prog, count in ((mixed_program(), 33), (store_program(), 25)):
+            for pipelined in (False, True):
+                dut, core, mem = core_with_unified_memory(prog, pipelined)
+                
+                emu = Emulator(256, prog, hardwire_zero = False)
+                
+                async def bench(ctx):
+                    await lockstep(ctx, core, emu, count)
+                    
+                sim = Simulator(dut)
+                sim.add_clock(1e-8)
+                sim.add_testbench(bench)
+                
+                sim.run()
+                
+    def test_lockstep_interrupts(self):
+        for sleep, count, period in ((True, 30, 40), (False, 60, 23)):
+            for pipelined, predict in ((False, False), (True, False), (True, True)):
+                prog = interrupt_program(sleep)
+                dut, core, data = core_with_memory(prog, pipelined, predict = predict, interrupts = True)
+                
+                emu = Emulator(256, prog, hardwire_zero = False, interrupts = True)
+                
+                async def sender(ctx):
+                    data = 1
+                    while True:
+                        for _ in range(period):
+                            await ctx.tick()
+                        ctx.set(core.int.cyc, 1)
+                        ctx.set(core.int.stb, 1)
+                        ctx.set(core.int.w_data, data)
+                        while not ctx.get(core.int.ack):
+                            await ctx.tick()
+                        await ctx.tick()
+                        ctx.set(core.int.cyc, 0)
+                        ctx.set(core.int.stb, 0)
+                        data += 1
+                        
+                async def bench(ctx):
+                    await lockstep(ctx, core, emu, count)
+                    
+                sim = Simulator(dut)
+                sim.add_clock(1e-8)
+                sim.add_testbench(sender, background = True)
+                sim.add_testbench(bench)
+                
+                sim.run()
+                
+                # Handler ran
+                assert emu.reg(3) == INTERRUPT_CAUSE
+                assert emu.reg(5) > 1
+                
+    def test_lockstep_atomics(self):
+        prog = atomic_program()
+        
+        for pipelined in (False, True):
+            for data_width in (8, 32):
+                dut, core, data = core_with_memory(prog, pipelined, data_width, atomics = True)
+                
+                emu = Emulator(256, prog, hardwire_zero = False, atomics = True)
+                
+                async def bench(ctx):
+                    await lockstep(ctx, core, emu, 45)
+                    
+                sim = Simulator(dut)
+                sim.add_clock(1e-8)
+                sim.add_testbench(bench)
+                
+                sim.run()
+                
+                # Only the first store conditional went through
+                assert [emu.reg(8), emu.reg(9), emu.reg(11)] == [0, 1, 1]
+                assert emu.reg(12) == 0
+                
+    def test_lockstep_banked(self):
+        # Both cores run the same program, so they store the same values
+        for prog, count in ((mixed_program(), 33), (store_program(), 25)):
+            for pipelined in (False, True):
+                for data_width in (8, 32):
+                    dut, cores, data = cores_with_banked_memory(prog, 2, pipelined, data_width)
+                    
+                    sim = Simulator(dut)
+                    sim.add_clock(1e-8)
+                    
+                    for core in cores:
+                        emu = Emulator(256, prog, hardwire_zero = False)
+                        
+                        async def bench(ctx, core = core, emu = emu):
+                            await lockstep(ctx, core, emu, count)
+                            
+                        sim.add_testbench(bench)
+                        
+                    sim.run()
+                    
+if __name__ == "__main__":
+    unittest.main()
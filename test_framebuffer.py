@@ -0,0 +1,84 @@
+import unittest
+from amaranth.sim import *
+from amaranth.lib import wiring
+from amaranth import *
+
+from bus_sim import *
+from framebuffer import FrameBuffer
+import ram
+
+def framebuffer_with_memory(contents, pipelined = False):
+    m = Module()
+    
+    fb = m.submodules.fb = FrameBuffer(width = 4, height = 2, pipelined = pipelined)
+    mem = m.submodules.mem = ram.WishboneMemory(8, len(contents), init = contents, pipelined = pipelined)
+    
+    wiring.connect(m, fb.ram, mem.bus)
+    
+    return m, fb, mem
+    
+class TestFrameBuffer(unittest.TestCase):
+    def test_stream(self):
+        contents = [(i * 7) & 0xFF for i in range(24)]
+        
+        pixels = [(contents[3 * i] << 16) | (contents[3 * i + 1] << 8) | contents[3 * i + 2] for i in range(8)]
+        
+        cycles = dict()
+        
+        for pipelined in (False, True):
+            dut, fb, mem = framebuffer_with_memory(contents, pipelined)
+            
+            async def bench(ctx):
+                ctx.set(fb.produce.tready, 1)
+                
+                received = list()
+                count = 0
+                while len(received) < 16:
+                    if ctx.get(fb.produce.tvalid):
+                        received.append(ctx.get(fb.produce.tdata))
+                    await ctx.tick()
+                    count += 1
+                    
+                # Two frames
+                assert received == pixels + pixels
+                cycles[pipelined] = count
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+        # Byte per cycle instead of every other cycle, 48 bytes
+        assert cycles[False] >= 96
+        assert cycles[True] <= 52
+        
+    def test_access(self):
+        contents = [0 for i in range(24)]
+        
+        dut, fb, mem = framebuffer_with_memory(contents, pipelined = True)
+        
+        async def bench(ctx):
+            ctx.set(fb.produce.tready, 1)
+            for _ in range(5):
+                await ctx.tick()
+                
+            # Write a pixel while streaming
+            for i, value in enumerate((0x12, 0x34, 0x56)):
+                await single_write(ctx, fb.consume, 3 + i, value)
+                
+            received = list()
+            while len(received) < 16:
+                if ctx.get(fb.produce.tvalid):
+                    received.append(ctx.get(fb.produce.tdata))
+                await ctx.tick()
+            assert 0x123456 in received
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+from amaranth.sim import *
+from amaranth import *
+
+from mailbox import Mailbox, MailboxRegister
+
+async def access(ctx, bus, register, data = 0, write = True):
+    ctx.set(bus.addr, register.value)
+    ctx.set(bus.w_data, data)
+    ctx.set(bus.w_en, write)
+    ctx.set(bus.stb, 1)
+    ctx.set(bus.cyc, 1)
+    # Sampled at the edge, other benches may still change the grant
+    ack = 0
+    while not ack:
+        _, _, ack, value = await ctx.tick().sample(bus.ack, bus.r_data)
+    ctx.set(bus.stb, 0)
+    ctx.set(bus.cyc, 0)
+    ctx.set(bus.w_en, 0)
+    return value
+    
+async def send(ctx, bus, dest, messages):
+    await access(ctx, bus, MailboxRegister.SEND_DEST, dest)
+    for message in messages:
+        await access(ctx, bus, MailboxRegister.SEND_DATA, message)
+        
+async def receive(ctx, bus):
+    source = await access(ctx, bus, MailboxRegister.READ_SOURCE, write = False)
+    data = await access(ctx, bus, MailboxRegister.READ_DATA, write = False)
+    return source, data
+    
+class TestMailbox(unittest.TestCase):
+    def test_sources(self):
+        dut = Mailbox(n = 3, credits = 4)
+        
+        def sender(i):
+            async def bench(ctx):
+                await send(ctx, getattr(dut, "c_{:02X}".format(i)), 2, [0x10 * (i + 1) + k for k in range(4)])
+            return bench
+            
+        async def bench(ctx):
+            while ctx.get(dut.levels[2]) < 8:
+                await ctx.tick()
+            # First message with INTERRUPT_SIZE 0
+            assert ctx.get(dut.i_02.stb) == 1
+            
+            received = [await receive(ctx, dut.c_02) for _ in range(8)]
+            
+            # In order from each source
+            assert [d for s, d in received if s == 0] == [0x10, 0x11, 0x12, 0x13]
+            assert [d for s, d in received if s == 1] == [0x20, 0x21, 0x22, 0x23]
+            assert ctx.get(dut.debug.sent[0]) == 4
+            assert ctx.get(dut.debug.received[2]) == 8
+            
+            # Credits back
+            await access(ctx, dut.c_00, MailboxRegister.SEND_DEST, 2)
+            assert await access(ctx, dut.c_00, MailboxRegister.CREDITS, write = False) == 4
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(sender(0))
+        sim.add_testbench(sender(1))
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_credits(self):
+        dut = Mailbox(n = 3, credits = 2)
+        
+        async def bench(ctx):
+            await access(ctx, dut.c_00, MailboxRegister.SEND_DEST, 1)
+            await access(ctx, dut.c_02, MailboxRegister.SEND_DEST, 1)
+            await access(ctx, dut.c_00, MailboxRegister.SEND_DATA, 0xA0)
+            await access(ctx, dut.c_00, MailboxRegister.SEND_DATA, 0xA1)
+            assert await access(ctx, dut.c_00, MailboxRegister.CREDITS, write = False) == 0
+            
+            # Out of credits, only core 0 waits
+            ctx.set(dut.c_00.addr, MailboxRegister.SEND_DATA.value)
+            ctx.set(dut.c_00.w_data, 0xA2)
+            ctx.set(dut.c_00.w_en, 1)
+            ctx.set(dut.c_00.stb, 1)
+            ctx.set(dut.c_00.cyc, 1)
+            
+            await access(ctx, dut.c_02, MailboxRegister.SEND_DATA, 0xC0)
+            assert ctx.get(dut.levels[1]) == 3
+            assert ctx.get(dut.c_00.ack) == 0
+            
+            assert await receive(ctx, dut.c_01) == (0, 0xA0)
+            
+            # Credit back, the send goes through
+            assert ctx.get(dut.c_00.ack) == 1
+            await ctx.tick()
+            ctx.set(dut.c_00.stb, 0)
+            ctx.set(dut.c_00.cyc, 0)
+            
+            assert await receive(ctx, dut.c_01) == (0, 0xA1)
+            assert await receive(ctx, dut.c_01) == (2, 0xC0)
+            assert await receive(ctx, dut.c_01) == (0, 0xA2)
+            assert ctx.get(dut.debug.stall[0]) > 0
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_throughput(self):
+        n = 4
+        dut = Mailbox(n = n, credits = 8)
+        
+        # Every other core sends to core 0 at once
+        def sender(i):
+            async def bench(ctx):
+                await send(ctx, getattr(dut, "c_{:02X}".format(i)), 0, list(range(8)))
+            return bench
+            
+        async def bench(ctx):
+            cycles = 0
+            while ctx.get(dut.levels[0]) < 8 * (n - 1):
+                await ctx.tick()
+                cycles += 1
+            # Inbox takes one a cycle, each send takes two cycles
+            assert cycles <= 8 * (n - 1) + 4
+            assert sum(ctx.get(s) for s in dut.debug.stall) > 0
+            assert ctx.get(dut.i_00.stb) == 1
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        for i in range(1, n):
+            sim.add_testbench(sender(i))
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+if __name__ == "__main__":
+    unittest.main()
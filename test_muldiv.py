@@ -0,0 +1,49 @@
+import unittest
+from amaranth.sim import *
+
+from emulator import MASK, divide, remainder
+from muldiv import Divider
+
+class TestDivider(unittest.TestCase):
+    def test_divide(self):
+        dut = Divider()
+        
+        values = [0, 1, 7, 3, 0x80000000, MASK, MASK - 6, 0x12345678, 0xDEADBEEF]
+        
+        expected = {
+            0b00: divide,
+            0b01: lambda a, b: a // b if b else MASK,
+            0b10: remainder,
+            0b11: lambda a, b: a % b if b else a
+        }
+        
+        async def bench(ctx):
+            for op, function in expected.items():
+                for a in values:
+                    for b in values:
+                        ctx.set(dut.a, a)
+                        ctx.set(dut.b, b)
+                        ctx.set(dut.op, op)
+                        ctx.set(dut.start, 1)
+                        await ctx.tick()
+                        ctx.set(dut.start, 0)
+                        
+                        cycles = 1
+                        while not ctx.get(dut.done):
+                            assert ctx.get(dut.busy)
+                            await ctx.tick()
+                            cycles += 1
+                            
+                        assert ctx.get(dut.result) == function(a, b) & MASK, \
+                            "op {} of 0x{:08X} 0x{:08X}".format(op, a, b)
+                        assert cycles == 33
+                        await ctx.tick()
+                        
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+import unittest
+from amaranth.sim import *
+from amaranth import *
+
+from ram import WishboneMemory, DualPortMemory, Collision, BankedMemory
+
+def request(ctx, port, addr, data = None, sel = 0b1111):
+    ctx.set(port.addr, addr)
+    ctx.set(port.stb, 1)
+    ctx.set(port.cyc, 1)
+    ctx.set(port.w_en, data is not None)
+    ctx.set(port.sel, sel)
+    if data is not None:
+        ctx.set(port.w_data, data)
+        
+def release(ctx, port):
+    ctx.set(port.stb, 0)
+    ctx.set(port.cyc, 0)
+    ctx.set(port.w_en, 0)
+    
+class TestWishboneMemory(unittest.TestCase):
+    def test_pipelined(self):
+        dut = WishboneMemory(8, 16, init = [0x10 + i for i in range(16)], pipelined = True)
+        
+        async def bench(ctx):
+            # A request every cycle, writes in between reads
+            requests = [(2, None), (3, 0xAA), (3, None), (4, None), (5, 0xBB), (5, None)]
+            ctx.set(dut.bus.cyc, 1)
+            acks = list()
+            for addr, data in requests + [(None, None)]:
+                if addr is not None:
+                    ctx.set(dut.bus.stb, 1)
+                    ctx.set(dut.bus.addr, addr)
+                    ctx.set(dut.bus.w_en, data is not None)
+                    ctx.set(dut.bus.w_data, data or 0)
+                    assert not ctx.get(dut.bus.stall)
+                else:
+                    ctx.set(dut.bus.stb, 0)
+                if ctx.get(dut.bus.ack):
+                    acks.append(ctx.get(dut.bus.r_data))
+                await ctx.tick()
+                
+            # Acks follow a cycle behind, reads see the write before them
+            assert len(acks) == len(requests)
+            assert [acks[i] for i in (0, 2, 3, 5)] == [0x12, 0xAA, 0x14, 0xBB]
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+    
+class TestDualPortMemory(unittest.TestCase):
+    def test_both_ports(self):
+        dut = DualPortMemory(32, 16, init = [0x100 + i for i in range(16)], byte_select = True)
+        
+        async def bench(ctx):
+            # Write and read in the same cycle
+            request(ctx, dut.bus, 3, 0xAAAA)
+            request(ctx, dut.bus_b, 5)
+            assert ctx.get(dut.bus.ack)
+            await ctx.tick()
+            release(ctx, dut.bus)
+            assert ctx.get(dut.bus_b.ack)
+            assert ctx.get(dut.bus_b.r_data) == 0x105
+            release(ctx, dut.bus_b)
+            await ctx.tick()
+            
+            # Both read, b sees the write from a
+            request(ctx, dut.bus, 5)
+            request(ctx, dut.bus_b, 3)
+            await ctx.tick()
+            assert ctx.get(dut.bus.ack) and ctx.get(dut.bus_b.ack)
+            assert ctx.get(dut.bus.r_data) == 0x105
+            assert ctx.get(dut.bus_b.r_data) == 0xAAAA
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_collision(self):
+        # a writes the low half, b the middle two bytes
+        for collision, expected in ((Collision.A_WINS, 0x00BB1111),
+                                    (Collision.B_WINS, 0x00BBBB11),
+                                    (Collision.STALL, 0x00BBBB11)):
+            dut = DualPortMemory(32, 16, byte_select = True, collision = collision)
+            
+            async def bench(ctx):
+                request(ctx, dut.bus, 2, 0x1111, sel = 0b0011)
+                request(ctx, dut.bus_b, 2, 0xBBBB00, sel = 0b0110)
+                assert ctx.get(dut.bus.ack)
+                # Stalled write waits for a to finish
+                assert ctx.get(dut.bus_b.ack) == (collision != Collision.STALL)
+                await ctx.tick()
+                release(ctx, dut.bus)
+                if collision == Collision.STALL:
+                    assert ctx.get(dut.bus_b.ack)
+                    await ctx.tick()
+                release(ctx, dut.bus_b)
+                
+                request(ctx, dut.bus, 2)
+                await ctx.tick()
+                assert ctx.get(dut.bus.r_data) == expected
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_stall_fair(self):
+        # a writes the same word every cycle, b still gets its turn
+        dut = DualPortMemory(32, 16, byte_select = True, collision = Collision.STALL)
+        assert not dut.atomic
+        
+        async def bench(ctx):
+            request(ctx, dut.bus_b, 2, 0xBB)
+            acks = 0
+            for i in range(8):
+                request(ctx, dut.bus, 2, 0x10 + i)
+                assert ctx.get(dut.bus.ack) == (i % 2 == 0)
+                if ctx.get(dut.bus_b.ack):
+                    acks += 1
+                await ctx.tick()
+            assert acks == 4
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+class TestBankedMemory(unittest.TestCase):
+    def test_parallel(self):
+        dut = BankedMemory(8, 32, banks = 4, masters = 2, init = list(range(32)))
+        
+        async def bench(ctx):
+            # Different banks in the same cycle
+            ctx.set(dut.bus_00.w_en, 1)
+            ctx.set(dut.bus_00.w_data, 0xAA)
+            for bus, addr in ((dut.bus_00, 4), (dut.bus_01, 5)):
+                ctx.set(bus.addr, addr)
+                ctx.set(bus.stb, 1)
+                ctx.set(bus.cyc, 1)
+            assert ctx.get(dut.bus_00.ack)
+            await ctx.tick()
+            assert ctx.get(dut.bus_01.ack)
+            assert ctx.get(dut.bus_01.r_data) == 5
+            
+            for bus in (dut.bus_00, dut.bus_01):
+                ctx.set(bus.stb, 0)
+                ctx.set(bus.cyc, 0)
+            ctx.set(dut.bus_00.w_en, 0)
+            await ctx.tick()
+            
+            # Same bank, one waits
+            for bus, addr in ((dut.bus_00, 4), (dut.bus_01, 8)):
+                ctx.set(bus.addr, addr)
+                ctx.set(bus.stb, 1)
+                ctx.set(bus.cyc, 1)
+                
+            
+            reads = dict()
+            for _ in range(4):
+                for i, bus in enumerate((dut.bus_00, dut.bus_01)):
+                    if ctx.get(bus.ack) and i not in reads:
+                        reads[i] = ctx.get(bus.r_data)
+                        ctx.set(bus.stb, 0)
+                        ctx.set(bus.cyc, 0)
+                await ctx.tick()
+            assert reads == {0: 0xAA, 1: 8}
+            assert ctx.get(dut.debug.conflicts) == 1
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+if __name__ == "__main__":
+    unittest.main()
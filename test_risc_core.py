@@ -4,7 +4,10 @@ from amaranth.lib import wiring
 from amaranth import *
 
 from bus_sim import *
-from risc_core import RiscCore
+from risc_core import RiscCore, Csr
+from cache import InstructionCache, DataCache
+from switch import BusSwitch, SwitchPortDef, BusRegister
+from delegate import Delegate, DelegateRegister
 import ram
 
 def map_bit(value, fromstart, fromstop, tostart, tostop):
@@ -42,7 +45,7 @@ class InstructionBuilder(object):
     @classmethod
     def i(cls, imm, rs, f, rd, op):
         return cls(
-            imm << 20,
+            (imm & 0xFFF) << 20,
             rs << 15,
             f  << 12,
             rd << 7,
@@ -50,7 +53,38 @@ class InstructionBuilder(object):
         )
         
     @classmethod
-    def jal(cls, offset):
+    def r(cls, f_upper, rs2, rs1, f, rd, op = 0b0110011):
+        return cls(
+            f_upper << 25,
+            rs2 << 20,
+            rs1 << 15,
+            f << 12,
+            rd << 7,
+            op
+        )
+        
+    @classmethod
+    def add(cls, rs2, rs1, rd):
+        return InstructionBuilder.r(0b0000000, rs2, rs1, 0b000, rd)
+        
+    @classmethod
+    def sub(cls, rs2, rs1, rd):
+        return InstructionBuilder.r(0b0100000, rs2, rs1, 0b000, rd)
+        
+    @classmethod
+    def lui(cls, imm, rd):
+        return InstructionBuilder.u(imm & 0xFFFFF, rd, 0b0110111)
+        
+    @classmethod
+    def auipc(cls, imm, rd):
+        return InstructionBuilder.u(imm & 0xFFFFF, rd, 0b0010111)
+        
+    @classmethod
+    def jalr(cls, offset, rs, rd):
+        return InstructionBuilder.i(offset, rs, 0b000, rd, 0b1100111)
+        
+    @classmethod
+    def jal(cls, offset, rd = 0):
         
         #offset = offset & 0b1111_1111_1111_1111_1111
         print("Offset original 0x{:08X}".format(offset))
@@ -70,6 +104,7 @@ class InstructionBuilder(object):
         # Stupid but don't wanna map offset rn
         return cls(
             offsetp,
+            rd << 7,
             0b1101111
         )
         
@@ -83,25 +118,306 @@ class InstructionBuilder(object):
         return InstructionBuilder.i(value, rs, 0b111, rd, 0b0010011)
         
     @classmethod
-    def storeword(cls, offset, rs2, rs1):
+    def b(cls, offset, rs2, rs1, f, op = 0b1100011):
+        offset = offset & 0x1FFF
+        return cls(
+            map_bit(offset, 12, 12, 31, 31),
+            map_bit(offset, 5,  10, 25, 30),
+            rs2 << 20,
+            rs1 << 15,
+            f << 12,
+            map_bit(offset, 1,  4,  8,  11),
+            map_bit(offset, 11, 11, 7,  7),
+            op
+        )
+        
+    @classmethod
+    def beq(cls, offset, rs2, rs1):
+        return InstructionBuilder.b(offset, rs2, rs1, 0b000)
+        
+    @classmethod
+    def bne(cls, offset, rs2, rs1):
+        return InstructionBuilder.b(offset, rs2, rs1, 0b001)
+        
+    @classmethod
+    def store(cls, offset, rs2, rs1, f):
+        offset = offset & 0xFFF
         return InstructionBuilder(
-            (offset & 0b111111100000) << 25,
+            (offset & 0b111111100000) << 20,
             rs2 << 20,
             rs1 <<  15,
-            0b010 << 12,
+            f << 12,
             (offset & 0b000000011111) << 7,
             0b0100011
         )
         
-def core_with_program(program):
+    @classmethod
+    def storeword(cls, offset, rs2, rs1):
+        return InstructionBuilder.store(offset, rs2, rs1, 0b010)
+        
+    @classmethod
+    def storehalf(cls, offset, rs2, rs1):
+        return InstructionBuilder.store(offset, rs2, rs1, 0b001)
+        
+    @classmethod
+    def storebyte(cls, offset, rs2, rs1):
+        return InstructionBuilder.store(offset, rs2, rs1, 0b000)
+        
+    @classmethod
+    def load(cls, offset, rs, rd, f):
+        return InstructionBuilder.i(offset, rs, f, rd, 0b0000011)
+        
+    @classmethod
+    def fence(cls):
+        # Order all earlier reads and writes before later ones
+        return InstructionBuilder.i(0x0FF, 0, 0b000, 0, 0b0001111)
+        
+    @classmethod
+    def csrrs(cls, csr, rs, rd):
+        return InstructionBuilder.i(csr, rs, 0b010, rd, 0b1110011)
+        
+    @classmethod
+    def csrrw(cls, csr, rs, rd):
+        return InstructionBuilder.i(csr, rs, 0b001, rd, 0b1110011)
+        
+    @classmethod
+    def csrrc(cls, csr, rs, rd):
+        return InstructionBuilder.i(csr, rs, 0b011, rd, 0b1110011)
+        
+    @classmethod
+    def csrrsi(cls, csr, imm, rd):
+        # Immediate is in the rs1 field
+        return InstructionBuilder.i(csr, imm, 0b110, rd, 0b1110011)
+        
+    @classmethod
+    def csrrci(cls, csr, imm, rd):
+        return InstructionBuilder.i(csr, imm, 0b111, rd, 0b1110011)
+        
+    @classmethod
+    def mret(cls):
+        return InstructionBuilder.i(0x302, 0, 0b000, 0, 0b1110011)
+        
+    @classmethod
+    def wfi(cls):
+        return InstructionBuilder.i(0x105, 0, 0b000, 0, 0b1110011)
+        
+    # Atomics, aq and rl only order accesses so the core ignores them
+    @classmethod
+    def amo(cls, f, rs2, rs1, rd, aq = 0, rl = 0):
+        return InstructionBuilder.r((f << 2) | (aq << 1) | rl, rs2, rs1, 0b010, rd, 0b0101111)
+        
+    @classmethod
+    def lr(cls, rs1, rd):
+        return InstructionBuilder.amo(0b00010, 0, rs1, rd)
+        
+    @classmethod
+    def sc(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b00011, rs2, rs1, rd)
+        
+    @classmethod
+    def amoswap(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b00001, rs2, rs1, rd)
+        
+    @classmethod
+    def amoadd(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b00000, rs2, rs1, rd)
+        
+    @classmethod
+    def amoxor(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b00100, rs2, rs1, rd)
+        
+    @classmethod
+    def amoand(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b01100, rs2, rs1, rd)
+        
+    @classmethod
+    def amoor(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b01000, rs2, rs1, rd)
+        
+    @classmethod
+    def amomin(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b10000, rs2, rs1, rd)
+        
+    @classmethod
+    def amomax(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b10100, rs2, rs1, rd)
+        
+    @classmethod
+    def amominu(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b11000, rs2, rs1, rd)
+        
+    @classmethod
+    def amomaxu(cls, rs2, rs1, rd):
+        return InstructionBuilder.amo(0b11100, rs2, rs1, rd)
+        
+    # Packed pixel instructions, each byte of the register is one channel
+    @classmethod
+    def ukadd8(cls, rs2, rs1, rd):
+        return InstructionBuilder.r(0, rs2, rs1, 0b000, rd, 0b0001011)
+        
+    @classmethod
+    def uksub8(cls, rs2, rs1, rd):
+        return InstructionBuilder.r(0, rs2, rs1, 0b001, rd, 0b0001011)
+        
+    @classmethod
+    def uradd8(cls, rs2, rs1, rd):
+        return InstructionBuilder.r(0, rs2, rs1, 0b010, rd, 0b0001011)
+        
+    @classmethod
+    def umin8(cls, rs2, rs1, rd):
+        return InstructionBuilder.r(0, rs2, rs1, 0b011, rd, 0b0001011)
+        
+    @classmethod
+    def umax8(cls, rs2, rs1, rd):
+        return InstructionBuilder.r(0, rs2, rs1, 0b100, rd, 0b0001011)
+        
+    @classmethod
+    def uscale8(cls, k, shift, rs, rd):
+        # Each channel is multiplied by k then shifted right
+        return InstructionBuilder.i((shift << 8) | k, rs, 0b000, rd, 0b0101011)
+        
+def core_with_program(program, pipelined = False, data_width = 8, cached = False, **kwargs):
     m = Module()
         
-    core = m.submodules.core = RiscCore()
+    core = m.submodules.core = RiscCore(pipelined = pipelined, data_width = data_width, **kwargs)
     prog = m.submodules.prog = ram.WishboneMemory(32, len(program) << 1, init = program, granularity = 2)
      
-    wiring.connect(m, core.prog, prog.bus)
+    if cached:
+        # Hits are acked in the same cycle
+        cache = m.submodules.cache = InstructionCache(mem_width = 32)
+        wiring.connect(m, core.prog, cache.proc)
+        wiring.connect(m, cache.mem, prog.bus)
+    else:
+        wiring.connect(m, core.prog, prog.bus)
     
     return m, core, prog
+    
+def core_with_memory(program, pipelined = False, data_width = 8, depth = 256, data_cache = False, **kwargs):
+    m, core, prog = core_with_program(program, pipelined, data_width, **kwargs)
+    
+    # Data memory starts with a copy of the program
+    atomic = kwargs.get("atomics", False)
+    if data_width == 8:
+        image = [(p >> (8 * i)) & 0xFF for p in program for i in range(4)]
+        data = m.submodules.data = ram.WishboneMemory(8, depth, init = image, atomic = atomic)
+    else:
+        data = m.submodules.data = ram.WishboneMemory(32, depth // 4, init = program, granularity = 2, byte_select = True,
+                                                      atomic = atomic)
+        
+    if data_cache:
+        cache = m.submodules.data_cache = DataCache(data_width = data_width, mem_width = data_width)
+        wiring.connect(m, core.bus, cache.proc)
+        wiring.connect(m, cache.mem, data.bus)
+    else:
+        wiring.connect(m, core.bus, data.bus)
+    
+    return m, core, data
+    
+def core_with_unified_memory(program, pipelined = False, depth = 256, **kwargs):
+    m = Module()
+    
+    # Program and data share one memory, fetch on one port and data on the other
+    core = m.submodules.core = RiscCore(pipelined = pipelined, data_width = 32, **kwargs)
+    mem = m.submodules.mem = ram.DualPortMemory(32, depth // 4, init = program, granularity = 2, byte_select = True)
+    
+    m.d.comb += [
+        mem.bus.cyc.eq(core.prog.cyc),
+        mem.bus.stb.eq(core.prog.stb),
+        mem.bus.addr.eq(core.prog.addr),
+        mem.bus.sel.eq(0b1111),
+        core.prog.ack.eq(mem.bus.ack),
+        core.prog.r_data.eq(mem.bus.r_data)
+    ]
+    wiring.connect(m, core.bus, mem.bus_b)
+    
+    return m, core, mem
+    
+def cores_with_banked_memory(program, n = 2, pipelined = False, data_width = 8, depth = 256, **kwargs):
+    m = Module()
+    
+    # Each core has its own program memory, data is shared
+    atomic = kwargs.get("atomics", False)
+    if data_width == 8:
+        image = [(p >> (8 * i)) & 0xFF for p in program for i in range(4)]
+        data = m.submodules.data = ram.BankedMemory(8, depth, masters = n, init = image, atomic = atomic)
+    else:
+        data = m.submodules.data = ram.BankedMemory(32, depth // 4, masters = n, init = program,
+                                                    granularity = 2, byte_select = True, atomic = atomic)
+        
+    cores = list()
+    for i in range(n):
+        core = m.submodules["core{}".format(i)] = RiscCore(pipelined = pipelined, data_width = data_width, **kwargs)
+        prog = m.submodules["prog{}".format(i)] = ram.WishboneMemory(32, len(program) << 1, init = program, granularity = 2)
+        
+        wiring.connect(m, core.prog, prog.bus)
+        wiring.connect(m, core.bus, getattr(data, "bus_{:02X}".format(i)))
+        cores.append(core)
+        
+    return m, cores, data
+    
+def cores_with_switch(program, n = 2, pipelined = False, data_width = 8, depth = 256, max_grant = 4, **kwargs):
+    m = Module()
+    
+    # Data memory is shared through a switch that keeps the reservations, cores need atomics
+    sel = 4 if data_width == 32 else 0
+    switch = m.submodules.switch = BusSwitch([SwitchPortDef(32, data_width, sel)], 1, 32, data_width, num_inputs = n,
+                                             sel = sel, max_grant = max_grant, atomic = True)
+    if data_width == 8:
+        image = [(p >> (8 * i)) & 0xFF for p in program for i in range(4)]
+        data = m.submodules.data = ram.WishboneMemory(8, depth, init = image)
+    else:
+        data = m.submodules.data = ram.WishboneMemory(32, depth // 4, init = program, granularity = 2, byte_select = True)
+    wiring.connect(m, switch.p_00, data.bus)
+    
+    cores = list()
+    for i in range(n):
+        core = m.submodules["core{}".format(i)] = RiscCore(pipelined = pipelined, data_width = data_width, **kwargs)
+        prog = m.submodules["prog{}".format(i)] = ram.WishboneMemory(32, len(program) << 1, init = program, granularity = 2)
+        
+        wiring.connect(m, core.prog, prog.bus)
+        wiring.connect(m, core.bus, getattr(switch, "c_{:02X}".format(i)))
+        cores.append(core)
+        
+    return m, cores, data
+    
+def counter_program(n):
+    """
+    Each core adds n to a counter with amoadd and n to another
+    with LR/SC, then loads both when every core is done
+    """
+    prog = list()
+    
+    prog.append(InstructionBuilder.addi(0xC0, 0, 1))
+    prog.append(InstructionBuilder.addi(0xC4, 0, 5))
+    prog.append(InstructionBuilder.addi(0xC8, 0, 8))
+    prog.append(InstructionBuilder.addi(1, 0, 2))
+    
+    prog.append(InstructionBuilder.addi(n, 0, 3))
+    prog.append(InstructionBuilder.amoadd(2, 1, 4))
+    prog.append(InstructionBuilder.addi(-1, 3, 3))
+    prog.append(InstructionBuilder.bne(-8, 0, 3))
+    
+    # Retry until the store conditional goes through
+    prog.append(InstructionBuilder.addi(n, 0, 3))
+    prog.append(InstructionBuilder.lr(5, 6))
+    prog.append(InstructionBuilder.addi(1, 6, 6))
+    prog.append(InstructionBuilder.sc(6, 5, 7))
+    prog.append(InstructionBuilder.bne(-12, 0, 7))
+    prog.append(InstructionBuilder.addi(-1, 3, 3))
+    prog.append(InstructionBuilder.bne(-20, 0, 3))
+    
+    # Wait for the other core
+    prog.append(InstructionBuilder.amoadd(2, 8, 4))
+    prog.append(InstructionBuilder.load(0, 8, 9, 0b010))
+    prog.append(InstructionBuilder.addi(2, 0, 13))
+    prog.append(InstructionBuilder.bne(-8, 13, 9))
+    
+    prog.append(InstructionBuilder.load(0, 1, 10, 0b010))
+    prog.append(InstructionBuilder.load(0, 5, 11, 0b010))
+    prog.append(InstructionBuilder.addi(1, 0, 12))
+    prog.append(InstructionBuilder.jal(0))
+    
+    return [p.value() for p in prog]
         
 class TestRiscCore(unittest.TestCase):
     def test_set_reg_to_value(self):
@@ -132,6 +448,425 @@ class TestRiscCore(unittest.TestCase):
         
         with sim.write_vcd("bench/risc_set_reg.vcd"):
             sim.run()
+            
+    def count_loop(self, pipelined):
+        prog = list()
+        
+        prog.append(InstructionBuilder.addi(3, 2, 2))  # Loop limit
+        prog.append(InstructionBuilder.addi(1, 1, 1))  # Increment counter
+        prog.append(InstructionBuilder.bne(-4, 2, 1))  # Repeat until counter reaches limit
+        prog.append(InstructionBuilder.storeword(16, 1, 3))
+        
+        prog = [p.value() for p in prog]
+        
+        dut, core, prog = core_with_program(prog, pipelined = pipelined)
+        
+        async def mem_process(ctx):
+            assert await receive(ctx, core.bus) == (16, 3, 1)
+            assert await receive(ctx, core.bus) == (17, 0, 1)
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(mem_process)
+        
+        sim.run()
+        
+    def test_branch_loop(self):
+        self.count_loop(pipelined = False)
+        
+    def test_pipelined_branch_loop(self):
+        self.count_loop(pipelined = True)
+        
+    def test_pipelined_set_reg(self):
+        prog = list()
+        
+        prog.append(InstructionBuilder.andi(0, 0, 0))
+        prog.append(InstructionBuilder.addi(11, 0, 0))
+        
+        prog.append(InstructionBuilder.andi(0, 1, 1))
+        prog.append(InstructionBuilder.addi(13, 1, 1))
+        
+        # Depends on both previous results, needs forwarding
+        prog.append(InstructionBuilder.storeword(0, 0, 1))
+        
+        prog = [p.value() for p in prog]
+        
+        dut, core, prog = core_with_program(prog, pipelined = True)
+        
+        async def mem_process(ctx):
+            assert await receive(ctx, core.bus) == (13, 11, 1)
+            assert await receive(ctx, core.bus) == (14, 0, 1)
+            assert await receive(ctx, core.bus) == (15, 0, 1)
+            assert await receive(ctx, core.bus) == (16, 0, 1)
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(mem_process)
+        
+        sim.run()
 
+    def test_load_store(self):
+        prog = list()
+        
+        prog.append(InstructionBuilder.addi(0x123, 0, 1))
+        prog.append(InstructionBuilder.storeword(16, 1, 0))
+        prog.append(InstructionBuilder.storebyte(18, 1, 0))
+        prog.append(InstructionBuilder.load(16, 0, 2, 0b010)) # LW
+        prog.append(InstructionBuilder.load(17, 0, 3, 0b000)) # LB
+        prog.append(InstructionBuilder.load(16, 0, 4, 0b001)) # LH
+        
+        prog.append(InstructionBuilder.addi(-1, 0, 5))
+        prog.append(InstructionBuilder.storehalf(20, 5, 0))
+        prog.append(InstructionBuilder.load(20, 0, 6, 0b001)) # LH
+        prog.append(InstructionBuilder.load(20, 0, 7, 0b101)) # LHU
+        prog.append(InstructionBuilder.beq(0, 0, 0)) # Stop
+        
+        prog = [p.value() for p in prog]
+        
+        expected = {1: 0x123, 2: 0x230123, 3: 0x01, 4: 0x123, 5: -1, 6: -1, 7: 0xFFFF}
+        
+        # Byte bus takes a transaction per byte, word bus one per access
+        for pipelined in (False, True):
+            for data_width, transactions in ((8, 18), (32, 8)):
+                dut, core, data = core_with_memory(prog, pipelined, data_width)
+                
+                async def bench(ctx):
+                    count = 0
+                    for _ in range(300):
+                        if ctx.get(core.bus.cyc & core.bus.stb & core.bus.ack):
+                            count += 1
+                        await ctx.tick()
+                        
+                    for r, value in expected.items():
+                        assert ctx.get(core.debug.reg[r]) == value
+                    assert count == transactions
+                
+                sim = Simulator(dut)
+                sim.add_clock(1e-8)
+                sim.add_testbench(bench)
+                
+                sim.run()
+
+    def test_register_memory(self):
+        prog = list()
+        
+        prog.append(InstructionBuilder.addi(5, 0, 0))  # x0 stays zero
+        prog.append(InstructionBuilder.addi(7, 0, 1))
+        prog.append(InstructionBuilder.add(1, 1, 2))   # Reads result of previous instruction
+        prog.append(InstructionBuilder.add(2, 0, 3))
+        prog.append(InstructionBuilder.beq(0, 0, 0))   # Stop
+        
+        prog = [p.value() for p in prog]
+        
+        for pipelined in (False, True):
+            dut, core, data = core_with_memory(prog, pipelined, register_memory = True)
+            
+            async def bench(ctx):
+                await ctx.tick().repeat(50)
+                
+                for r, value in ((0, 0), (1, 7), (2, 14), (3, 14)):
+                    assert ctx.get(core.debug.reg[r]) == value
+                    
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_counters(self):
+        prog = list()
+        
+        prog.append(InstructionBuilder.csrrs(Csr.INSTRET.value, 0, 1))
+        prog.append(InstructionBuilder.csrrs(Csr.CYCLE.value, 0, 2))
+        prog.append(InstructionBuilder.load(0, 0, 5, 0b010))
+        prog.append(InstructionBuilder.csrrs(Csr.CYCLE.value, 0, 3))
+        prog.append(InstructionBuilder.csrrs(Csr.INSTRET.value, 0, 4))
+        prog.append(InstructionBuilder.csrrs(Csr.MEMORY_STALL.value, 0, 6))
+        prog.append(InstructionBuilder.csrrs(Csr.CYCLEH.value, 0, 7))
+        prog.append(InstructionBuilder.beq(0, 0, 0))
+        
+        prog = [p.value() for p in prog]
+        
+        for pipelined in (False, True):
+            dut, core, data = core_with_memory(prog, pipelined, counters = True)
+            
+            async def bench(ctx):
+                await ctx.tick().repeat(60)
+                
+                reg = [ctx.get(core.debug.reg[r]) for r in range(8)]
+                
+                assert reg[1] == 0
+                assert reg[4] == 4
+                # Byte loads wait on memory
+                assert reg[3] - reg[2] > 4
+                assert reg[6] > 0
+                assert reg[7] == 0
+                assert ctx.get(core.debug.counters[Csr.CYCLE]) == 60
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_predict_loop(self):
+        prog = list()
+        
+        prog.append(InstructionBuilder.addi(20, 0, 2))  # Loop limit
+        prog.append(InstructionBuilder.addi(1, 1, 1))   # Increment counter
+        prog.append(InstructionBuilder.addi(3, 3, 3))
+        prog.append(InstructionBuilder.bne(-8, 2, 1))   # Backward, predicted taken
+        prog.append(InstructionBuilder.addi(1, 0, 4))
+        prog.append(InstructionBuilder.beq(0, 0, 0))    # Stop
+        
+        prog = [p.value() for p in prog]
+        
+        for pipelined in (False, True):
+            cycles = dict()
+            
+            for predict in (False, True):
+                dut, core, data = core_with_memory(prog, pipelined, cached = True, predict = predict)
+                
+                async def bench(ctx):
+                    count = 0
+                    while ctx.get(core.debug.reg[4]) != 1:
+                        await ctx.tick()
+                        count += 1
+                    assert ctx.get(core.debug.reg[3]) == 60
+                    cycles[predict] = count
+                    
+                sim = Simulator(dut)
+                sim.add_clock(1e-8)
+                sim.add_testbench(bench)
+                
+                sim.run()
+                
+            # At least a cycle saved on most of the 19 taken branches
+            assert cycles[False] - cycles[True] >= 15
+            
+    def test_store_buffer(self):
+        prog = list()
+        
+        prog.append(InstructionBuilder.addi(0x123, 0, 1))
+        for i in range(6):
+            prog.append(InstructionBuilder.storeword(128 + 4 * i, 1, 0))
+            prog.append(InstructionBuilder.addi(1, 1, 1))
+            prog.append(InstructionBuilder.addi(1, 2, 2))
+            prog.append(InstructionBuilder.addi(1, 3, 3))
+        prog.append(InstructionBuilder.fence())
+        prog.append(InstructionBuilder.addi(1, 0, 4))
+        prog.append(InstructionBuilder.beq(0, 0, 0))    # Stop
+        
+        prog = [p.value() for p in prog]
+        
+        for pipelined in (False, True):
+            cycles = dict()
+            
+            for store_buffer in (0, 4):
+                dut, core, _ = core_with_program(prog, pipelined, 32, store_buffer = store_buffer)
+                
+                written = dict()
+                
+                async def slow_memory(ctx):
+                    # Writes wait three cycles before ack
+                    wait = 0
+                    while True:
+                        ctx.set(core.bus.ack, 0)
+                        if ctx.get(core.bus.cyc & core.bus.stb & core.bus.w_en):
+                            if wait == 3:
+                                written[ctx.get(core.bus.addr)] = ctx.get(core.bus.w_data)
+                                ctx.set(core.bus.ack, 1)
+                                wait = 0
+                            else:
+                                wait += 1
+                        await ctx.tick()
+                        
+                async def bench(ctx):
+                    count = 0
+                    while ctx.get(core.debug.reg[4]) != 1:
+                        await ctx.tick()
+                        count += 1
+                    # Every store is on the bus before the fence finishes
+                    assert written == {128 + 4 * i: 0x123 + i for i in range(6)}
+                    cycles[store_buffer] = count
+                    
+                sim = Simulator(dut)
+                sim.add_clock(1e-8)
+                sim.add_testbench(slow_memory, background = True)
+                sim.add_testbench(bench)
+                
+                sim.run()
+                
+            # Write waits overlap with the instructions after each store
+            assert cycles[0] - cycles[4] >= 10
+            
+    def test_store_buffer_device(self):
+        # Load of a device register after a buffered store to the device
+        prog = [
+            InstructionBuilder.addi(0x5A, 0, 1),
+            InstructionBuilder.storebyte(DelegateRegister.WRITE_DATA.value, 1, 0),
+            InstructionBuilder.storebyte(DelegateRegister.WRITE_DATA.value, 1, 0),
+            InstructionBuilder.load(DelegateRegister.BUFFER_SIZE.value, 0, 2, 0b100),
+            InstructionBuilder.addi(1, 0, 3),
+            InstructionBuilder.beq(0, 0, 0)
+        ]
+        prog = [p.value() for p in prog]
+        
+        for pipelined in (False, True):
+            dut, core, _ = core_with_program(prog, pipelined, store_buffer = 4)
+            delegate = dut.submodules.delegate = Delegate()
+            
+            # Slice slows the device down, so the store is still buffered at the load
+            reg = dut.submodules.reg = BusRegister(32, 8)
+            wiring.connect(dut, core.bus, reg.consume)
+            wiring.connect(dut, reg.produce, delegate.bus)
+            
+            async def bench(ctx):
+                while ctx.get(core.debug.reg[3]) != 1:
+                    await ctx.tick()
+                assert ctx.get(core.debug.reg[2]) == 2
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_data_cache(self):
+        prog = list()
+        
+        prog.append(InstructionBuilder.addi(8, 0, 2))               # Loop count
+        prog.append(InstructionBuilder.storeword(128, 2, 0))
+        prog.append(InstructionBuilder.load(128, 0, 3, 0b010))      # Sum words in one line
+        prog.append(InstructionBuilder.load(132, 0, 4, 0b010))
+        prog.append(InstructionBuilder.add(3, 1, 1))
+        prog.append(InstructionBuilder.add(4, 1, 1))
+        prog.append(InstructionBuilder.addi(-1, 2, 2))
+        prog.append(InstructionBuilder.bne(-24, 0, 2))
+        prog.append(InstructionBuilder.addi(1, 0, 5))
+        prog.append(InstructionBuilder.beq(0, 0, 0))                # Stop
+        
+        prog = [p.value() for p in prog]
+        
+        for pipelined in (False, True):
+            for data_width in (8, 32):
+                # Word accesses, a byte bus takes four transactions for each
+                for data_cache, words in ((False, 24), (True, 4)):
+                    transactions = words * 32 // data_width
+                    
+                    dut, core, data = core_with_memory(prog, pipelined, data_width, data_cache = data_cache)
+                    
+                    async def bench(ctx):
+                        count = 0
+                        while ctx.get(core.debug.reg[5]) != 1:
+                            if ctx.get(data.bus.cyc & data.bus.stb & data.bus.ack):
+                                count += 1
+                            await ctx.tick()
+                        assert ctx.get(core.debug.reg[1]) == 36
+                        # Only the line refill goes to memory
+                        assert count == transactions
+                        
+                    sim = Simulator(dut)
+                    sim.add_clock(1e-8)
+                    sim.add_testbench(bench)
+                    
+                    sim.run()
+                    
+    def test_scratchpad(self):
+        prog = list()
+        
+        prog.append(InstructionBuilder.lui(0x10000, 1))             # Scratchpad base
+        prog.append(InstructionBuilder.addi(0x55, 0, 2))
+        prog.append(InstructionBuilder.storeword(8, 2, 1))
+        prog.append(InstructionBuilder.storebyte(9, 2, 1))
+        prog.append(InstructionBuilder.load(8, 1, 3, 0b010))
+        prog.append(InstructionBuilder.storeword(16, 3, 0))         # Data memory
+        prog.append(InstructionBuilder.load(16, 0, 4, 0b010))
+        prog.append(InstructionBuilder.addi(1, 0, 5))
+        prog.append(InstructionBuilder.beq(0, 0, 0))                # Stop
+        
+        prog = [p.value() for p in prog]
+        
+        for pipelined in (False, True):
+            for data_width in (8, 32):
+                dut, core, data = core_with_memory(prog, pipelined, data_width, scratchpad = 64)
+                
+                async def bench(ctx):
+                    count = 0
+                    while ctx.get(core.debug.reg[5]) != 1:
+                        if ctx.get(core.bus.cyc & core.bus.stb & core.bus.ack):
+                            count += 1
+                        await ctx.tick()
+                    assert ctx.get(core.debug.reg[3]) == 0x5555
+                    assert ctx.get(core.debug.reg[4]) == 0x5555
+                    # Only the last store and load go out on the bus
+                    assert count == 2 * 32 // data_width
+                    
+                sim = Simulator(dut)
+                sim.add_clock(1e-8)
+                sim.add_testbench(bench)
+                
+                sim.run()
+                
+    def test_unified_memory(self):
+        prog = list()
+        
+        prog.append(InstructionBuilder.addi(0x77, 0, 1))
+        for i in range(4):
+            prog.append(InstructionBuilder.storeword(128 + 4 * i, 1, 0))
+            prog.append(InstructionBuilder.load(128 + 4 * i, 0, 2 + i, 0b010))
+        prog.append(InstructionBuilder.addi(1, 0, 8))
+        prog.append(InstructionBuilder.beq(0, 0, 0))                # Stop
+        
+        prog = [p.value() for p in prog]
+        
+        dut, core, mem = core_with_unified_memory(prog, pipelined = True)
+        
+        async def bench(ctx):
+            both = 0
+            while ctx.get(core.debug.reg[8]) != 1:
+                if ctx.get(mem.bus.ack & mem.bus_b.ack):
+                    both += 1
+                await ctx.tick()
+            assert [ctx.get(core.debug.reg[2 + i]) for i in range(4)] == [0x77] * 4
+            # Fetches continue while loads and stores use the other port
+            assert both >= 4
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_atomics(self):
+        # Counters shared through a switch and through banked memory
+        for build in (cores_with_switch, cores_with_banked_memory):
+            for pipelined in (False, True):
+                for data_width in (8, 32):
+                    n = 5
+                    prog = counter_program(n)
+                    dut, cores, data = build(prog, 2, pipelined, data_width, atomics = True)
+                    
+                    async def bench(ctx):
+                        for _ in range(3000):
+                            if all(ctx.get(core.debug.reg[12]) for core in cores):
+                                break
+                            await ctx.tick()
+                        for core in cores:
+                            assert ctx.get(core.debug.reg[12]) == 1
+                            assert ctx.get(core.debug.reg[10]) == 2 * n
+                            assert ctx.get(core.debug.reg[11]) == 2 * n
+                            
+                    sim = Simulator(dut)
+                    sim.add_clock(1e-8)
+                    sim.add_testbench(bench)
+                    
+                    sim.run()
+                    
+        with self.assertRaises(ValueError):
+            RiscCore(atomics = True, store_buffer = 4)
+        with self.assertRaises(ValueError):
+            BusSwitch([SwitchPortDef(32, 8)], 1, 32, 8, pipelined = True, atomic = True)
+            
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
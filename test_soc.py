@@ -0,0 +1,133 @@
+import unittest
+from amaranth.sim import *
+from amaranth import *
+
+from soc import SoC, memory_map, FB_BASE, DELEGATE_BASE, DMA_BASE
+from delegate import DelegateRegister
+from risc_core import Csr
+from test_risc_core import InstructionBuilder
+
+def soc_program():
+    prog = list()
+    
+    prog.append(InstructionBuilder.addi(0x5A, 0, 1))
+    
+    # Green of the second pixel
+    prog.append(InstructionBuilder.lui(FB_BASE >> 12, 2))
+    prog.append(InstructionBuilder.storebyte(4, 1, 2))
+    
+    # Through shared ram to the delegate
+    prog.append(InstructionBuilder.storebyte(0x100, 1, 0))
+    prog.append(InstructionBuilder.load(0x100, 0, 3, 0b100))
+    prog.append(InstructionBuilder.lui(DELEGATE_BASE >> 12, 4))
+    prog.append(InstructionBuilder.storebyte(0, 3, 4))
+    
+    prog.append(InstructionBuilder.jal(0))
+    
+    return [p.value() for p in prog]
+    
+class TestSoC(unittest.TestCase):
+    def test_cores(self):
+        dut = SoC(cores = 2, program = soc_program(), ram_size = 1024, width = 4, height = 4)
+        
+        async def bench(ctx):
+            ctx.set(dut.video.tready, 1)
+            
+            # Last frame of pixels
+            pixels = list()
+            for _ in range(2000):
+                if ctx.get(dut.video.tvalid):
+                    pixels = (pixels + [ctx.get(dut.video.tdata)])[-16:]
+                if all(ctx.get(d.level) == 1 for d in dut.delegates) and 0x005A00 in pixels:
+                    break
+                await ctx.tick()
+            assert [ctx.get(d.level) for d in dut.delegates] == [1, 1]
+            assert sorted(pixels) == [0] * 15 + [0x005A00]
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_dma(self):
+        prog = list()
+        
+        # Both cores send the first 4 bytes of ram to core 1
+        prog.append(InstructionBuilder.lui(DMA_BASE >> 12, 5))
+        prog.append(InstructionBuilder.addi(1, 0, 1))
+        prog.append(InstructionBuilder.storebyte(4, 1, 5))
+        prog.append(InstructionBuilder.addi(4, 0, 2))
+        prog.append(InstructionBuilder.storeword(0, 2, 5))
+        prog.append(InstructionBuilder.jal(0))
+        
+        prog = [p.value() for p in prog]
+        
+        dut = SoC(cores = 2, program = prog, ram_size = 1024, width = 4, height = 4)
+        
+        async def bench(ctx):
+            for _ in range(2000):
+                if all(ctx.get(d.interrupt.stb) for d in dut.dmas):
+                    break
+                await ctx.tick()
+            assert [ctx.get(d.interrupt.stb) for d in dut.dmas] == [1, 1]
+            assert [ctx.get(d.level) for d in dut.delegates] == [0, 8]
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_interrupt(self):
+        prog = list()
+        
+        # Both cores point their delegate interrupt at core 1, then sleep
+        prog.append(InstructionBuilder.addi(0x40, 0, 1))
+        prog.append(InstructionBuilder.csrrw(Csr.MTVEC.value, 1, 0))
+        prog.append(InstructionBuilder.lui(DELEGATE_BASE >> 12, 4))
+        prog.append(InstructionBuilder.addi(1, 0, 2))
+        prog.append(InstructionBuilder.storebyte(DelegateRegister.INTERRUPT_DEST.value, 2, 4))
+        prog.append(InstructionBuilder.csrrsi(Csr.MSTATUS.value, 8, 0))
+        prog.append(InstructionBuilder.storebyte(DelegateRegister.WRITE_DATA.value, 2, 4))
+        prog.append(InstructionBuilder.wfi())
+        prog.append(InstructionBuilder.jal(0))
+        
+        prog = [p.value() for p in prog]
+        prog += [0] * (16 - len(prog))
+        
+        # Handler at 0x40 sends the message on to its own delegate
+        handler = list()
+        handler.append(InstructionBuilder.csrrs(Csr.INT_DATA.value, 9, 3))
+        handler.append(InstructionBuilder.storebyte(DelegateRegister.WRITE_DATA.value, 3, 4))
+        handler.append(InstructionBuilder.jal(0))
+        
+        prog += [p.value() for p in handler]
+        
+        dut = SoC(cores = 2, program = prog, ram_size = 1024, width = 4, height = 4, interrupts = True)
+        
+        async def bench(ctx):
+            for _ in range(2000):
+                if ctx.get(dut.delegates[1].level) == 2:
+                    break
+                await ctx.tick()
+            # Only core 1 wakes
+            for _ in range(100):
+                await ctx.tick()
+            assert [ctx.get(d.level) for d in dut.delegates] == [1, 2]
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_memory_map(self):
+        assert memory_map(4096, 32, 32) == [(0x00000000, 4096, "ram"), (0x01000000, 4096, "fb"),
+                                             (0x02000000, 8, "delegate"), (0x03000000, 16, "dma")]
+                                             
+        with self.assertRaises(ValueError):
+            SoC(ram_size = 1000)
+            
+if __name__ == "__main__":
+    unittest.main()
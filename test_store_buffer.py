@@ -0,0 +1,164 @@
+import unittest
+from amaranth.sim import *
+from amaranth.lib import wiring
+from amaranth import *
+
+from bus_sim import *
+from store_buffer import StoreBuffer
+import ram
+
+def buffer_with_memory(depth = 4, data_width = 8):
+    m = Module()
+    
+    if data_width == 8:
+        buffer = m.submodules.buffer = StoreBuffer(depth, 8)
+        mem = m.submodules.mem = ram.WishboneMemory(8, 64)
+    else:
+        buffer = m.submodules.buffer = StoreBuffer(depth, 32, 4)
+        mem = m.submodules.mem = ram.WishboneMemory(32, 16, granularity = 2, byte_select = True)
+        
+    wiring.connect(m, buffer.mem, mem.bus)
+    
+    return m, buffer, mem
+    
+async def access(ctx, port, addr, data = None, sel = None):
+    ctx.set(port.addr, addr)
+    ctx.set(port.stb, 1)
+    ctx.set(port.cyc, 1)
+    ctx.set(port.w_en, data is not None)
+    if data is not None:
+        ctx.set(port.w_data, data)
+    if sel is not None:
+        ctx.set(port.sel, sel)
+    cycles = 0
+    while not ctx.get(port.ack):
+        await ctx.tick()
+        cycles += 1
+    r_data = ctx.get(port.r_data)
+    await ctx.tick()
+    ctx.set(port.stb, 0)
+    ctx.set(port.cyc, 0)
+    ctx.set(port.w_en, 0)
+    return r_data, cycles
+    
+class TestStoreBuffer(unittest.TestCase):
+    def test_forward(self):
+        dut, buffer, mem = buffer_with_memory()
+        
+        async def bench(ctx):
+            # Writes are acked straight away
+            for addr, data in ((1, 0x11), (2, 0x22), (1, 0x33)):
+                _, cycles = await access(ctx, buffer.proc, addr, data)
+                assert cycles == 0
+                
+            # Newest write to an address is forwarded
+            data, cycles = await access(ctx, buffer.proc, 1)
+            assert data == 0x33
+            assert cycles == 0
+            
+            # Other addresses are read from memory
+            data, cycles = await access(ctx, buffer.proc, 3)
+            assert data == 0
+            assert cycles > 0
+            
+            while not ctx.get(buffer.empty):
+                await ctx.tick()
+                
+            for addr, value in ((1, 0x33), (2, 0x22)):
+                data, _ = await access(ctx, buffer.proc, addr)
+                assert data == value
+            assert ctx.get(buffer.debug.forwarded) == 1
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_order(self):
+        dut, buffer, mem = buffer_with_memory()
+        
+        async def bench(ctx):
+            for addr, data in ((1, 0x11), (2, 0x22), (3, 0x33)):
+                await access(ctx, buffer.proc, addr, data)
+                
+            # Read of another address waits for the writes, a device sees them first
+            ctx.set(buffer.proc.addr, 7)
+            ctx.set(buffer.proc.stb, 1)
+            ctx.set(buffer.proc.cyc, 1)
+            while not ctx.get(buffer.proc.ack):
+                await ctx.tick()
+            assert ctx.get(buffer.empty)
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_full(self):
+        dut = StoreBuffer(depth = 2)
+        
+        async def bench(ctx):
+            # Memory doesn't ack so nothing drains
+            ctx.set(dut.proc.cyc, 1)
+            ctx.set(dut.proc.stb, 1)
+            ctx.set(dut.proc.w_en, 1)
+            acked = list()
+            for addr in range(3):
+                ctx.set(dut.proc.addr, addr)
+                ctx.set(dut.proc.w_data, addr + 0x40)
+                acked.append(ctx.get(dut.proc.ack))
+                await ctx.tick()
+            assert acked == [1, 1, 0]
+            ctx.set(dut.proc.cyc, 0)
+            ctx.set(dut.proc.stb, 0)
+            
+            # Drains oldest first, holding each write until ack
+            drained = list()
+            for _ in range(4):
+                assert ctx.get(dut.mem.cyc & dut.mem.stb & dut.mem.w_en)
+                await ctx.tick()
+                ctx.set(dut.mem.ack, 1)
+                drained.append((ctx.get(dut.mem.addr), ctx.get(dut.mem.w_data)))
+                await ctx.tick()
+                ctx.set(dut.mem.ack, 0)
+                if ctx.get(dut.empty):
+                    break
+            assert drained == [(0, 0x40), (1, 0x41)]
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_partial(self):
+        dut, buffer, mem = buffer_with_memory(data_width = 32)
+        
+        async def bench(ctx):
+            await access(ctx, buffer.proc, 4, 0x12345678, 0b1111)
+            await access(ctx, buffer.proc, 4, 0xAB00, 0b0010)
+            
+            # Byte covered by the newest write is forwarded
+            data, cycles = await access(ctx, buffer.proc, 4, sel = 0b0010)
+            assert data & 0xFF00 == 0xAB00
+            assert cycles == 0
+            
+            # Whole word waits for both writes to drain
+            data, cycles = await access(ctx, buffer.proc, 4, sel = 0b1111)
+            assert data == 0x1234AB78
+            assert ctx.get(buffer.debug.count) == 0
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_depth(self):
+        with self.assertRaises(ValueError):
+            StoreBuffer(3)
+            
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,413 @@
+import unittest
+from amaranth.sim import *
+from amaranth.lib import wiring
+from amaranth import *
+
+from bus_sim import *
+from signature import CycleType
+from switch import BusSwitch, SwitchPortDef, Arbitration, BusRegister, AddressSwitch, AddressDecoder
+from cache import InstructionCache
+import ram
+
+def switch_with_memory(pipelined = False, **kwargs):
+    m = Module()
+    
+    switch = m.submodules.switch = BusSwitch([SwitchPortDef(32, 8)], 1, 32, 8, num_inputs = 2, pipelined = pipelined, **kwargs)
+    mem = m.submodules.mem = ram.WishboneMemory(8, 16, init = [0x10 + i for i in range(16)], pipelined = pipelined)
+    
+    wiring.connect(m, switch.p_00, mem.bus)
+    
+    return m, switch
+    
+def hold_requests(switch, cycles = 64):
+    """
+    Both inputs keep reading, returns acks for each input
+    """
+    acks = [0, 0]
+    
+    async def bench(ctx):
+        inputs = [switch.c_00, switch.c_01]
+        for i, c in enumerate(inputs):
+            ctx.set(c.addr, i)
+            ctx.set(c.stb, 1)
+            ctx.set(c.cyc, 1)
+        for _ in range(cycles):
+            for i, c in enumerate(inputs):
+                if ctx.get(c.ack):
+                    assert ctx.get(c.r_data) == 0x10 + i
+                    acks[i] += 1
+            await ctx.tick()
+            
+    return bench, acks
+    
+class TestBusSwitch(unittest.TestCase):
+    def test_pipelined(self):
+        contents = [i & 0xFF for i in range(64)]
+        
+        m = Module()
+        
+        cache = m.submodules.cache = InstructionCache(pipelined = True)
+        switch = m.submodules.switch = BusSwitch([SwitchPortDef(32, 8)], 1, 32, 8, num_inputs = 2, pipelined = True)
+        mem = m.submodules.mem = ram.WishboneMemory(8, len(contents), init = contents, pipelined = True)
+        
+        wiring.connect(m, cache.mem, switch.c_00)
+        wiring.connect(m, switch.p_00, mem.bus)
+        
+        other = switch.c_01
+        
+        async def bench(ctx):
+            ctx.set(cache.proc.addr, 16)
+            ctx.set(cache.proc.stb, 1)
+            ctx.set(cache.proc.cyc, 1)
+            
+            count = 0
+            while not ctx.get(cache.proc.ack):
+                if count == 2:
+                    # Other input waits while the cache refills
+                    ctx.set(other.addr, 40)
+                    ctx.set(other.stb, 1)
+                    ctx.set(other.cyc, 1)
+                if count >= 2:
+                    assert ctx.get(other.stall)
+                count += 1
+                await ctx.tick()
+            # A beat every cycle through the switch, after a cycle to select the cache
+            assert count == 19
+            ctx.set(cache.proc.stb, 0)
+            ctx.set(cache.proc.cyc, 0)
+            
+            while ctx.get(other.stall):
+                await ctx.tick()
+            await ctx.tick()
+            ctx.set(other.stb, 0)
+            while not ctx.get(other.ack):
+                await ctx.tick()
+            assert ctx.get(other.r_data) == 40
+            
+        sim = Simulator(m)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+    def test_crossbar(self):
+        # Each input reads from a different port
+        finished = dict()
+        for crossbar in (False, True):
+            m = Module()
+            
+            switch = m.submodules.switch = BusSwitch([SwitchPortDef(32, 8), SwitchPortDef(32, 8)], 1, 32, 8,
+                                                     num_inputs = 2, crossbar = crossbar)
+            for i in range(2):
+                mem = m.submodules["mem{}".format(i)] = ram.WishboneMemory(8, 16, init = [0x10 * (i + 1) + j for j in range(16)])
+                wiring.connect(m, getattr(switch, "p_{:02X}".format(i)), mem.bus)
+                
+            inputs = [switch.c_00, switch.c_01]
+            
+            async def bench(ctx):
+                for i, c in enumerate(inputs):
+                    ctx.set(c.addr, 3)
+                    ctx.set(c.dest, i)
+                    ctx.set(c.stb, 1)
+                    ctx.set(c.cyc, 1)
+                    
+                acked = dict()
+                cycle = 0
+                while len(acked) < 2:
+                    for i, c in enumerate(inputs):
+                        if ctx.get(c.ack) and i not in acked:
+                            acked[i] = cycle
+                            assert ctx.get(c.r_data) == 0x10 * (i + 1) + 3
+                            ctx.set(c.stb, 0)
+                            ctx.set(c.cyc, 0)
+                    cycle += 1
+                    await ctx.tick()
+                    
+                finished[crossbar] = acked
+                
+            sim = Simulator(m)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+        # Shared switch serves one input at a time, crossbar overlaps them
+        assert finished[False][1] > finished[False][0] + 1
+        assert max(finished[True].values()) < max(finished[False].values())
+        
+    def test_max_grant(self):
+        for pipelined in (False, True):
+            # Input holding cyc starves the other
+            dut, switch = switch_with_memory(pipelined)
+            bench, acks = hold_requests(switch)
+            
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            sim.run()
+            
+            assert acks[1] == 0
+            
+            # Grant ends after 8 cycles
+            dut, switch = switch_with_memory(pipelined, max_grant = 8)
+            bench, acks = hold_requests(switch)
+            
+            async def wait(ctx):
+                await ctx.tick().repeat(64)
+                # Waits at most one grant at a time
+                assert 0 < ctx.get(switch.debug.wait[1]) < 40
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            sim.add_testbench(wait)
+            sim.run()
+            
+            assert acks[1] > 0
+            assert abs(acks[0] - acks[1]) <= acks[0] // 2
+            
+    def test_priority(self):
+        dut, switch = switch_with_memory(arbitration = Arbitration.PRIORITY)
+        
+        async def bench(ctx):
+            # Input 1 is selected and reading
+            ctx.set(switch.c_01.addr, 1)
+            ctx.set(switch.c_01.stb, 1)
+            ctx.set(switch.c_01.cyc, 1)
+            while not ctx.get(switch.c_01.ack):
+                await ctx.tick()
+            await ctx.tick()
+            
+            # Input 0 takes over at the end of the next read
+            ctx.set(switch.c_00.addr, 0)
+            ctx.set(switch.c_00.stb, 1)
+            ctx.set(switch.c_00.cyc, 1)
+            acks = [0, 0]
+            for _ in range(16):
+                for i, c in enumerate((switch.c_00, switch.c_01)):
+                    acks[i] += ctx.get(c.ack)
+                await ctx.tick()
+            assert acks[1] <= 1
+            assert acks[0] >= 6
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        sim.run()
+        
+    def test_burst(self):
+        # Other input asks for the switch in the middle of a burst
+        for burster, kwargs in ((1, dict(arbitration = Arbitration.PRIORITY)), (0, dict(max_grant = 2))):
+            m = Module()
+            
+            switch = m.submodules.switch = BusSwitch([SwitchPortDef(32, 8, burst = True)], 1, 32, 8, num_inputs = 2,
+                                                     burst = True, **kwargs)
+            mem = m.submodules.mem = ram.WishboneMemory(8, 16, init = [0x10 + i for i in range(16)], burst = True)
+            
+            wiring.connect(m, switch.p_00, mem.bus)
+            
+            inputs = [switch.c_00, switch.c_01]
+            b = inputs[burster]
+            other = inputs[1 - burster]
+            
+            async def bench(ctx):
+                beats = list()
+                ctx.set(b.cti, CycleType.INCREMENT)
+                ctx.set(b.stb, 1)
+                ctx.set(b.cyc, 1)
+                
+                read = None
+                cycle = 0
+                while len(beats) < 8 or read is None:
+                    # Address moves on after each acked beat
+                    ctx.set(b.addr, len(beats))
+                    ctx.set(b.cti, CycleType.END if len(beats) == 7 else CycleType.INCREMENT)
+                    if cycle == 2:
+                        ctx.set(other.addr, 12)
+                        ctx.set(other.stb, 1)
+                        ctx.set(other.cyc, 1)
+                    if ctx.get(other.ack) and read is None:
+                        read = ctx.get(other.r_data)
+                        ctx.set(other.stb, 0)
+                        ctx.set(other.cyc, 0)
+                    if len(beats) < 8 and ctx.get(b.ack):
+                        beats.append(ctx.get(b.r_data))
+                        if len(beats) == 8:
+                            ctx.set(b.stb, 0)
+                            ctx.set(b.cyc, 0)
+                    cycle += 1
+                    await ctx.tick()
+                
+                # Burst runs to the end before the other input is served
+                assert beats == [0x10 + i for i in range(8)]
+                assert read == 0x1C
+            
+            sim = Simulator(m)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_weighted(self):
+        dut, switch = switch_with_memory(arbitration = Arbitration.WEIGHTED, weights = [12, 4])
+        bench, acks = hold_requests(switch, 128)
+        
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        sim.run()
+        
+        # Roughly three reads for input 0 to every one for input 1
+        assert 2 * acks[1] < acks[0] < 4 * acks[1]
+        
+        with self.assertRaises(ValueError):
+            BusSwitch([SwitchPortDef(32, 8)], 1, 32, 8, arbitration = Arbitration.WEIGHTED, weights = [1])
+            
+class TestBusRegister(unittest.TestCase):
+    def test_pipelined(self):
+        dut = BusRegister(pipelined = True)
+        
+        stalls = (2, 3, 7)
+        received = list()
+        
+        async def slave(ctx):
+            # Stall on some cycles, ack the next cycle
+            taken = None
+            for cycle in range(20):
+                ctx.set(dut.produce.ack, taken is not None)
+                if taken is not None:
+                    ctx.set(dut.produce.r_data, taken + 0x100)
+                ctx.set(dut.produce.stall, cycle in stalls)
+                taken = None
+                if ctx.get(dut.produce.stb) and cycle not in stalls:
+                    taken = ctx.get(dut.produce.addr)
+                    received.append(taken)
+                await ctx.tick()
+                    
+        async def master(ctx):
+            ctx.set(dut.consume.cyc, 1)
+            acks = list()
+            addr = 0
+            for _ in range(20):
+                ctx.set(dut.consume.stb, addr < 8)
+                ctx.set(dut.consume.addr, addr)
+                if ctx.get(dut.consume.ack):
+                    acks.append(ctx.get(dut.consume.r_data))
+                if addr < 8 and not ctx.get(dut.consume.stall):
+                    addr += 1
+                await ctx.tick()
+            # Every request in order, stalls don't lose any
+            assert received == list(range(8))
+            assert acks == [0x100 + i for i in range(8)]
+            
+        sim = Simulator(dut)
+        sim.add_clock(1e-8)
+        sim.add_testbench(slave)
+        sim.add_testbench(master)
+        
+        sim.run()
+        
+    def test_switch(self):
+        # Registered switch adds a cycle each way
+        cycles = dict()
+        for registered in (False, True):
+            dut, switch = switch_with_memory(registered = registered)
+            
+            async def bench(ctx):
+                # Switch settles on the input first
+                ctx.set(switch.c_00.cyc, 1)
+                await ctx.tick().repeat(2)
+                ctx.set(switch.c_00.addr, 5)
+                ctx.set(switch.c_00.stb, 1)
+                count = 0
+                while not ctx.get(switch.c_00.ack):
+                    count += 1
+                    await ctx.tick()
+                assert ctx.get(switch.c_00.r_data) == 0x15
+                cycles[registered] = count
+                
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+        assert cycles[True] == cycles[False] + 2
+        
+        # Pipelined switch keeps a request every cycle
+        for registered in (False, True):
+            dut, switch = switch_with_memory(True, registered = registered)
+            bench, acks = hold_requests(switch, 32)
+            
+            sim = Simulator(dut)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            sim.run()
+            
+            assert acks[0] >= 32 - 3
+            
+        with self.assertRaises(ValueError):
+            BusSwitch([SwitchPortDef(32, 8, burst = True)], 1, 32, 8, burst = True, registered = True)
+            
+    def test_address_switch(self):
+        m = Module()
+        
+        switch = m.submodules.switch = AddressSwitch(split = 16, registered = True)
+        a = m.submodules.a = ram.WishboneMemory(32, 16, init = [0xA0 + i for i in range(16)])
+        b = m.submodules.b = ram.WishboneMemory(32, 16, init = [0xB0 + i for i in range(16)])
+        
+        wiring.connect(m, switch.a, a.bus)
+        wiring.connect(m, switch.b, b.bus)
+        
+        async def bench(ctx):
+            for addr, expected in ((3, 0xA3), (18, 0xB2)):
+                ctx.set(switch.consume.addr, addr)
+                ctx.set(switch.consume.stb, 1)
+                ctx.set(switch.consume.cyc, 1)
+                while not ctx.get(switch.consume.ack):
+                    await ctx.tick()
+                assert ctx.get(switch.consume.r_data) == expected
+                await ctx.tick()
+                
+        sim = Simulator(m)
+        sim.add_clock(1e-8)
+        sim.add_testbench(bench)
+        
+        sim.run()
+        
+class TestAddressDecoder(unittest.TestCase):
+    def test_regions(self):
+        # Aligned regions decode on prefix, others on compares
+        for regions in ([(0x00, 16, "ram"), (0x40, 16, "fb"), (0x20, 8, "mailbox")],
+                        [(0x00, 12, "ram"), (0x40, 10, "fb"), (0x20, 8, "mailbox")]):
+            m = Module()
+            
+            decoder = m.submodules.decoder = AddressDecoder(regions)
+            for i, (base, size, name) in enumerate(regions):
+                mem = m.submodules[name] = ram.WishboneMemory(32, size, init = [(i + 1) * 0x100 + j for j in range(size)])
+                wiring.connect(m, getattr(decoder, name), mem.bus)
+                
+            async def bench(ctx):
+                for addr, expected in ((0x03, 0x103), (0x45, 0x205), (0x27, 0x307), (0x30, 0)):
+                    ctx.set(decoder.consume.addr, addr)
+                    ctx.set(decoder.consume.stb, 1)
+                    ctx.set(decoder.consume.cyc, 1)
+                    while not ctx.get(decoder.consume.ack):
+                        await ctx.tick()
+                    assert ctx.get(decoder.consume.r_data) == expected
+                    await ctx.tick()
+                    ctx.set(decoder.consume.stb, 0)
+                    await ctx.tick()
+                    
+            sim = Simulator(m)
+            sim.add_clock(1e-8)
+            sim.add_testbench(bench)
+            
+            sim.run()
+            
+    def test_overlap(self):
+        with self.assertRaises(ValueError):
+            AddressDecoder([(0x00, 16, "a"), (0x08, 16, "b")])
+            
+if __name__ == "__main__":
+    unittest.main()
@@ -206,8 +206,7 @@ class InstructionCacheWidget(object):
         debug = self.cache.debug
         if debug is None:
             return
-        # Hardcoded for now
-        self.ready = [ctx.get(debug.ready[i]) for i in range(4)]
+        self.ready = [ctx.get(r) for r in debug.ready]
         self.state = ctx.get(debug.state)
         
     def draw(self, canvas):
@@ -222,7 +221,8 @@ class InstructionCacheWidget(object):
                             anchor = tk.NW)
         
         msg = " " 
-        if self.state == 0:
+        if self.state != 0:
+            # Refilling line
             msg = "..."
             
         canvas.create_text(self.param.top_left_padded(y_offset = 12),
@@ -232,7 +232,7 @@ class InstructionCacheWidget(object):
                             anchor = tk.NW)
         
         if self.ready is not None:
-            msg = ["_" for _ in range(4)]
+            msg = ["_" for _ in range(len(self.ready))]
             for i in range(len(self.ready)):
                 if self.ready[i]:
                     msg[i] = "x"